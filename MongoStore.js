@@ -12,36 +12,69 @@ dojo.require('dojox.rpc.Rest');
 dojo.require('dojox.data.JsonRestStore');
 dojo.require('dojo.io.iframe');
 
+// parse json except for a 304, which the store fills in from its cache
+dojo._contentHandlers.mongoJson = function(xhr) {
+    return xhr.status == 304 ? null : dojo._contentHandlers.json(xhr);
+};
+
 dojo.declare('uow.data.MongoStore', [dojox.data.JsonRestStore], {
+    // set true to page through sorted queries using keys from the server
+    // instead of having it skip over all the earlier rows
+    keysetPaging: false,
+    // fields to fetch in queries, all when empty. Fetched items only hold
+    // these fields so leave patchUpdates on to save changes to them.
+    fields: [],
+    // save at least this many changes in one request to the bulk endpoint, 0 never
+    bulkThreshold: 20,
+    // save changed items by sending only their changed fields
+    patchUpdates: true,
+    // most responses to keep for reuse when the server says they are unchanged, 0 none
+    etagCache: 200,
+    _rangeKeyCount: 0,
+    _etagCount: 0,
     constructor: function(options){
-        // monkey patch service._getRequest to insert an additional header
-        if (options.accessKey) {
-            var _getRequest = this.service._getRequest;
-            var myKey = options.accessKey;
-            this.accessKey = myKey;
-            var myGetRequest = function(id, args) {
-                var request = _getRequest(id, args);
-                // take the key off the path before using it.
+        // range keys from the server by query and start position
+        this._rangeKeys = {};
+        // responses with ETags by url, range and range key
+        this._etags = {};
+        var self = this;
+        // monkey patch service._getRequest to insert additional headers, the
+        // range fixes and keyset paging are needed even without a key
+        var _getRequest = this.service._getRequest;
+        var myKey = options.accessKey;
+        this.accessKey = myKey;
+        var myGetRequest = function(id, args) {
+            var request = _getRequest(id, args);
+            // take the key off the path before using it.
+            if (myKey) {
                 request.headers['Authorization'] = myKey;
-                // fix a bug in dojo range handling
-                if (args && (args.start >= 0 || args.count >= 0)) {
-                    var start = args.start || 0;
-                    var range = 'items=' + start + '-';
-                    if (args.count !== undefined && args.count != Infinity) {
-                        if (args.count === 0) {
-                             // minimum is one because last-pos must be >= than first-pos
-                             // according to 14.35 in http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html
-                            range += start;
-                        } else {
-                            range += args.count + start - 1;
-                        }
+            }
+            // fix a bug in dojo range handling
+            if (args && (args.start >= 0 || args.count >= 0)) {
+                var start = args.start || 0;
+                var range = 'items=' + start + '-';
+                if (args.count !== undefined && args.count != Infinity) {
+                    if (args.count === 0) {
+                         // minimum is one because last-pos must be >= than first-pos
+                         // according to 14.35 in http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html
+                        range += start;
+                    } else {
+                        range += args.count + start - 1;
                     }
-                    request.headers.Range = range;
                 }
-                return request;
-            };
-            this.service._getRequest = myGetRequest;
-        }
+                request.headers.Range = range;
+            }
+            // continue a query from where the previous page ended
+            if (args && args.rangeKey) {
+                request.headers['X-Range-Key'] = args.rangeKey;
+            }
+            if (self.etagCache) {
+                self._conditional(request, [request.url, request.headers.Range,
+                                             request.headers['X-Range-Key']].join('|'));
+            }
+            return request;
+        };
+        this.service._getRequest = myGetRequest;
     },
     _doQuery: function(args) {
         // pack the query into one parameter with the query args json and uri encoded
@@ -62,9 +95,347 @@ dojo.declare('uow.data.MongoStore', [dojox.data.JsonRestStore], {
                 return (v.descending ? '-' : '+') + encodeURIComponent(v.attribute); }).join(',');
             qs.ms = s;
         }
+        var fields = args.fields || this.fields;
+        if (typeof(fields) == 'string') {
+            fields = fields.split(',');
+        }
+        if (fields && fields.length) {
+            qs.mf = dojo.map(fields, encodeURIComponent).join(',');
+        }
         args.query = qs;
-        // hand off to the method in JsonRestStore
-        return this.inherited(arguments);
+        if (!this.keysetPaging) {
+            // hand off to the method in JsonRestStore
+            return this.inherited(arguments);
+        }
+        // send the key for this page if we have one, otherwise ask for one
+        var qkey = dojo.toJson(qs) + '@';
+        var start = args.start || 0;
+        args.rangeKey = this._rangeKeys[qkey + start] || '*';
+        var d = this.inherited(arguments);
+        var self = this;
+        d.addCallback(function(results) {
+            var xhr = d.ioArgs && d.ioArgs.xhr;
+            var key = xhr && xhr.getResponseHeader('X-Range-Key');
+            if (key && results) {
+                if (self._rangeKeyCount++ > 1000) {
+                    self._rangeKeys = {};
+                    self._rangeKeyCount = 0;
+                }
+                self._rangeKeys[qkey + (start + results.length)] = key;
+            }
+            return results;
+        });
+        return d;
+    },
+    _conditional: function(request, key) {
+        // ask for the response only if it changed since the copy we have and
+        // answer a 304 with that copy
+        var cached = this._etags[key], self = this;
+        if (cached) {
+            request.headers['If-None-Match'] = cached.etag;
+        }
+        request.handleAs = 'mongoJson';
+        request.load = function(result, ioArgs) {
+            var xhr = ioArgs.xhr;
+            if (xhr.status == 304 && cached) {
+                // the range and key headers of the cached copy are still good
+                ioArgs.xhr = {
+                    status: 200,
+                    responseText: cached.text,
+                    getResponseHeader: function(name) {
+                        return cached.headers[name] || xhr.getResponseHeader(name);
+                    }
+                };
+                return dojo.fromJson(cached.text);
+            }
+            var etag = xhr.getResponseHeader('ETag');
+            if (etag) {
+                if (self._etagCount++ > self.etagCache) {
+                    self._etags = {};
+                    self._etagCount = 0;
+                }
+                self._etags[key] = {
+                    etag: etag,
+                    text: xhr.responseText,
+                    headers: {
+                        'Content-Range': xhr.getResponseHeader('Content-Range'),
+                        'X-Range-Key': xhr.getResponseHeader('X-Range-Key')
+                    }
+                };
+            }
+            return result;
+        };
+    },
+    save: function(kwArgs) {
+        // send many changes to this store in one bulk request instead of one each
+        // and changed items as just their changed fields
+        kwArgs = kwArgs || {};
+        var path = this.service.servicePath;
+        var dirty = dojox.rpc.JsonRest.getDirtyObjects();
+        var mine = dojo.filter(dirty, function(d) {
+            var it = d.object || d.old;
+            return d.save && it && it.__id && it.__id.indexOf(path) === 0;
+        });
+        var nested = dojo.some(mine, function(d) {
+            return d.object && d.old && d.object.__id.indexOf('#') >= 0;
+        });
+        if (nested) {
+            return this.inherited(arguments);
+        }
+        if (this.bulkThreshold && mine.length >= this.bulkThreshold) {
+            return this._saveBulk(kwArgs, path, dirty, mine);
+        }
+        var changed = this.patchUpdates ? dojo.filter(mine, function(d) {
+            return d.object && d.old;
+        }) : [];
+        if (!changed.length) {
+            return this.inherited(arguments);
+        }
+        this._takeDirty(dirty, changed);
+        var requests = dojo.map(changed, function(d) {
+            var xhr = dojo.xhr('PATCH', {
+                url: d.object.__id,
+                postData: dojox.json.ref.toJson(this._changes(d), false, path, true),
+                headers: { 'Authorization': this.accessKey,
+                           'Content-Type': 'application/json' },
+                handleAs: 'json'
+            }, true);
+            xhr.addErrback(dojo.hitch(this, function(err) {
+                this._putDirty(dirty, [d]);
+                return err;
+            }));
+            return xhr;
+        }, this);
+        if (dirty.length) {
+            // let JsonRest save the creates and deletes
+            var rest = new dojo.Deferred();
+            this.inherited(arguments, [dojo.mixin({}, kwArgs, {
+                onComplete: function() { rest.callback(true); },
+                onError: function(err) { rest.errback(err); }
+            })]);
+            requests.push(rest);
+        }
+        var d = new dojo.DeferredList(requests, false, true, true);
+        d.addCallback(function(results) {
+            if (kwArgs.onComplete) {
+                kwArgs.onComplete.call(kwArgs.scope, mine);
+            }
+            return results;
+        });
+        d.addErrback(function(err) {
+            if (kwArgs.onError) {
+                kwArgs.onError.call(kwArgs.scope, err);
+            }
+            return err;
+        });
+        return d;
+    },
+    _changes: function(dirty) {
+        // the fields of an item changed since it was first made dirty, null for removed ones
+        var object = dirty.object, old = dirty.old, changes = {}, key;
+        for (key in object) {
+            if (object.hasOwnProperty(key) && key.substr(0, 2) != '__') {
+                // objects and arrays may have been changed in place so always send them
+                if (object[key] !== old[key] ||
+                    (object[key] && typeof(object[key]) == 'object')) {
+                    changes[key] = object[key];
+                }
+            }
+        }
+        for (key in old) {
+            if (old.hasOwnProperty(key) && key.substr(0, 2) != '__' && !(key in object)) {
+                changes[key] = null;
+            }
+        }
+        delete changes._id;
+        return changes;
+    },
+    _takeDirty: function(dirty, entries) {
+        // take entries off the dirty list the way JsonRest.commit does
+        for (var i = dirty.length - 1; i >= 0; i--) {
+            if (dojo.indexOf(entries, dirty[i]) >= 0) {
+                dirty.splice(i, 1);
+            }
+        }
+        dojo.forEach(entries, function(entry) {
+            if (entry.object) {
+                delete entry.object.__isDirty;
+            }
+        });
+    },
+    _putDirty: function(dirty, entries) {
+        // the server checks everything before writing so failed entries are still dirty
+        dojo.forEach(entries, function(entry) {
+            dirty.push(entry);
+            if (entry.object) {
+                entry.object.__isDirty = true;
+            }
+        });
+    },
+    _saveBulk: function(kwArgs, path, dirty, mine) {
+        // save this store's changes with one request to the bulk endpoint
+        this._takeDirty(dirty, mine);
+        var ops = dojo.map(mine, function(d) {
+            var id = (d.object || d.old).__id.substring(path.length);
+            if (!d.object) {
+                return dojo.toJson({method: 'delete', id: id});
+            }
+            if (!d.old) {
+                return '{"method":"post","content":' +
+                    dojox.json.ref.toJson(d.object, false, path, true) + '}';
+            }
+            if (this.patchUpdates) {
+                return '{"method":"patch","id":' + dojo.toJson(id) + ',"content":' +
+                    dojox.json.ref.toJson(this._changes(d), false, path, true) + '}';
+            }
+            return '{"method":"put","id":' + dojo.toJson(id) + ',"content":' +
+                dojox.json.ref.toJson(d.object, false, path, true) + '}';
+        }, this);
+        var d = dojo.xhrPost({
+            url: path + '_bulk',
+            postData: '[' + ops.join(',') + ']',
+            headers: { 'Authorization': this.accessKey,
+                       'Content-Type': 'application/json' },
+            handleAs: 'json'
+        });
+        d.addCallback(function(results) {
+            dojo.forEach(mine, function(dirty, i) {
+                if (dirty.object && !dirty.old) {
+                    // new items get their id from the server
+                    var object = dirty.object;
+                    dojo.mixin(object, results[i]);
+                    object.__id = path + results[i]._id;
+                    dojox.rpc.Rest._index[object.__id] = object;
+                }
+            });
+            if (kwArgs.onComplete) {
+                kwArgs.onComplete.call(kwArgs.scope, mine);
+            }
+            return results;
+        });
+        d.addErrback(dojo.hitch(this, function(err) {
+            this._putDirty(dirty, mine);
+            if (kwArgs.onError) {
+                kwArgs.onError.call(kwArgs.scope, err);
+            }
+            return err;
+        }));
+        return d;
+    },
+    watch: function(args) {
+        // keep the cached items up to date with changes saved by others by
+        // waiting on the server for them instead of fetching the query again.
+        // args.query and args.fields select items like fetch. args.onChange is
+        // called with the changed items and the ids of the items that left the
+        // query after they are applied, args.onReset when the server lost
+        // track of the changes and the query should be fetched again.
+        // Returns a handle with a cancel method.
+        args = args || {};
+        var self = this, since = '', request = null, cancelled = false, delay = 0;
+        var content = {};
+        if (args.query && typeof(args.query) == 'object') {
+            content.mq = encodeURIComponent(dojo.toJson(args.query));
+        }
+        var fields = args.fields || this.fields;
+        if (typeof(fields) == 'string') {
+            fields = fields.split(',');
+        }
+        if (fields && fields.length) {
+            content.mf = dojo.map(fields, encodeURIComponent).join(',');
+        }
+        var poll = function() {
+            if (cancelled) {
+                return;
+            }
+            request = dojo.xhrGet({
+                url: self.service.servicePath + '_changes',
+                content: dojo.mixin({ since: since }, content),
+                headers: { 'Authorization': self.accessKey },
+                handleAs: 'json',
+                preventCache: true
+            });
+            request.addCallback(function(response) {
+                delay = 0;
+                if (response.reset) {
+                    if (args.onReset) {
+                        args.onReset.call(args.scope);
+                    }
+                } else if (since) {
+                    var changed = self._applyChanges(response, !(fields && fields.length));
+                    if (args.onChange && (changed.length || response.deleted.length)) {
+                        args.onChange.call(args.scope, changed, response.deleted);
+                    }
+                }
+                since = response.since;
+                poll();
+            });
+            request.addErrback(function(err) {
+                // back off while the server is away
+                if (!cancelled) {
+                    delay = Math.min(delay * 2 || 1000, 60000);
+                    setTimeout(poll, delay);
+                }
+            });
+        };
+        poll();
+        return {
+            cancel: function() {
+                cancelled = true;
+                if (request) {
+                    request.cancel();
+                }
+            }
+        };
+    },
+    _applyChanges: function(response, whole) {
+        // update, add and remove cached items and tell the store's listeners.
+        // Items with unsaved changes are left alone.
+        var path = this.service.servicePath, index = dojox.rpc.Rest._index, changed = [];
+        dojo.forEach(response.items, function(fresh) {
+            var id = path + fresh._id, item = index[id], key, old;
+            if (!item) {
+                fresh.__id = id;
+                index[id] = fresh;
+                this.onNew(fresh);
+                changed.push(fresh);
+                return;
+            }
+            if (item.__isDirty) {
+                return;
+            }
+            for (key in fresh) {
+                if (fresh.hasOwnProperty(key) && key.substr(0, 2) != '__' &&
+                    dojo.toJson(item[key]) != dojo.toJson(fresh[key])) {
+                    old = item[key];
+                    item[key] = fresh[key];
+                    this.onSet(item, key, old, fresh[key]);
+                }
+            }
+            if (whole) {
+                // only a whole item shows which fields were removed
+                for (key in item) {
+                    if (item.hasOwnProperty(key) && key.substr(0, 2) != '__' && !(key in fresh)) {
+                        old = item[key];
+                        delete item[key];
+                        this.onSet(item, key, old, undefined);
+                    }
+                }
+            }
+            changed.push(item);
+        }, this);
+        dojo.forEach(response.deleted, function(_id) {
+            var id = path + _id, item = index[id];
+            if (item && !item.__isDirty) {
+                delete index[id];
+                this.onDelete(item);
+            }
+        }, this);
+        return changed;
+    },
+    useGridFields: function(grid) {
+        // fetch only the fields displayed in a grid's columns
+        this.fields = dojo.filter(dojo.map(grid.layout.cells, function(cell) {
+            return cell.field; }), function(field) { return field && field != '_item'; });
     },
     upload: function(args) {
         // upload a file using io.iframe.send
@@ -243,6 +614,81 @@ uow.data.getDatabase = function(args) {
     return def;
 };
 
+// Fetch from several stores with one request. Each request is like the
+// arguments to fetch with a store: {store, query, sort, fields, start, count,
+// onComplete, onError, scope}. onComplete gets the items and the request,
+// onError the error. The Deferred gets a list of {items, total} or {error,
+// status} in the same order.
+uow.data.batchFetch = function(requests) {
+    var queries = dojo.map(requests, function(request) {
+        var store = request.store;
+        // the service path is /data/mode-database/collection/
+        var parts = store.service.servicePath.split('/');
+        var query = {
+            key: store.accessKey,
+            database: parts[2].substring(parts[2].indexOf('-') + 1),
+            collection: parts[3]
+        };
+        if (request.query && typeof(request.query) == 'object') {
+            query.mq = request.query;
+        }
+        if (request.sort) {
+            query.ms = dojo.map(request.sort, function(v) {
+                return (v.descending ? '-' : '+') + v.attribute; }).join(',');
+        }
+        var fields = request.fields || store.fields;
+        if (typeof(fields) == 'string') {
+            fields = fields.split(',');
+        }
+        if (fields && fields.length) {
+            query.mf = fields;
+        }
+        if (request.count !== undefined && request.count != Infinity) {
+            query.start = request.start || 0;
+            query.count = request.count;
+        }
+        return query;
+    });
+    var d = dojo.xhrGet({
+        url: '/data/_batch',
+        content: { q: dojo.toJson(queries) },
+        handleAs: 'json'
+    });
+    return d.then(function(response) {
+        return dojo.map(response.results, function(result, i) {
+            var request = requests[i];
+            if (result.error) {
+                if (request.onError) {
+                    request.onError.call(request.scope, result);
+                }
+                return result;
+            }
+            var path = request.store.service.servicePath, index = dojox.rpc.Rest._index;
+            // share items already in the store like fetch does
+            var items = dojo.map(result.items, function(item) {
+                var id = path + item._id;
+                if (index[id]) {
+                    return index[id].__isDirty ? index[id] : dojo.mixin(index[id], item);
+                }
+                item.__id = id;
+                index[id] = item;
+                return item;
+            });
+            if (request.onComplete) {
+                request.onComplete.call(request.scope, items, request);
+            }
+            return { items: items, total: parseInt(result.range.split('/')[1], 10) };
+        });
+    }, function(err) {
+        dojo.forEach(requests, function(request) {
+            if (request.onError) {
+                request.onError.call(request.scope, err);
+            }
+        });
+        return err;
+    });
+};
+
 // Return a store for listing and deleting collections from a database
 uow.data.manageDatabase = function(args) {
     args = args || {};
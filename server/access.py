@@ -4,11 +4,19 @@ import hmac
 import hashlib
 from datetime import datetime, timedelta
 import tornado.web
+import tornado.gen
 from tornado.web import HTTPError
 import tornado.auth
 import pymongo
 import bson.json_util
 import mongo_util
+import cache_util
+import compress_util
+import metrics
+import profile_util
+import index_util
+import process_util
+import sanity
 import json
 import socket
 import struct
@@ -30,6 +38,7 @@ Delete = set('d')
 Override = set('O') # allow writing records owned by others
 
 OwnerKey = '_owner' # key in the schema to store the owner
+VersionKey = '_version' # key set to a new value by every write, for ETags
 
 modeSet = Create | Read | Update | Delete | Override
 collectionSet = Create | Read | Update | Delete | Override
@@ -39,6 +48,104 @@ KeyDuration = timedelta(1, 0) # one day
 
 AdminDbName = 'Admin'
 
+# role and permission lookups from the Admin db, shared by all handlers
+AdminCacheTTL = 60 # seconds
+RoleCache = cache_util.LRUCache(10000, AdminCacheTTL)
+PermissionCache = cache_util.LRUCache(10000, AdminCacheTTL)
+# compiled validators by (database, collection), None when there is no schema
+SchemaCache = cache_util.LRUCache(1000, AdminCacheTTL)
+# verified access keys by (key, user, database, collection) holding their expiry time
+KeyCache = cache_util.LRUCache(10000)
+# decoded user cookies by the raw cookie value
+UserCache = cache_util.LRUCache(10000, AdminCacheTTL)
+# mongo's plans for slow queries by collection and query shape, so each is explained once a minute
+ExplainCache = cache_util.LRUCache(1000, 60)
+
+def configureAdminCaches(ttl=None, size=None):
+    '''Set the expiry and size of the role, permission and schema caches'''
+    for cache in [ RoleCache, PermissionCache, SchemaCache, UserCache ]:
+        if ttl is not None:
+            cache.ttl = ttl
+        if size is not None:
+            cache.maxsize = size
+
+def invalidateAdminCaches(collection):
+    '''Forget cached lookups that depend on a changed Admin collection'''
+    if collection in [ 'Developers', 'AccessUsers', '*' ]:
+        RoleCache.invalidate()
+    if collection in [ 'AccessModes', '*' ]:
+        PermissionCache.invalidate()
+    if collection in [ 'Schemas', '*' ]:
+        SchemaCache.invalidate()
+
+def compileSchema(schema, cls=None):
+    '''Return a function that raises ValueError when an item does not match schema
+
+    cls is the validator class to use, by default the one for the schema's $schema.
+    '''
+    if isinstance(schema, basestring):
+        # the admin editor stores schemas as json text
+        schema = json.loads(schema)
+    validators = getattr(jsonschema, 'validators', None)
+    if validators is None:
+        # older jsonschema only offers the one-shot validate
+        def validate(item):
+            try:
+                jsonschema.validate(item, schema)
+            except jsonschema.ValidationError, e:
+                raise ValueError(e.message)
+        return validate
+    validator = (cls or validators.validator_for(schema))(schema)
+    def validate(item):
+        for error in validator.iter_errors(item):
+            raise ValueError(error.message)
+    return validate
+
+# top level schema keywords that can be checked a field at a time, and annotations
+FieldSchemaKeys = set(['type', 'properties', 'required', 'additionalProperties',
+                       '$schema', 'id', 'title', 'description', 'default'])
+
+def compileFieldSchemas(schema):
+    '''Return validators for the top level fields of an object schema
+
+    The result has the validators by field name, the set of required fields and
+    the rule for fields not listed, True for anything, False for nothing or a
+    validator. Returns None when fields can't be checked on their own.
+    '''
+    if isinstance(schema, basestring):
+        schema = json.loads(schema)
+    # any other rule, like dependencies, anyOf or maxProperties, relates fields to
+    # each other and references need the whole schema
+    if (set(schema) - FieldSchemaKeys or schema.get('type', 'object') != 'object' or
+            '"$ref"' in json.dumps(schema)):
+        return None
+    properties = schema.get('properties', {})
+    required = set(schema.get('required', [])
+                   if type(schema.get('required')) == list else [])
+    required.update(key for key, value in properties.iteritems()
+                    if value.get('required') is True)
+    # the fields are checked by the draft the whole schema names
+    validators = getattr(jsonschema, 'validators', None)
+    cls = validators and validators.validator_for(schema)
+    additional = schema.get('additionalProperties', True)
+    if type(additional) == dict:
+        additional = compileSchema(additional, cls)
+    return { 'properties': dict((key, compileSchema(value, cls))
+                                for key, value in properties.iteritems()),
+             'required': required,
+             'additional': additional }
+
+def compareDigest(a, b):
+    '''Compare signatures in time that does not depend on where they differ'''
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
 def matchIP(ip, pattern):
     if ip == pattern:
         return True
@@ -52,30 +159,154 @@ def matchIP(ip, pattern):
 
 class BaseHandler(mongo_util.MongoRequestHandler):
     '''Manage user cookie'''
+    # size of the response body for the metrics
+    responseBytes = 0
+    # (collection, findSpec, sortSpec) to explain in the slow log
+    slowQuery = None
+
+    def __init__(self, *args, **kwargs):
+        super(BaseHandler, self).__init__(*args, **kwargs)
+        self.spans = profile_util.Spans()
+        self.profiler = profile_util.sample()
+
+    def wrap_worker(self, worker):
+        '''Profile the workers of sampled requests'''
+        worker = super(BaseHandler, self).wrap_worker(worker)
+        if self.profiler is None:
+            return worker
+        # a profiler only follows the thread it runs on so each worker gets its own
+        return lambda *args, **kwargs: profile_util.runcall(worker, *args, **kwargs)
+
+    def profiled(self, fn, *args, **kwargs):
+        '''Call fn on the io loop under the profiler of a sampled request'''
+        if self.profiler is None:
+            return fn(*args, **kwargs)
+        return self.profiler.runcall(fn, *args, **kwargs)
+
+    def write(self, chunk):
+        '''Count the response body bytes as they are written'''
+        if isinstance(chunk, dict):
+            chunk = tornado.escape.json_encode(chunk)
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        chunk = tornado.escape.utf8(chunk)
+        self.responseBytes += len(chunk)
+        super(BaseHandler, self).write(chunk)
+
+    @tornado.gen.coroutine
+    def writeBody(self, s, variants=None):
+        '''Write a whole response body compressed if the client accepts it and it is big enough
+
+        variants is a dict of the body already compressed by encoding from a
+        cache entry. An encoding it is missing is added to it. Big bodies are
+        compressed in a worker thread.
+        '''
+        s = tornado.escape.utf8(s)
+        if compress_util.MinSize and len(s) >= compress_util.MinSize:
+            self.set_header('Vary', 'Accept-Encoding')
+            encoding = compress_util.negotiate(self.request.headers.get('Accept-Encoding', ''))
+            if encoding:
+                data = variants is not None and variants.get(encoding) or None
+                if data is None:
+                    if len(s) >= compress_util.ThreadSize:
+                        data = yield self.run_future(compress_util.compress, s, encoding)
+                    else:
+                        data = self.profiled(compress_util.compress, s, encoding)
+                    self.spans.mark('compress')
+                    if variants is not None:
+                        variants[encoding] = data
+                s = data
+                self.set_header('Content-Encoding', encoding)
+        self.set_header('Content-Length', len(s))
+        self.write(s)
+
+    def on_finish(self):
+        '''Record the request in the metrics'''
+        super(BaseHandler, self).on_finish()
+        handler = self.__class__.__name__
+        method = self.request.method
+        metrics.Requests.inc((handler, method, str(self.get_status())))
+        metrics.RequestSeconds.observe((handler, method), self.request.request_time())
+        metrics.ResponseBytes.observe((handler,), self.responseBytes)
+        if self.spans.names:
+            # the last stage of a handler that marks them is writing the response
+            self.spans.mark('write')
+        for stage, seconds in self.spans.items():
+            metrics.StageSeconds.observe((handler, stage), seconds)
+        if self.profiler is not None:
+            profile_util.collect(self.profiler)
+            self.profiler = None
+        if profile_util.is_slow(self.request.request_time()):
+            self.logSlow()
+
+    @tornado.gen.coroutine
+    def logSlow(self):
+        '''Log a slow request with its stages and, for a query, mongo's plan
+
+        Explaining runs the query again in a worker thread after the request
+        finished, once a minute for queries of the same shape. The query string
+        is left out of the log because it can hold access keys.
+        '''
+        message = '%s %s %d %dms %s' % (self.request.method, self.request.path, self.get_status(),
+                                        self.request.request_time() * 1000, self.spans)
+        if self.slowQuery is not None:
+            collection, findSpec, sortSpec = self.slowQuery
+            key = (collection.full_name, index_util.shape(findSpec, sortSpec))
+            plan = ExplainCache.get(key)
+            if plan is cache_util.Missing:
+                # others of the same shape log this while the explain runs
+                ExplainCache.set(key, 'explain running')
+                try:
+                    plan = yield self.run_future(self._explainWorker, collection, findSpec, sortSpec)
+                except Exception, e:
+                    plan = 'explain failed: %s' % e
+                ExplainCache.set(key, plan)
+            message += ' find=%s sort=%s plan=%s' % (json.dumps(findSpec, default=bson.json_util.default),
+                                                     json.dumps(sortSpec), json.dumps(plan))
+        profile_util.slow_log.warning(message)
+
+    def _explainWorker(self, collection, findSpec, sortSpec):
+        '''Get the summary of mongo's plan for a query in a thread'''
+        cursor = collection.find(findSpec)
+        if sortSpec:
+            cursor = cursor.sort(sortSpec)
+        return profile_util.explain_summary(cursor.explain())
+
     def get_current_user(self):
         if hasattr(self, 'user'):
             return self.user
 
-        user_json = self.get_secure_cookie("user")
-        if not user_json:
+        cookie = self.get_cookie("user")
+        result = cookie and UserCache.get(cookie)
+        if result is cache_util.Missing:
+            result = None
+            user_json = self.get_secure_cookie("user")
+            if user_json:
+                result = tornado.escape.json_decode(user_json)
+                if 'email' not in result:
+                    logging.warning('no email in user: %s' % repr(result))
+                    result['email'] = None
+                logging.debug('user: %s' % repr(result))
+                UserCache.set(cookie, result)
+        if not result:
             result = { 'email' : None }
-        else:
-            result = tornado.escape.json_decode(user_json)
-            if 'email' not in result:
-                logging.warning('no email in user: %s' % repr(result))
-                result['email'] = None
-        logging.debug('user: %s' % repr(result))
-        self.user = result
-        return result
+        self.user = dict(result)
+        return self.user
 
     def getUserId(self):
         if hasattr(self, 'user'):
             return self.user['email']
         return self.get_current_user()['email']
 
-    def isDeveloper(self, user=None, role=None):
+    def isDeveloper(self, user=None, role=None, cachedOnly=False):
         '''Return true for local developers'''
-        return self.getRole() in [ 'developer' ]
+        return self.getRole(cachedOnly=cachedOnly) in [ 'developer' ]
+
+    def isLocalOrDeveloper(self):
+        '''Return true for requests from this host or from developers
+
+        This may query the Admin db so call it from a worker thread.
+        '''
+        return bool(localIP.match(self.request.remote_ip)) or self.isDeveloper()
 
     def makeSignature(self, *args):
         self.require_setting("cookie_secret", "secure cookies")
@@ -84,7 +315,11 @@ class BaseHandler(mongo_util.MongoRequestHandler):
                              hashlib.sha1).hexdigest()
         return signature
 
-    def getRole(self, userId = None, db = None):
+    def getRole(self, userId = None, db = None, cachedOnly=False):
+        '''Return the role for a user, or None when cachedOnly and it is not cached
+
+        This may query the Admin db so call it from a worker thread.
+        '''
         if hasattr(self, 'role'):
             return self.role
 
@@ -95,6 +330,13 @@ class BaseHandler(mongo_util.MongoRequestHandler):
             self.role = 'anonymous'
             return 'anonymous'
 
+        role = RoleCache.get(userId)
+        if role is not cache_util.Missing:
+            self.role = role
+            return role
+        if cachedOnly:
+            return None
+
         # connect to the Admin db
         if db is None:
             db = self.mongo_conn[AdminDbName]
@@ -111,14 +353,33 @@ class BaseHandler(mongo_util.MongoRequestHandler):
                 role = info['role']
             else:
                 role = 'identified' # logged in but not specifically given a role
+        RoleCache.set(userId, role)
         self.role = role
         return role
 
+    def getPermission(self, role, dbName, collection, db=None):
+        '''Return the permission string stored for a role, db, collection triple or None'''
+        key = (role, dbName, collection)
+        permission = PermissionCache.get(key)
+        if permission is not cache_util.Missing:
+            return permission
+
+        if db is None:
+            db = self.mongo_conn[AdminDbName]
+        perms = db['AccessModes'].find_one( { 'role': role,
+                                              'database': dbName,
+                                              'collection': collection } )
+        permission = perms and perms['permission']
+        # remember misses too so unlisted collections don't query every time
+        PermissionCache.set(key, permission)
+        return permission
+
 
     def makeAccessKey(self, dbName, collection, modestring):
         '''Create an access key for a database/collection pair with the requested mode
 
         Note: We only lookup the user Role and Permissions here. Later we trust the key.
+        This may query the Admin db so call it from a worker thread.
         '''
         # get the user so we can check permissions
         userId = self.getUserId()
@@ -135,11 +396,7 @@ class BaseHandler(mongo_util.MongoRequestHandler):
         role = self.getRole(userId, db)
 
         # fetch permissions for this role
-        AccessModes = db['AccessModes']
-        # look for the role, db, collection triple
-        perms = AccessModes.find_one( { 'role': role,
-                                        'database': dbName,
-                                        'collection': collection } )
+        perms = self.getPermission(role, dbName, collection, db)
         if dbName == 'admin':
             permission = ''
 
@@ -155,8 +412,8 @@ class BaseHandler(mongo_util.MongoRequestHandler):
             else:
                 permission = ''
 
-        elif perms:
-            permission = perms['permission']
+        elif perms is not None:
+            permission = perms
 
         elif role in [ 'developer' ]:
             permission = requested_mode # developers get their wish
@@ -189,28 +446,125 @@ class BaseHandler(mongo_util.MongoRequestHandler):
             return False
         userId = self.getUserId()
 
-        if signature != self.makeSignature(db, collection, userId, modebits, timebits):
-            self.checkAccessKeyMessage = 'invalid signature'
-            return False
-        timebits = str(int(timebits, 16))
-        delay = datetime.now() - datetime.strptime(timebits, '%y%m%d%H%M%S')
-        if delay > KeyDuration:
-            self.checkAccessKeyMessage = 'key expired'
-            return False
+        # grids send the same key over and over so remember the ones already verified
+        cacheKey = (key, userId, db, collection)
+        expires = KeyCache.get(cacheKey)
+        if expires is not cache_util.Missing and datetime.now() > expires:
+            # let expired keys take the full check below to report it
+            KeyCache.pop(cacheKey)
+            expires = cache_util.Missing
+        if expires is cache_util.Missing:
+            if not compareDigest(signature,
+                                 self.makeSignature(db, collection, userId, modebits, timebits)):
+                self.checkAccessKeyMessage = 'invalid signature'
+                return False
+            timebits = str(int(timebits, 16))
+            expires = datetime.strptime(timebits, '%y%m%d%H%M%S') + KeyDuration
+            if datetime.now() > expires:
+                self.checkAccessKeyMessage = 'key expired'
+                return False
+            KeyCache.set(cacheKey, expires)
         self.allowedMode = set(modebits) & modeSet
         result = (self.allowedMode & mode)
         if not result:
             self.checkAccessKeyMessage = 'Mode not in allowed set'
         return result
 
-    def validateSchema(self, db, collection, item):
+    def getSchemaInfo(self, db, collection):
+        '''Return the Schemas registry entry for a collection or None
+
+        The entry carries the compiled validator when it has a schema.
+        This may query the Admin db so call it from a worker thread.
+        '''
+        key = (db, collection)
+        info = SchemaCache.get(key)
+        if info is not cache_util.Missing:
+            return info
+
         schemas = self.mongo_conn[AdminDbName]['Schemas']
         info = schemas.find_one({ 'database': db, 'collection': collection })
-        if not info:
+        if info and info.get('schema'):
+            info['validator'] = compileSchema(info['schema'])
+            info['fieldValidators'] = compileFieldSchemas(info['schema'])
+        SchemaCache.set(key, info)
+        return info
+
+    def getSchemaValidator(self, db, collection):
+        '''Return the compiled validator for a collection or None if it has no schema'''
+        info = self.getSchemaInfo(db, collection)
+        return info and info.get('validator') or None
+
+    def checkItems(self, db, collection, items, size=0, sanitize=True):
+        '''Validate and sanitize a list of items in place
+
+        Items with more than process_util.CheckThreshold bytes of json each are
+        checked in parallel in the process pool if there is one. Call it from a
+        worker thread.
+        '''
+        if process_util.use_pool(size):
+            info = self.getSchemaInfo(db, collection)
+            cleaned = process_util.check(items, info and info.get('schema'), sanitize)
+            for item, clean in zip(items, cleaned):
+                item.clear()
+                item.update(clean)
             return
+
+        for item in items:
+            self.validateSchema(db, collection, item)
+            if sanitize:
+                try:
+                    sanity.sanitize(item)
+                except ValueError:
+                    raise HTTPError(400, 'HTML field parse failed')
+
+    def validateChanges(self, db, collection, changes):
+        '''Validate just the changed top level fields of an item, None removes a field
+
+        Returns False when the schema can only check whole items.
+        '''
+        info = self.getSchemaInfo(db, collection)
+        if not info or not info.get('validator'):
+            return True
+        fields = info.get('fieldValidators')
+        if fields is None:
+            return False
         try:
-            schema = info['schema']
-            jsonschema.validate(item, schema)
+            for key, value in changes.iteritems():
+                if value is None:
+                    if key in fields['required']:
+                        raise ValueError('%s is required' % key)
+                    continue
+                validator = fields['properties'].get(key, fields['additional'])
+                if validator is False:
+                    raise ValueError('%s is not allowed' % key)
+                if validator is not True:
+                    validator(value)
+        except ValueError, e:
+            raise HTTPError(403, e.message)
+        return True
+
+    def getProjection(self, db, collection, fields, restrict):
+        '''Return the list of fields to fetch or None for whole documents
+
+        fields is the comma separated list the client asked for. Restricted
+        readers never get more than the restrictedFields listed in the registry.
+        '''
+        fields = fields and [ field for field in fields.split(',') if field ] or None
+        if restrict:
+            info = self.getSchemaInfo(db, collection)
+            allowed = info and info.get('restrictedFields')
+            if allowed:
+                allowed = [ field.strip() for field in allowed.split(',') if field.strip() ]
+                fields = [ field for field in fields or allowed if field in allowed ]
+                # an empty projection means everything to mongo
+                fields = fields or [ '_id' ]
+        return fields
+
+    def validateSchema(self, db, collection, item):
+        try:
+            validator = self.getSchemaValidator(db, collection)
+            if validator:
+                validator(item)
         except ValueError, e:
             raise HTTPError(403, e.message)
 
@@ -218,7 +572,8 @@ class BaseHandler(mongo_util.MongoRequestHandler):
         '''Override their error message to give developers more info'''
         description = httplib.responses[status_code]
         message = ''
-        if self.isDeveloper() and 'exception' in kwargs:
+        # don't block the IOLoop on the Admin db while reporting an error
+        if self.isDeveloper(cachedOnly=True) and 'exception' in kwargs:
             exc = kwargs['exception']
             if isinstance(exc, HTTPError):
                 message = exc.log_message
@@ -274,7 +629,7 @@ class AuthHandler(BaseHandler, tornado.auth.GoogleOAuth2Mixin):
 
         elif id == '/user':
             user = self.get_current_user()
-            user['role'] = self.getRole()
+            user['role'] = yield self.run_future(self.getRole)
             self.write(user)
             self.finish()
 
@@ -313,13 +668,16 @@ class AuthHandler(BaseHandler, tornado.auth.GoogleOAuth2Mixin):
                 response_type='code',
                 extra_params={'approval_prompt': 'auto'})
 
+    @tornado.gen.coroutine
     def post(self, id):
         '''Open a db/collection with requested permissions'''
         args = json.loads(self.request.body, object_hook=bson.json_util.object_hook)
         db = args['database']
         collection = args['collection']
         mode = args['mode']
-        key, mode = self.makeAccessKey(db, collection, mode)
+        # decode the cookie here rather than in the worker
+        self.getUserId()
+        key, mode = yield self.run_future(self.makeAccessKey, db, collection, mode)
         if collection == '*':
             url = '/data/%s-%s/' % (mode, db)
         else:
@@ -327,3 +685,42 @@ class AuthHandler(BaseHandler, tornado.auth.GoogleOAuth2Mixin):
         self.write({ 'url' : url,
                      'key' : key })
 
+
+def _benchmark(n=20000):
+    '''Measure the per request cost of decoding the user cookie and checking a key'''
+    import time
+    import tornado.httputil
+
+    class Connection(object):
+        def set_close_callback(self, callback):
+            pass
+
+    app = tornado.web.Application(cookie_secret='benchmark secret')
+    app.mongo_conn = None
+    cookie = tornado.web.create_signed_value(app.settings['cookie_secret'], 'user',
+                                             json.dumps({ 'email': 'someone@example.com' }))
+    request = tornado.httputil.HTTPServerRequest(method='GET', uri='/data/', connection=Connection())
+    request.headers['Cookie'] = 'user=' + cookie
+    handler = BaseHandler(app, request)
+    key, modebits = 'rc', '%x' % int(datetime.now().strftime('%y%m%d%H%M%S'))
+    key = '%s-%s-%s' % (key, modebits, handler.makeSignature('test', 'items',
+                        'someone@example.com', key, modebits))
+    request.headers['Authorization'] = key
+
+    def run(cached, check=True):
+        t0 = time.time()
+        for i in range(n):
+            if not cached:
+                KeyCache.invalidate()
+                UserCache.invalidate()
+            handler = BaseHandler(app, request)
+            if check:
+                assert handler.checkAccessKey('test', 'items', Read)
+        return 1e6 * (time.time() - t0) / n
+
+    setup = run(True, False)
+    print 'auth per request  uncached %.1fus  cached %.1fus' % (run(False) - setup,
+                                                               run(True) - setup)
+
+if __name__ == '__main__':
+    _benchmark()
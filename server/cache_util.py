@@ -0,0 +1,200 @@
+'''
+Small in-process caches for lookups that would otherwise go to mongo on every
+request.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import time
+import zlib
+import multiprocessing
+from threading import Lock
+from collections import OrderedDict
+
+# returned by get when the key is not present, so None can be cached
+Missing = object()
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe, least-recently-used cache with optional expiry.
+    Entries older than ttl seconds are treated as absent. Handlers and pool
+    workers share instances so every access takes the lock. With maxbytes
+    the sizes given to set are bounded too.
+
+    :ivar maxsize: maximum number of entries
+    :ivar maxbytes: maximum total size of the entries, None for no limit
+    :ivar ttl: seconds an entry stays valid, None for no expiry
+    :ivar hits: number of successful lookups
+    :ivar misses: number of failed or expired lookups
+    :ivar bytes: total size of the entries
+    '''
+    def __init__(self, maxsize=1000, ttl=None, maxbytes=None):
+        '''
+        :param maxsize: Maximum number of entries before the oldest is evicted
+        :type maxsize: int
+        :param ttl: Seconds before an entry expires or None
+        :type ttl: float
+        :param maxbytes: Maximum total size before the oldest is evicted or None
+        :type maxbytes: int
+        '''
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=Missing):
+        '''
+        Fetch a value and mark it most recently used.
+
+        :param key:
+        :param default: value returned when the key is absent or expired
+        '''
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            stamp, value, size = entry
+            if self.ttl is not None and time.time() - stamp > self.ttl:
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        '''
+        Store a value evicting the least recently used entries if full.
+
+        :param key:
+        :param value:
+        :param size: bytes to count against maxbytes
+        '''
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (time.time(), value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and
+                                                     self.bytes > self.maxbytes):
+                self.bytes -= self._data.popitem(last=False)[1][2]
+
+    def pop(self, key):
+        '''
+        Remove an entry if present.
+
+        :param key:
+        '''
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        '''Remove an entry holding the lock'''
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def invalidate(self, predicate=None):
+        '''
+        Remove every entry whose key satisfies predicate, or all entries.
+
+        :param predicate: function of the key or None to clear everything
+        '''
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                self.bytes = 0
+                return
+            for key in [ key for key in self._data if predicate(key) ]:
+                self._remove(key)
+
+    def stats(self):
+        '''
+        Report the size and hit counters.
+
+        :rtype: dict
+        '''
+        with self._lock:
+            return { 'size': len(self._data),
+                     'maxsize': self.maxsize,
+                     'bytes': self.bytes,
+                     'hits': self.hits,
+                     'misses': self.misses }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ChangeCounters(object):
+    '''
+    Counts the changes to each key, for telling whether anything changed
+    since a response was made. The counts live in memory shared with the
+    processes forked after this is made, so make it before forking. Keys
+    hash into a fixed number of slots and keys sharing a slot just see each
+    other's changes.
+
+    A version combines the count with the time the counters were made so
+    versions from before a restart never match.
+
+    :ivar slots: number of counters
+    '''
+    def __init__(self, slots=4096):
+        '''
+        :param slots: number of counters
+        :type slots: int
+        '''
+        self.slots = slots
+        self._counts = multiprocessing.RawArray('L', slots)
+        self._lock = multiprocessing.Lock()
+        self._epoch = '%x' % int(time.time() * 1000)
+
+    def _slot(self, key):
+        # handlers get unicode names from the path so u'a' and 'a' have to count together
+        if isinstance(key, tuple):
+            key = tuple(isinstance(part, unicode) and part.encode('utf-8') or part
+                        for part in key)
+        return zlib.crc32(repr(key)) % self.slots
+
+    def bump(self, key):
+        '''
+        Count a change to key and return the new count.
+
+        :param key: any key with a stable repr
+        :rtype: int
+        '''
+        slot = self._slot(key)
+        with self._lock:
+            self._counts[slot] += 1
+            return self._counts[slot]
+
+    def version(self, key):
+        '''
+        Report a string that differs after every change to key.
+
+        :param key: any key with a stable repr
+        :rtype: str
+        '''
+        return '%s.%x' % (self._epoch, self._counts[self._slot(key)])
+
+    def count(self, version):
+        '''
+        Report the count in a version, None if it didn't come from these counters.
+
+        :param version: from version()
+        :rtype: int
+        '''
+        epoch, dot, count = version.partition('.')
+        if epoch != self._epoch:
+            return None
+        try:
+            return int(count, 16)
+        except ValueError:
+            return None
@@ -0,0 +1,121 @@
+'''
+Content-Encoding for response bodies.
+
+The encoding is negotiated from Accept-Encoding, preferring brotli when the
+brotli module is installed, then gzip, then deflate. Small bodies aren't
+worth the time and are sent as they are. zlib and brotli release the GIL
+while they work so big bodies can be compressed in a worker thread.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import re
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this many bytes are sent as they are
+MinSize = 1024
+# bodies bigger than this many bytes are compressed in a worker thread
+ThreadSize = 64 * 1024
+# zlib compression level, lower is faster
+Level = 6
+# brotli quality, lower is faster
+BrotliQuality = 5
+
+# supported encodings in order of preference
+Encodings = (brotli and ['br'] or []) + ['gzip', 'deflate']
+# encodings that can compress a response a chunk at a time
+StreamEncodings = ['gzip', 'deflate']
+
+_wbits = { 'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS }
+
+
+def negotiate(accept, streaming=False):
+    '''
+    Returns the best encoding the client accepts or None for none.
+
+    :param accept: the Accept-Encoding header
+    :param streaming: true to choose only encodings that can be streamed
+    '''
+    weights = {}
+    for part in accept.split(','):
+        m = re.match(r'\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?', part)
+        if m:
+            try:
+                weights[m.group(1).lower()] = float(m.group(2) or 1)
+            except ValueError:
+                pass
+    best = None
+    for encoding in streaming and StreamEncodings or Encodings:
+        weight = weights.get(encoding, weights.get('*', 0))
+        if weight > 0 and (best is None or weight > best[0]):
+            best = (weight, encoding)
+    return best and best[1]
+
+
+def compress(data, encoding):
+    '''
+    Compresses a whole body.
+
+    :param data: str
+    :param encoding: one of Encodings
+    :rtype: str
+    '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=BrotliQuality)
+    compressor = zlib.compressobj(Level, zlib.DEFLATED, _wbits[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+class Stream(object):
+    '''
+    Compresses a body a chunk at a time, each one complete enough for the
+    client to decode it as it arrives.
+    '''
+    def __init__(self, encoding):
+        '''
+        :param encoding: one of StreamEncodings
+        '''
+        self._compressor = zlib.compressobj(Level, zlib.DEFLATED, _wbits[encoding])
+
+    def chunk(self, data):
+        '''
+        Compresses the next chunk.
+
+        :param data: str
+        :rtype: str
+        '''
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=''):
+        '''
+        Compresses the last chunk and ends the stream.
+
+        :param data: str
+        :rtype: str
+        '''
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+def _benchmark(nrows=1000):
+    '''Measure the compression of a grid page'''
+    import json
+    import time
+    rows = [ { '_id': '%024x' % i, 'label': 'item %d' % i, 'value': i * 7 % 100,
+               'letters': list('item%d' % i), '_owner': 'someone@example.com' }
+             for i in range(nrows) ]
+    data = json.dumps(rows)
+    for encoding in Encodings:
+        t0 = time.time()
+        for i in range(20):
+            out = compress(data, encoding)
+        print '%-8s %4.1fx %6.2f ms for %dKB' % (encoding, len(data) / float(len(out)),
+                                                 (time.time() - t0) / 20 * 1000,
+                                                 len(data) // 1024)
+
+if __name__ == '__main__':
+    _benchmark()
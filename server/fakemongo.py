@@ -0,0 +1,376 @@
+'''
+An in-memory stand-in for the parts of a pymongo.Connection the handlers use,
+so handler tests run without a mongod. Queries support the operators the
+handlers generate and every operation is recorded in the collection's ops.
+
+HandlerTestCase serves the jsonreststore routes from a fresh fake connection
+for each test.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import copy
+import json
+
+import tornado.ioloop
+import tornado.testing
+
+
+def _rank(value):
+    '''Rough bson type order, $gt and $lt only compare values of the same rank'''
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 1
+    if isinstance(value, basestring):
+        return 2
+    return 9
+
+# python types by bson $type code
+_types = { 1: (float,), 16: (int,), 18: (long,), 2: (basestring,), 3: (dict,), 4: (list,),
+           8: (bool,) }
+
+
+def match(doc, spec):
+    '''
+    Returns true if a document matches a query.
+
+    :param doc: dict
+    :param spec: mongo query
+    '''
+    for key, test in spec.iteritems():
+        if key == '$and':
+            if not all(match(doc, clause) for clause in test):
+                return False
+            continue
+        if key == '$or':
+            if not any(match(doc, clause) for clause in test):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(test, dict) and test and all(op.startswith('$') for op in test):
+            for op, arg in test.iteritems():
+                if op == '$in':
+                    ok = value in arg
+                elif op in ('$gt', '$lt'):
+                    ok = (value is not None and _rank(value) == _rank(arg) and
+                          (op == '$gt' and value > arg or op == '$lt' and value < arg))
+                elif op == '$gte':
+                    ok = value is not None and value >= arg
+                elif op == '$lte':
+                    ok = value is not None and value <= arg
+                elif op == '$type':
+                    ok = (value is not None and isinstance(value, _types.get(arg, ())) and
+                          not (arg in (1, 16, 18) and isinstance(value, bool)))
+                elif op == '$exists':
+                    ok = (key in doc) == arg
+                else:
+                    raise ValueError('unsupported operator %s' % op)
+                if not ok:
+                    return False
+        elif hasattr(test, 'search'):
+            if not isinstance(value, basestring) or not test.search(value):
+                return False
+        elif isinstance(value, list) and test is not None and not isinstance(test, list):
+            if test not in value:
+                return False
+        elif value != test:
+            return False
+    return True
+
+
+def project(doc, fields):
+    '''Returns a copy of a document with only the listed fields and _id'''
+    if fields is None:
+        return copy.deepcopy(doc)
+    if isinstance(fields, dict):
+        fields = [ key for key, value in fields.iteritems() if value ]
+    result = dict((key, copy.deepcopy(doc[key])) for key in fields if key in doc)
+    result['_id'] = doc['_id']
+    return result
+
+
+class Result(dict):
+    '''The result of a write'''
+
+
+class Cursor(object):
+    '''
+    The documents matching a query, selected when the first one is fetched.
+    '''
+    def __init__(self, collection, spec, fields):
+        self.collection = collection
+        self.spec = spec
+        self.fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._rows = None
+
+    def sort(self, sortSpec):
+        self._sort = sortSpec
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def _matching(self):
+        docs = [ doc for doc in self.collection.docs if match(doc, self.spec) ]
+        for key, direction in reversed(self._sort or []):
+            docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return docs
+
+    def count(self, with_limit_and_skip=False):
+        self.collection.ops.append('count')
+        return len(self._matching())
+
+    def explain(self):
+        return { 'cursor': 'BasicCursor', 'n': 1, 'nscanned': len(self.collection.docs),
+                 'millis': 0 }
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._rows is None:
+            self.collection.ops.append('find')
+            docs = self._matching()[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            self._rows = iter([ project(doc, self.fields) for doc in docs ])
+        return self._rows.next()
+
+    def close(self):
+        self._rows = iter([])
+
+
+class Bulk(object):
+    '''An ordered bulk operation applied when it is executed'''
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def insert(self, doc):
+        self.ops.append(('insert', doc))
+
+    def find(self, spec):
+        ops = self.ops
+        class Selected(object):
+            def replace_one(self, doc):
+                ops.append(('update', spec, doc))
+            def update_one(self, update):
+                ops.append(('update', spec, update))
+            def remove_one(self):
+                ops.append(('remove', spec))
+        return Selected()
+
+    def execute(self):
+        self.collection.ops.append('bulk')
+        result = { 'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0 }
+        for op in self.ops:
+            if op[0] == 'insert':
+                self.collection.insert(op[1])
+                result['nInserted'] += 1
+            elif op[0] == 'update':
+                n = self.collection.update(op[1], op[2])['n']
+                result['nMatched'] += n
+                result['nModified'] += n
+            else:
+                result['nRemoved'] += self.collection.remove(op[1], multi=False)['n']
+        return result
+
+
+class Collection(object):
+    '''
+    A list of documents.
+
+    :ivar docs: the documents
+    :ivar ops: names of the operations made, in order
+    :ivar bulk: false to act like a pymongo without bulk operations
+    '''
+    bulk = True
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self.docs = []
+        self.ops = []
+        self.indexes = { '_id_': { 'key': [ ('_id', 1) ] } }
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return Cursor(self, spec or {}, fields)
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        self.ops.append('find_one')
+        if spec is not None and not isinstance(spec, dict):
+            spec = { '_id': spec }
+        for doc in self.docs:
+            if match(doc, spec or {}):
+                return project(doc, fields)
+        return None
+
+    def insert(self, doc, safe=True, **kwargs):
+        self.ops.append('insert')
+        if isinstance(doc, list):
+            return [ self.insert(one) for one in doc ]
+        if [ old for old in self.docs if old['_id'] == doc['_id'] ]:
+            raise ValueError('duplicate key %s' % doc['_id'])
+        self.docs.append(copy.deepcopy(doc))
+        return doc['_id']
+
+    def _apply(self, i, update):
+        doc = self.docs[i]
+        if [ key for key in update if key.startswith('$') ]:
+            for key, value in update.get('$set', {}).iteritems():
+                doc[key] = copy.deepcopy(value)
+            for key in update.get('$unset', {}):
+                doc.pop(key, None)
+            for key, value in update.get('$inc', {}).iteritems():
+                doc[key] = doc.get(key, 0) + value
+        else:
+            replacement = copy.deepcopy(update)
+            replacement['_id'] = doc['_id']
+            self.docs[i] = replacement
+
+    def update(self, spec, update, upsert=False, safe=True, multi=False, **kwargs):
+        self.ops.append('update')
+        for i, doc in enumerate(self.docs):
+            if match(doc, spec):
+                self._apply(i, update)
+                return Result(n=1, updatedExisting=True)
+        return Result(n=0, updatedExisting=False)
+
+    def find_and_modify(self, query=None, update=None, new=False, fields=None, **kwargs):
+        self.ops.append('find_and_modify')
+        for i, doc in enumerate(self.docs):
+            if match(doc, query or {}):
+                old = copy.deepcopy(doc)
+                self._apply(i, update)
+                return project(new and self.docs[i] or old, fields)
+        return None
+
+    def remove(self, spec, safe=True, multi=True, **kwargs):
+        self.ops.append('remove')
+        n = 0
+        for doc in list(self.docs):
+            if match(doc, spec):
+                self.docs.remove(doc)
+                n += 1
+                if not multi:
+                    break
+        return Result(n=n)
+
+    def count(self):
+        return len(self.docs)
+
+    def __getattr__(self, name):
+        if name == 'initialize_ordered_bulk_op' and self.bulk:
+            return lambda: Bulk(self)
+        raise AttributeError(name)
+
+    def index_information(self):
+        return self.indexes
+
+    def ensure_index(self, keys, **kwargs):
+        name = '_'.join('%s_%s' % key for key in keys)
+        self.indexes[name] = { 'key': keys }
+        return name
+
+    create_index = ensure_index
+
+
+class Database(object):
+    '''Collections by name, made when first used'''
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection(self, name)
+        return self.collections[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+    def command(self, command, name=None, **kwargs):
+        if command == 'collstats':
+            return { 'count': len(self[name].docs) }
+        raise ValueError('unsupported command %s' % command)
+
+
+class Connection(object):
+    '''Databases by name, made when first used'''
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = Database(name)
+        return self.databases[name]
+
+    def end_request(self):
+        pass
+
+
+class HandlerTestCase(tornado.testing.AsyncHTTPTestCase):
+    '''
+    Serves the jsonreststore routes from a fake connection where anonymous
+    users have the permissions in modes.
+
+    :cvar modes: {collection: permission} in the test database
+    :ivar conn: the fake connection
+    '''
+    modes = { 'items': 'crudO' }
+
+    def get_app(self):
+        import access
+        import jsonreststore
+        import mongo_util
+        self.conn = Connection()
+        for collection, permission in self.modes.items():
+            self.conn['Admin']['AccessModes'].insert({ '_id': collection, 'role': 'anonymous',
+                                                       'database': 'test',
+                                                       'collection': collection,
+                                                       'permission': permission })
+        # the caches outlive the connection they were filled from
+        access.invalidateAdminCaches('*')
+        for cache in jsonreststore.MetricsHandler.caches.values():
+            cache.invalidate()
+        return mongo_util.MongoApplication(jsonreststore.ROUTES, cookie_secret='x' * 20,
+                                           thread_count=2, mongo_conn=self.conn,
+                                           google_oauth={})
+
+    def get_new_ioloop(self):
+        # the thread pool delivers results to the global loop
+        return tornado.ioloop.IOLoop.instance()
+
+    def key(self, collection='items', mode='crudO'):
+        '''Returns the url and access key for a collection in the test database'''
+        response = self.fetch('/data/_auth', method='POST',
+                              body=json.dumps({ 'database': 'test', 'collection': collection,
+                                                'mode': mode }))
+        info = json.loads(response.body)
+        return info['url'], info['key']
+
+    def request(self, url, key, method='GET', body=None, headers=None):
+        '''Fetch url with an access key'''
+        allHeaders = { 'Authorization': key }
+        allHeaders.update(headers or {})
+        return self.fetch(url, method=method, body=body, headers=allHeaders,
+                          allow_nonstandard_methods=True)
@@ -0,0 +1,130 @@
+'''
+Recent changes to each collection for clients that wait for them instead of
+polling their queries.
+
+Every write counts a change in the shared ChangeCounters and publishes the
+ids it touched here with the new count. A client holds the version of the
+counter it has seen and gets the ids changed since then. When a count in
+between isn't here, because another server process made the change or it
+is older than the events kept, the client is told to start over instead.
+
+Waiters are called on the thread that publishes, the io loop for the
+handlers.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+from collections import deque
+from threading import Lock
+
+# events kept per collection
+KeepEvents = 1000
+# longest a client waits for a change, seconds
+PollSeconds = 25
+# how often a waiting client checks for changes made by other processes, seconds
+CheckSeconds = 1
+
+
+class Feed(object):
+    '''
+    Recent change events by key with the callbacks waiting for them.
+
+    :ivar counters: the ChangeCounters the events are numbered by
+    :ivar keep: events kept per key
+    :ivar closed: true once the server is stopping and nobody should wait
+    '''
+    def __init__(self, counters, keep=KeepEvents):
+        '''
+        :param counters: ChangeCounters
+        :param keep: events kept per key
+        '''
+        self.counters = counters
+        self.keep = keep
+        self._events = {}
+        self._waiters = {}
+        self._lock = Lock()
+        self.closed = False
+
+    def publish(self, key, count, ids=None):
+        '''
+        Records a change and wakes the callbacks waiting on its key.
+
+        :param key: any key with a stable repr
+        :param count: the count from bumping the key's counter
+        :param ids: list of ids changed, None if anything may have changed
+        '''
+        with self._lock:
+            events = self._events.get(key)
+            if events is None:
+                events = self._events[key] = deque(maxlen=self.keep)
+            events.append((count, ids))
+            waiters = self._waiters.pop(key, [])
+        for callback in waiters:
+            callback()
+
+    def since(self, key, version):
+        '''
+        Returns (current version, ids changed after version). The ids are
+        None when they aren't all known and the client should start over.
+
+        :param key: any key with a stable repr
+        :param version: from an earlier call or the counters
+        '''
+        current = self.counters.version(key)
+        if version == current:
+            return current, []
+        seen = self.counters.count(version)
+        now = self.counters.count(current)
+        if seen is None or now is None or seen > now:
+            return current, None
+        counts = set()
+        ids = set()
+        with self._lock:
+            for count, changed in self._events.get(key, ()):
+                if seen < count <= now:
+                    if changed is None:
+                        return current, None
+                    counts.add(count)
+                    ids.update(changed)
+        if len(counts) != now - seen:
+            return current, None
+        return current, sorted(ids)
+
+    def wait(self, key, callback):
+        '''
+        Calls callback once, at the next change to key.
+
+        :param key: any key with a stable repr
+        :param callback: function of no arguments
+        '''
+        with self._lock:
+            self._waiters.setdefault(key, []).append(callback)
+
+    def unwait(self, key, callback):
+        '''
+        Forgets a callback that no longer needs calling.
+
+        :param key: any key with a stable repr
+        :param callback: as given to wait
+        '''
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters and callback in waiters:
+                waiters.remove(callback)
+                if not waiters:
+                    del self._waiters[key]
+
+    def waiting(self):
+        '''Returns the number of callbacks waiting'''
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def close(self):
+        '''Wakes every waiting callback and stops waits for the server to stop'''
+        with self._lock:
+            self.closed = True
+            waiters = [ callback for callbacks in self._waiters.values()
+                        for callback in callbacks ]
+            self._waiters.clear()
+        for callback in waiters:
+            callback()
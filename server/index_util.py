@@ -0,0 +1,280 @@
+'''
+Index advice from the queries the server actually sees.
+
+Each query is reduced to its shape: the fields it tests for equality, the
+fields it sorts on and the fields it tests with a range. The index that
+serves a shape best has the equality fields first, then the sort fields and
+then the range fields. Shapes are counted per collection and compared with
+the indexes that exist for the /data/_indexes report.
+
+Indexes declared in the Schemas entry for a collection are created in the
+background the first time the collection is queried. If the entry's
+autoIndex is on, the index for a shape seen AutoIndexQueries times is
+created too.
+
+Counts are per process so with several server processes each reports
+what it has seen.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+from threading import Lock, Thread
+from Queue import Queue
+import logging
+import pymongo
+
+# create the index for a shape after this many queries in an opted in collection
+AutoIndexQueries = 10
+# most auto indexes to create on one collection
+MaxAutoIndexes = 10
+# most shapes to count per collection
+MaxShapes = 100
+
+_lock = Lock()
+# {(db, collection): {shape: count}}
+_shapes = {}
+# index keys queued or built by this process
+_queued = set()
+# collections whose declared indexes were queued
+_declared = set()
+# auto indexes queued per collection
+_autoCount = {}
+_builds = Queue()
+_builder = None
+
+# operators that select a range of an index
+RangeOps = set(['$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists', '$regex', '$mod'])
+
+
+def shape(findSpec, sortSpec):
+    '''
+    Reduces a translated query and sort to the fields an index would need.
+    Returns (equality fields, sort, range fields) or None for a query that
+    no index would help.
+
+    :param findSpec: translated mongo query
+    :param sortSpec: list of (field, direction)
+    '''
+    equality = set()
+    ranges = set()
+    _fields(findSpec or {}, equality, ranges)
+    sort = tuple((field, direction) for field, direction in sortSpec or ()
+                 if field not in equality)
+    if not equality and not ranges and not sort:
+        return None
+    return (tuple(sorted(equality)), sort, tuple(sorted(ranges - equality)))
+
+
+def _fields(spec, equality, ranges):
+    '''Collect the fields a query tests into equality and ranges'''
+    for field, value in spec.iteritems():
+        if field == '$and':
+            for clause in value:
+                _fields(clause, equality, ranges)
+        elif field.startswith('$'):
+            # $or, $nor and $where need an index per clause or can't use one
+            continue
+        elif isinstance(value, dict) and value and all(key.startswith('$') for key in value):
+            if '$in' in value or '$all' in value:
+                equality.add(field)
+            elif RangeOps.intersection(value):
+                ranges.add(field)
+        elif hasattr(value, 'pattern'):
+            # only a case sensitive prefix match can use an index
+            if value.pattern.startswith('^') and not value.flags & 2:  # re.I
+                ranges.add(field)
+        else:
+            equality.add(field)
+
+
+def index_key(shape):
+    '''
+    Returns the index key that serves a shape as a list of (field, direction).
+
+    :param shape: from shape()
+    '''
+    equality, sort, ranges = shape
+    key = [ (field, pymongo.ASCENDING) for field in equality ]
+    key.extend(sort)
+    key.extend((field, pymongo.ASCENDING) for field in ranges if field not in dict(sort))
+    return key
+
+
+def covers(existing, shape):
+    '''
+    Returns true if an index with the existing key serves a shape.
+
+    :param existing: index key as a list of (field, direction)
+    :param shape: from shape()
+    '''
+    equality, sort, ranges = shape
+    if not _ordered(existing):
+        return False
+    n = len(equality)
+    if set(field for field, direction in existing[:n]) != set(equality):
+        return False
+    prefix = existing[n:n + len(sort)]
+    if sort and prefix != list(sort) and prefix != [ (field, -direction)
+                                                     for field, direction in sort ]:
+        return False
+    n += len(sort)
+    rest = [ field for field in ranges if field not in dict(sort) ]
+    return set(field for field, direction in existing[n:n + len(rest)]) == set(rest)
+
+
+def parse_indexes(text):
+    '''
+    Parses declared indexes, one per line or separated by semicolons, each a
+    comma separated list of fields with an optional + or - like ms.
+
+    :param text: like "+label,-value; word"
+    :rtype: list of index keys
+    '''
+    result = []
+    for line in (text or '').replace(';', '\n').splitlines():
+        key = []
+        for field in line.split(','):
+            field = field.strip()
+            if not field:
+                continue
+            direction = pymongo.ASCENDING
+            if field[0] in '+-':
+                direction = field[0] == '-' and pymongo.DESCENDING or pymongo.ASCENDING
+                field = field[1:].strip()
+            key.append((field, direction))
+        if key:
+            result.append(key)
+    return result
+
+
+def record(collection, db_name, collection_name, findSpec, sortSpec, info):
+    '''
+    Counts a query's shape and queues any index it or the collection's
+    Schemas entry calls for. Cheap enough to call on every query.
+
+    :param collection: the collection queried
+    :param db_name:
+    :param collection_name:
+    :param findSpec: translated mongo query
+    :param sortSpec: list of (field, direction)
+    :param info: Schemas entry for the collection or None
+    '''
+    name = (db_name, collection_name)
+    s = shape(findSpec, sortSpec)
+    with _lock:
+        builds = []
+        if info and info.get('indexes') and name not in _declared:
+            _declared.add(name)
+            builds.extend((key, 'declared') for key in parse_indexes(info['indexes']))
+        if s is not None:
+            counts = _shapes.setdefault(name, {})
+            if s in counts or len(counts) < MaxShapes:
+                counts[s] = count = counts.get(s, 0) + 1
+                if (count == AutoIndexQueries and info and info.get('autoIndex') == 'on' and
+                        _autoCount.get(name, 0) < MaxAutoIndexes):
+                    builds.append((index_key(s), 'auto'))
+        for key, reason in builds:
+            if (name, tuple(key)) in _queued:
+                continue
+            _queued.add((name, tuple(key)))
+            if reason == 'auto':
+                _autoCount[name] = _autoCount.get(name, 0) + 1
+            _start()
+            _builds.put((collection, name, key, reason))
+
+
+def forget(db_name=None, collection_name=None):
+    '''
+    Forgets which indexes were queued for a collection, or for all of them,
+    after it was dropped or the Schemas changed so they are checked again.
+
+    :param db_name:
+    :param collection_name:
+    '''
+    name = (db_name, collection_name)
+    with _lock:
+        for queued in [ queued for queued in _queued if db_name is None or queued[0] == name ]:
+            _queued.discard(queued)
+        if db_name is None:
+            _declared.clear()
+            _autoCount.clear()
+        else:
+            _declared.discard(name)
+            _autoCount.pop(name, None)
+
+
+def report(indexes_for, info_for, db_name=None):
+    '''
+    Returns the shapes seen per collection with the index each needs and the
+    existing index that serves it, if any. Call it from a worker thread.
+
+    :param indexes_for: function of (db, collection) returning its index_information
+    :param info_for: function of (db, collection) returning its Schemas entry
+    :param db_name: report only this database
+    :rtype: dict
+    '''
+    with _lock:
+        seen = dict((name, dict(counts)) for name, counts in _shapes.items()
+                    if db_name is None or name[0] == db_name)
+    result = {}
+    for name, counts in sorted(seen.items()):
+        indexes = indexes_for(*name)
+        info = info_for(*name) or {}
+        queries = []
+        for s, count in sorted(counts.items(), key=lambda item: -item[1]):
+            covering = [ index for index, spec in sorted(indexes.items())
+                         if covers(spec['key'], s) ]
+            queries.append({ 'equality': list(s[0]),
+                             'sort': [ list(field) for field in s[1] ],
+                             'range': list(s[2]),
+                             'count': count,
+                             'index': [ list(field) for field in index_key(s) ],
+                             'coveredBy': covering and covering[0] or None })
+        result['%s.%s' % name] = {
+            'autoIndex': info.get('autoIndex', 'off'),
+            'declared': [ [ list(field) for field in key ]
+                          for key in parse_indexes(info.get('indexes')) ],
+            'indexes': dict((index, [ list(field) for field in spec['key'] ])
+                            for index, spec in indexes.items()),
+            'missing': len([ query for query in queries if not query['coveredBy'] ]),
+            'queries': queries }
+    return result
+
+
+def _ordered(existing):
+    '''True if an index key is all ascending and descending fields
+
+    Text, geo and hashed indexes have names like "text" or "2dsphere" for
+    directions and don't serve the shapes counted here.
+    '''
+    return all(type(direction) in (int, long, float) and direction in (1, -1)
+               for field, direction in existing)
+
+
+def _startswith(existing, key):
+    '''True if an existing ordered index key begins with key'''
+    return _ordered(existing) and list(existing[:len(key)]) == key
+
+
+def _start():
+    '''Start the builder thread the first time it is needed'''
+    global _builder
+    if _builder is None:
+        _builder = Thread(target=_build, name='index builder')
+        _builder.daemon = True
+        _builder.start()
+
+
+def _build():
+    '''Create queued indexes one at a time in the background'''
+    while True:
+        collection, name, key, reason = _builds.get()
+        try:
+            existing = collection.index_information()
+            if any(_startswith(spec['key'], key) for spec in existing.values()):
+                continue
+            logging.warning('creating %s index %s on %s.%s' % (reason, key, name[0], name[1]))
+            collection.create_index(key, background=True)
+        except Exception, e:
+            # keep building the others whatever went wrong with this one
+            logging.warning('index %s on %s.%s failed: %s' % (key, name[0], name[1], e))
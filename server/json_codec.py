@@ -0,0 +1,214 @@
+'''
+JSON encoding and decoding for the rest store.
+
+Mongo won't store keys starting with $ so the "$ref" keys used by
+dojox.data.JsonRestStore are kept as "_ref" in the db. loads renames them in
+an object_hook while parsing and dumps renames them back before encoding, so
+only keys are touched, never text in string values. When the output shows
+a _ref key dumps encodes again from a copy of just the objects that hold one
+and the lists and objects containing them.
+
+The standard library json is used unless a faster backend (orjson or ujson)
+is chosen with setBackend. A backend is only accepted if it encodes and
+decodes the bson types the same way or refuses them with a TypeError so they
+fall back to the standard library.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import json
+import re
+from datetime import datetime
+import bson.json_util
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+RefKey = '$ref'
+StoredRefKey = '_ref'
+
+def _stdDumps(obj):
+    return json.dumps(obj, default=bson.json_util.default)
+
+def _stdHookLoads(s, object_hook):
+    return json.loads(s, object_hook=object_hook)
+
+def _orjsonDumps(obj):
+    return orjson.dumps(obj, default=bson.json_util.default).decode('utf8')
+
+def _ujsonDumps(obj):
+    return ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+
+# name: (dumps, loads, loads with an object_hook)
+Backends = { 'json': (_stdDumps, json.loads, _stdHookLoads) }
+if ujson:
+    Backends['ujson'] = (_ujsonDumps, ujson.loads,
+                         lambda s, object_hook: _walkHook(ujson.loads(s), object_hook))
+if orjson:
+    Backends['orjson'] = (_orjsonDumps, orjson.loads,
+                          lambda s, object_hook: _walkHook(orjson.loads(s), object_hook))
+
+def _roundTrips(name):
+    '''True if a backend encodes and decodes the bson types like the standard library'''
+    dumps, loads, hookLoads = Backends[name]
+    sample = { 'date': datetime(2010, 6, 1, 12, 30, 15),
+               'id': ObjectId('4c0a6e3b5e11c5a1b2000000'),
+               're': re.compile('^a', re.I), 'ref': { StoredRefKey: 'x' },
+               'text': u'caf\xe9 </script>', 'n': [ 1, 2.5, None, True ] }
+    expected = _stdDumps(sample)
+    try:
+        encoded = dumps(sample)
+    except (TypeError, OverflowError):
+        # refused, the standard library takes over
+        encoded = expected
+    try:
+        return (json.loads(encoded) == json.loads(expected) and
+                hookLoads(expected, _hideRef) == _stdHookLoads(expected, _hideRef))
+    except (TypeError, ValueError):
+        return False
+
+def setBackend(name):
+    '''Choose the json implementation by name, one of Backends
+
+    Raises ValueError for a backend that would change the bson types.
+    '''
+    global Backend, _dumps, _loads, _hookLoads
+    if name != 'json' and not _roundTrips(name):
+        raise ValueError('json backend %s changes the bson types' % name)
+    _dumps, _loads, _hookLoads = Backends[name]
+    Backend = name
+
+setBackend('json')
+
+def _walkHook(obj, object_hook):
+    '''Apply an object_hook bottom up for backends that don't take one'''
+    if type(obj) == dict:
+        for key, value in obj.iteritems():
+            if type(value) in (dict, list):
+                obj[key] = _walkHook(value, object_hook)
+        return object_hook(obj)
+    elif type(obj) == list:
+        for i, value in enumerate(obj):
+            if type(value) in (dict, list):
+                obj[i] = _walkHook(value, object_hook)
+    return obj
+
+def _renameRef(obj):
+    '''object_hook hiding $ref keys from mongo'''
+    if RefKey in obj:
+        obj[StoredRefKey] = obj.pop(RefKey)
+    return obj
+
+def _hideRef(obj):
+    '''object_hook renaming $ref before bson gets a chance to treat it as a DBRef'''
+    if RefKey in obj:
+        obj[StoredRefKey] = obj.pop(RefKey)
+    return bson.json_util.object_hook(obj)
+
+def _encode(obj):
+    try:
+        return _dumps(obj)
+    except (TypeError, OverflowError):
+        # bson types the fast backends don't know
+        return _stdDumps(obj)
+
+def _showRefs(obj):
+    '''Return obj with _ref keys renamed $ref, copying only what has to change'''
+    if type(obj) == dict:
+        result = obj
+        for key, value in obj.iteritems():
+            if type(value) in (dict, list):
+                shown = _showRefs(value)
+                if shown is not value:
+                    if result is obj:
+                        result = dict(obj)
+                    result[key] = shown
+        if StoredRefKey in obj:
+            if result is obj:
+                result = dict(obj)
+            result[RefKey] = result.pop(StoredRefKey)
+        return result
+    elif type(obj) == list:
+        result = obj
+        for i, value in enumerate(obj):
+            if type(value) in (dict, list):
+                shown = _showRefs(value)
+                if shown is not value:
+                    if result is obj:
+                        result = list(obj)
+                    result[i] = shown
+        return result
+    return obj
+
+def dumps(obj):
+    '''Encode an object from mongo for the client, restoring $ref keys'''
+    s = _encode(obj)
+    # the encoders escape quotes inside strings so this only finds _ref keys, usually
+    # there are none and nothing needs walking
+    if '"%s":' % StoredRefKey in s:
+        s = _encode(_showRefs(obj))
+    return s
+
+def loads(s):
+    '''Decode a request body for mongo, hiding $ref keys'''
+    special = s.count('"$')
+    if not special:
+        # no $ref or bson extended json keys so there is nothing for a hook to do
+        return _loads(s)
+    if special == s.count('"%s"' % RefKey):
+        # only $ref keys so skip the bson hook
+        return _hookLoads(s, _renameRef)
+    return _hookLoads(s, _hideRef)
+
+def _benchmark():
+    '''Compare against rewriting the whole text with str.replace for a 1MB payload'''
+    import time
+    import random
+    random.seed(1)
+    words = [ ''.join(random.sample('abcdefghijklmnopqrstuvwxyz', 8)) for i in range(200) ]
+    docs = [ { '_id': '%024x' % i,
+               'label': ' '.join(random.sample(words, 5)),
+               'value': i * 1.1,
+               'tags': random.sample(words, 3),
+               'bodyHTML': '<p>%s</p>' % ' '.join(random.sample(words, 40)) }
+             for i in range(1800) ]
+    withRefs = [ dict(doc, parent={ StoredRefKey: '%024x' % (i // 10) })
+                 for i, doc in enumerate(docs) ]
+
+    def oldDumps(obj):
+        s = json.dumps(obj, default=bson.json_util.default)
+        return s.replace('"_ref":', '"$ref":')
+
+    def oldLoads(s):
+        s = s.replace('"$ref":', '"_ref":')
+        return json.loads(s, object_hook=bson.json_util.object_hook)
+
+    def timeit(fn, arg, n=10):
+        t0 = time.time()
+        for i in range(n):
+            fn(arg)
+        return 1000 * (time.time() - t0) / n
+
+    print 'backend %s' % Backend
+    for name, payload in [ ('no refs', docs), ('with refs', withRefs) ]:
+        text = dumps(payload)
+        assert oldLoads(oldDumps(payload)) == loads(text)
+        print '%s: %d bytes' % (name, len(text))
+        print '  encode  replace %6.1fms  codec %6.1fms' % (timeit(oldDumps, payload),
+                                                          timeit(dumps, payload))
+        print '  decode  replace %6.1fms  codec %6.1fms' % (timeit(oldLoads, text),
+                                                          timeit(loads, text))
+        # replace always builds a second full size string, the codec only when there are refs
+        print '  extra bytes per encode  replace %d  codec %d' % (
+            len(text), payload is withRefs and len(text) or 0)
+        print '  extra bytes per decode  replace %d  codec 0' % len(text)
+
+if __name__ == '__main__':
+    _benchmark()
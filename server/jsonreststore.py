@@ -7,9 +7,16 @@ A Mongo-based server for use with dojox.data.JsonRestStore.
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.escape
+import tornado.concurrent
+import tornado.netutil
 from tornado.web import HTTPError
 import pymongo
+import bson.binary
 import bson.json_util
+import bson.objectid
+import bson.timestamp
 try:
     import pymongo.objectid
 except ImportError:
@@ -17,21 +24,66 @@ except ImportError:
 import mongo_util
 import os
 import json
+import base64
+import hashlib
 import re
 import string
 import random
 import urllib
+import httplib
 import optparse
+import signal
 import logging
 import time
+import traceback
+from datetime import datetime, timedelta
 
 import access
+import cache_util
+import compress_util
+import feed_util
+import index_util
+import json_codec
+import metrics
 import myLogging
+import profile_util
+import process_util
+import sanity
 from sanity import sanitize
 
 JSRE = re.compile(r'^/(.*)/([igm]*)$')
 DojoGlob = re.compile(r'[?*]')
 CheckSanity = True
+# results with more items than this are streamed in chunks of this size, 0 to disable
+StreamChunkSize = 1000
+# how paged queries fill the Content-Range total
+#   exact: count the query every time
+#   cached: reuse counts per collection and query for CountCacheTTL seconds
+#   estimate: like cached but use the collection stats for empty queries
+CountModes = ('exact', 'cached', 'estimate')
+CountMode = 'exact'
+CountCacheTTL = 10
+CountCache = cache_util.LRUCache(10000, CountCacheTTL)
+# most operations accepted in one bulk request
+BulkLimit = 1000
+# most queries accepted in one batch request
+BatchLimit = 20
+# most items returned for each query of a batch, they are held in memory until sent
+BatchCount = 100
+# most seconds to wait for requests in flight on SIGTERM
+DrainSeconds = 10
+# translated queries by their raw mq parameter
+QueryCache = cache_util.LRUCache(1000)
+# answer gets with ETags and If-None-Match with 304, assumes this server makes every change
+ETags = True
+# change counts by collection for ETags, made before forking so server processes share them
+Changes = cache_util.ChangeCounters()
+# encoded query results for collections with resultCache on in Schemas, keyed with the
+# collection's change count so results from before a change are never used
+ResultCacheMB = 64
+ResultCache = cache_util.LRUCache(10000, maxbytes=ResultCacheMB * 1024 * 1024)
+# recent changed ids by collection for clients waiting on _changes
+Feed = feed_util.Feed(Changes)
 
 
 def TranslateQuery(obj):
@@ -54,8 +106,9 @@ def TranslateQuery(obj):
         if m:
             flags = 0
             for letter in m.group(2):
+                # python has no global flag, every match is global to mongo anyway
                 flags |= {'m': re.M,
-                          'g': re.G,
+                          'g': 0,
                           'i': re.I}[letter]
             try:
                 obj = re.compile(m.group(1), flags)
@@ -65,11 +118,15 @@ def TranslateQuery(obj):
         # check for globbing in the string
         elif DojoGlob.search(obj):
             # protect python re special characters
-            q = re.sub(r'([][.+(){}|^\\])', r'\\\1', obj)
+            q = re.sub(r'([][.+(){}|^$\\])', r'\\\1', obj)
             # convert * to .* and ? to .?
             q = re.sub(r'([*?])', r'.\1', q)
             # anchor it
             q = '^' + q + '$'
+            # a trailing .*$ matches anything so drop it, leaving a plain prefix like ^abc
+            # that mongo can answer from an index
+            if q.endswith('.*$'):
+                q = q[:-3]
             # try to compile it
             try:
                 obj = re.compile(q)
@@ -82,6 +139,204 @@ def TranslateQuery(obj):
         return obj
 
 
+def CopyQuery(obj):
+    '''Copy the dicts and lists of a translated query, sharing the compiled patterns'''
+    if type(obj) == dict:
+        return dict((key, CopyQuery(val)) for key, val in obj.iteritems())
+    elif type(obj) == list:
+        return [CopyQuery(val) for val in obj]
+    return obj
+
+
+def ParseQuery(q):
+    '''Translate a raw mq parameter into a mongo query, caching the translation'''
+    spec = QueryCache.get(q)
+    if spec is cache_util.Missing:
+        # the query is json encoded and then url quoted
+        try:
+            spec = json.loads(urllib.unquote(q))
+        except ValueError, e:
+            raise HTTPError(400, unicode(e))
+        # convert to format expected by mongo
+        spec = TranslateQuery(spec)
+        QueryCache.set(q, spec)
+    # callers may change the query so never hand out the cached one
+    return CopyQuery(spec)
+
+
+def collectionChanged(db_name, collection_name, ids=None):
+    '''Forget anything cached about a collection after it is written
+
+    ids lists the items written for the clients waiting on changes, None when
+    the whole collection may have changed.
+    '''
+    Feed.publish((db_name, collection_name), Changes.bump((db_name, collection_name)), ids)
+    ResultCache.invalidate(lambda key: key[:2] == (db_name, collection_name))
+    if db_name == access.AdminDbName:
+        access.invalidateAdminCaches(collection_name)
+        if collection_name == 'Schemas':
+            # declared indexes, restricted fields and result caching may have changed
+            index_util.forget()
+            ResultCache.invalidate()
+    CountCache.invalidate(lambda key: key[:2] == (db_name, collection_name))
+
+
+def ChangingWorker(worker, db_name, collection_name, ids=None):
+    '''Wrap a worker that writes a collection to count the change from its thread
+
+    The request can stop waiting for a worker that goes on to write, when the
+    client goes away or the task times out, so the change is counted when the
+    worker finishes whatever happens to the request. The io loop runs it before
+    the worker's result is delivered. An HTTPError means the write was refused
+    and nothing changed, except a 409 for a conflict found after part of the
+    write was made. That and any other error may come after part of the write
+    reached mongo so it counts as a change to the ids or, when ids is a
+    function of the worker's result, the whole collection.
+    '''
+    io_loop = tornado.ioloop.IOLoop.instance()
+    def _worker(*args, **kwargs):
+        written = True
+        changed = not callable(ids) and ids or None
+        try:
+            result = worker(*args, **kwargs)
+            if callable(ids):
+                changed = ids(result)
+            return result
+        except HTTPError, e:
+            written = e.status_code == 409
+            raise
+        finally:
+            if written:
+                io_loop.add_callback(collectionChanged, db_name, collection_name, changed)
+    return _worker
+
+
+def getField(item, field):
+    '''Get a possibly dotted field from a document'''
+    for part in field.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(part)
+    return item
+
+
+# bson $type codes in the order mongo sorts values, null standing for null and missing
+BsonTypeOrder = [[None], [1, 16, 18], [2, 14], [3], [4], [5], [7], [8], [9], [17], [11]]
+
+
+def BsonTypeRank(value):
+    '''Position of a decoded value's type in BsonTypeOrder'''
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, (int, long, float)):
+        return 1
+    if isinstance(value, bson.binary.Binary):
+        return 5
+    if isinstance(value, basestring):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    if isinstance(value, bson.objectid.ObjectId):
+        return 6
+    if isinstance(value, datetime):
+        return 8
+    if isinstance(value, bson.timestamp.Timestamp):
+        return 9
+    return 10 # regular expression
+
+
+def KeysetQuery(sortSpec, values):
+    '''Build a query for the documents that sort after the given sort key values
+
+    $gt and $lt only compare values of the same type so documents with a
+    different type, or null or missing, that sort after a value are selected
+    by type.
+    '''
+    clauses = []
+    for i, (field, direction) in enumerate(sortSpec):
+        prefix = dict(zip([f for f, d in sortSpec[:i]], values[:i]))
+        rank = BsonTypeRank(values[i])
+        if values[i] is not None:
+            clause = dict(prefix)
+            clause[field] = {direction == pymongo.ASCENDING and '$gt' or '$lt': values[i]}
+            clauses.append(clause)
+        later = direction == pymongo.ASCENDING and BsonTypeOrder[rank + 1:] or BsonTypeOrder[:rank]
+        for codes in later:
+            for code in codes:
+                clause = dict(prefix)
+                if code is None:
+                    clause[field] = None
+                else:
+                    clause[field] = {'$type': code}
+                clauses.append(clause)
+    if not clauses:
+        # nothing sorts after the last of everything
+        return {'_id': {'$in': []}}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
+
+
+def ETagHash(*parts):
+    '''Short hash of the request parts that select a response'''
+    return hashlib.sha1(repr(parts)).hexdigest()[:16]
+
+
+def RequestETags(request):
+    '''Get the entity tags in If-None-Match without quotes or W/'''
+    return re.findall(r'(?:W/)?"([^"]*)"', request.headers.get('If-None-Match', ''))
+
+
+def CheckPatch(changes):
+    '''Raise an error unless changes is an object of plain top level fields
+
+    The meta items are dropped since clients can't change them.
+    '''
+    if type(changes) != dict:
+        raise HTTPError(400, 'expected an object')
+    changes.pop('_id', '')
+    changes.pop(access.OwnerKey, '')
+    changes.pop(access.VersionKey, '')
+    for key in changes:
+        if key.startswith('$') or '.' in key:
+            raise HTTPError(400, 'bad field name %s' % key)
+
+
+def PatchUpdate(changes, version=None):
+    '''Turn changed fields into a mongo update, None values remove the field
+
+    A change also sets the item's version when one is given.
+    '''
+    update = {}
+    sets = dict((key, value) for key, value in changes.iteritems() if value is not None)
+    unsets = dict((key, 1) for key, value in changes.iteritems() if value is None)
+    if sets:
+        update['$set'] = sets
+    if unsets:
+        update['$unset'] = unsets
+    if update and version:
+        update.setdefault('$set', {})[access.VersionKey] = version
+    return update
+
+
+def PatchedItem(item, changes):
+    '''Return a copy of item with the changes applied, for validating whole items'''
+    item = dict(item or {})
+    for key, value in changes.iteritems():
+        if value is None:
+            item.pop(key, None)
+        else:
+            item[key] = value
+    item.pop('_id', '')
+    item.pop(access.OwnerKey, '')
+    item.pop(access.VersionKey, '')
+    return item
+
+
 def RestrictQuery(query):
     restricted = {}
     for key, value in query.iteritems():
@@ -109,6 +364,7 @@ def doQuery(item, spec):
 
 # handle requests with only a db name
 class DatabaseHandler(access.BaseHandler):
+    @tornado.gen.coroutine
     def get(self, mode, db_name, collection_name):
         '''Handle queries for collection names'''
         if collection_name:
@@ -117,7 +373,7 @@ class DatabaseHandler(access.BaseHandler):
         if not self.checkAccessKey(db_name, '*', access.Read):
             raise HTTPError(403, 'listing not permitted (%s)' % self.checkAccessKeyMessage)
         db = self.mongo_conn[db_name]
-        names = db.collection_names()
+        names = yield self.run_future(db.collection_names)
         result = [{"_id": name}
                    for name in names
                    if name != 'system.indexes']
@@ -125,16 +381,7 @@ class DatabaseHandler(access.BaseHandler):
         # handle query parameters
         spec = {}
         if 'mq' in self.request.arguments:
-            q = self.request.arguments['mq'][0]
-            # remove url quoting
-            q = urllib.unquote(q)
-            # convert from json
-            try:
-                q = json.loads(q)
-            except ValueError, e:
-                raise HTTPError(400, unicode(e))
-            # convert to format expected by mongo
-            spec = TranslateQuery(q)
+            spec = ParseQuery(self.request.arguments['mq'][0])
 
         # simulate what mongo would do to select the names...
         result = [item for item in result if doQuery(item, spec)]
@@ -152,47 +399,42 @@ class DatabaseHandler(access.BaseHandler):
 
         # send the result
         self.set_header('Content-Range', 'items %d-%d/%d' % (start, stop, Nitems))
-        s = json.dumps(result, default=bson.json_util.default)
-        s = s.replace('"_ref":', '"$ref":')  # restore $ref
-        self.set_header('Content-Length', len(s))
+        s = json_codec.dumps(result)
         self.set_header('Content-Type', 'text/javascript')
-        self.write(s)
+        yield self.writeBody(s)
 
+    @tornado.gen.coroutine
     def delete(self, mode, db_name, collection_name):
         '''Drop the collection'''
         if not self.checkAccessKey(db_name, '*', access.Delete):
             raise HTTPError(403, 'drop collection not permitted (%s)' % self.checkAccessKeyMessage)
-        self.mongo_conn[db_name].drop_collection(collection_name)
+        yield self.run_future(ChangingWorker(self.mongo_conn[db_name].drop_collection,
+                                             db_name, collection_name), collection_name)
+        # the indexes went with it
+        index_util.forget(db_name, collection_name)
 
 
 # handle requests without an id
 class CollectionHandler(access.BaseHandler):
-    @tornado.web.asynchronous
+    # where to cache the result when the collection caches results
+    resultCacheKey = None
+
+    @tornado.gen.coroutine
     def get(self, mode, db_name, collection_name):
         '''Handle queries'''
         readMode = self.checkAccessKey(db_name, collection_name, access.Read)
         restrict = readMode == access.RestrictedRead
         if not readMode:
             raise HTTPError(403, 'read not permitted (%s)' % self.checkAccessKeyMessage)
+        self.spans.mark('auth')
 
         collection = self.mongo_conn[db_name][collection_name]
 
         # check for a query
         findSpec = {}
         if 'mq' in self.request.arguments:
-            q = self.request.arguments['mq'][0]
-            # pass an arbitrary query into mongo, the query is json encoded and
-            # then url quoted
-
-            # remove url quoting
-            q = urllib.unquote(q)
-            # convert from json
-            try:
-                q = json.loads(q)
-            except ValueError, e:
-                raise HTTPError(400, unicode(e))
-            # convert to format expected by mongo
-            findSpec = TranslateQuery(q)
+            # pass an arbitrary query into mongo
+            findSpec = ParseQuery(self.request.arguments['mq'][0])
             if restrict:
                 findSpec = RestrictQuery(findSpec)
 
@@ -211,44 +453,254 @@ class CollectionHandler(access.BaseHandler):
             start = 0
             stop = None
 
-        # hand off to the worker thread to do the possibly slow db access
-        self.run_async(self._callback, self._worker, collection, findSpec, sortSpec, start, stop,
-                       restrict)
+        # check for a list of fields to return
+        fields = self.request.arguments.get('mf', [None])[0]
+
+        # a count made before a write finishes is kept under the version it was asked at
+        countKey = (db_name, collection_name, self.request.arguments.get('mq', [''])[0], restrict,
+                    Changes.version((db_name, collection_name)))
+
+        # keyset paging continues after the last row of the previous page instead of skipping
+        rangeKey = self.request.headers.get('X-Range-Key', None)
+        if (restrict or stop is None or
+                StreamChunkSize and stop - start + 1 > StreamChunkSize):
+            rangeKey = None
+        keyset = None
+        if rangeKey:
+            # the order must be total for the next page to start in the right place
+            if '_id' not in [field for field, direction in sortSpec]:
+                sortSpec.append(('_id', pymongo.ASCENDING))
+            keyset = self.parseRangeKey(rangeKey, db_name, collection_name, start, sortSpec)
+        self.spans.mark('translate')
+        self.slowQuery = (collection, findSpec, sortSpec)
+
+        # the same request gets the same response until the collection changes
+        if ETags:
+            args = self.request.arguments
+            etag = '%s:q%s' % (Changes.version((db_name, collection_name)),
+                               ETagHash(args.get('mq'), args.get('ms'), fields, start, stop,
+                                        rangeKey, restrict, restrict and
+                                        Changes.version((access.AdminDbName, 'Schemas'))))
+            # weak since the body differs with its Content-Encoding
+            self.set_header('Etag', 'W/"%s"' % etag)
+            if etag in RequestETags(self.request):
+                self.set_status(304)
+                return
+
+        # the same query gets the same result until the collection changes
+        cacheKey = None
+        if ResultCache.maxbytes and not (StreamChunkSize and (stop is None or
+                                                             stop - start + 1 > StreamChunkSize)):
+            args = self.request.arguments
+            # restricted fields come from the Schemas registry
+            cacheKey = (db_name, collection_name, Changes.version((db_name, collection_name)),
+                        Changes.version((access.AdminDbName, 'Schemas')),
+                        args.get('mq', [''])[0], args.get('ms', [''])[0], fields, start, stop,
+                        restrict, repr(keyset))
 
-    def _worker(self, collection, findSpec, sortSpec, start, stop, restrict):
-        '''Do just the db query in a thread, the hand off to the callback to write the results'''
-        cursor = collection.find(findSpec)
+        # hand off to the worker thread to do the possibly slow db access
+        result = yield self.run_future(self._worker, collection, findSpec, sortSpec, start, stop,
+                                       restrict, countKey, keyset, fields, cacheKey)
+        rows, start, stop, Nitems = result[:4]
+        variants = None
+        if isinstance(rows, basestring):
+            # a cached result is already encoded and maybe compressed
+            s, last, variants = rows, result[4], result[5]
+        elif isinstance(rows, list):
+            s = tornado.escape.utf8(self.profiled(json_codec.dumps, rows))
+            self.spans.mark('encode')
+            last = rows and rows[-1] or None
+            cacheKey = self.resultCacheKey
+            if cacheKey is not None:
+                variants = {}
+                ResultCache.set(cacheKey, (s, start, stop, Nitems, last, variants), len(s))
+        else:
+            yield self._stream(result)
+            return
+        if rangeKey and last:
+            self.set_header('X-Range-Key', self.makeRangeKey(db_name, collection_name,
+                                                             stop + 1, sortSpec, last))
+        compressed = variants is not None and len(variants)
+        yield self._callback(s, start, stop, Nitems, variants)
+        if variants is not None and len(variants) > compressed:
+            # keep the newly compressed body with the cached result
+            ResultCache.set(cacheKey, (s, start, stop, Nitems, last, variants),
+                            len(s) + sum(len(data) for data in variants.values()))
+
+    def _rangeKeySignature(self, db_name, collection_name, payload):
+        '''Sign a range key for this user, collection, query and sort'''
+        args = self.request.arguments
+        return self.makeSignature(db_name, collection_name, self.getUserId(),
+                                  args.get('mq', [''])[0], args.get('ms', [''])[0], payload)
+
+    def makeRangeKey(self, db_name, collection_name, position, sortSpec, row):
+        '''Make the opaque key a client sends back to continue from position'''
+        values = [getField(row, field) for field, direction in sortSpec]
+        payload = base64.urlsafe_b64encode(json_codec.dumps([position, values]))
+        return '%s.%s' % (payload, self._rangeKeySignature(db_name, collection_name, payload))
+
+    def parseRangeKey(self, rangeKey, db_name, collection_name, start, sortSpec):
+        '''Return the query for the page after a valid range key or None to skip instead'''
+        try:
+            payload, signature = rangeKey.split('.')
+            if signature != self._rangeKeySignature(db_name, collection_name, payload):
+                return None
+            position, values = json_codec.loads(base64.urlsafe_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+        if position != start or len(values) != len(sortSpec):
+            return None
+        return KeysetQuery(sortSpec, values)
+
+    def _worker(self, collection, findSpec, sortSpec, start, stop, restrict, countKey,
+                keyset=None, fields=None, cacheKey=None, spans=None):
+        '''Do just the db query in a thread, the hand off to the callback to write the results
+
+        Large results come back as an open cursor to be streamed instead of a list of rows.
+        A keyset query selects the rows after the previous page instead of skipping to start.
+        A result cached under cacheKey comes back already encoded with its last row.
+        The stages are timed in spans, the request's by default.
+        '''
+        spans = spans or self.spans
+        spans.mark('wait')
+        db_name, collection_name = countKey[:2]
+        info = self.getSchemaInfo(db_name, collection_name)
+        index_util.record(collection, db_name, collection_name, findSpec, sortSpec, info)
+        if cacheKey is not None and info and info.get('resultCache') == 'on':
+            cached = ResultCache.get(cacheKey)
+            if cached is not cache_util.Missing:
+                spans.mark('cache')
+                return cached
+            self.resultCacheKey = cacheKey
+        fields = self.getProjection(db_name, collection_name, fields, restrict)
+        if fields is not None:
+            # the sort values are needed to make the key for the next page
+            fields = fields + [ field for field, direction in sortSpec if field not in fields ]
+        cursor = collection.find(findSpec, fields=fields)
         if sortSpec:
             cursor = cursor.sort(sortSpec)
-        Nitems = cursor.count()
-        if stop is None:
-            stop = Nitems - 1
+        spans.mark('find')
+
+        # only small ranged pages can use an inexact count because their total can be
+        # corrected from the rows actually fetched, the rest need it up front
+        exact = (CountMode == 'exact' or restrict or stop is None or
+                 StreamChunkSize and stop - start + 1 > StreamChunkSize)
+        if exact:
+            Nitems = cursor.count()
+            if stop is None:
+                stop = Nitems - 1
+            else:
+                stop = min(stop, Nitems - 1)
         else:
-            stop = min(stop, Nitems - 1)
-        cursor = cursor.skip(start).limit(stop - start + 1)
+            Nitems = self._count(collection, cursor, findSpec, countKey)
+        spans.mark('count')
 
-        if restrict and Nitems > 1:
+        if stop < start:
+            # nothing to fetch, a limit of 0 would mean no limit
+            rows = []
+        elif restrict and Nitems > 1:
             rows = []
             start = 0
             stop = 0
             Nitems = 0
         else:
-            rows = list(cursor)
+            if keyset:
+                cursor = collection.find(findSpec and {'$and': [findSpec, keyset]} or keyset,
+                                         fields=fields)
+                cursor = cursor.sort(sortSpec).limit(stop - start + 1)
+            else:
+                cursor = cursor.skip(start).limit(stop - start + 1)
+            if StreamChunkSize and stop - start + 1 > StreamChunkSize:
+                rows = cursor.batch_size(StreamChunkSize)
+            else:
+                rows = list(cursor)
+        spans.mark('fetch')
+        if not exact:
+            if len(rows) < stop - start + 1:
+                # we ran off the end so the total is known
+                stop = start + len(rows) - 1
+                Nitems = rows and start + len(rows) or min(Nitems, start)
+            else:
+                Nitems = max(Nitems, stop + 1)
         return (rows, start, stop, Nitems)
 
-    def _callback(self, result, *args):
-        '''Report the async worker's results'''
-        rows, start, stop, Nitems = result
-
+    def _count(self, collection, cursor, findSpec, countKey):
+        '''Get a possibly stale count of the query results according to CountMode'''
+        if CountMode == 'estimate' and not findSpec:
+            try:
+                return collection.database.command('collstats', collection.name)['count']
+            except pymongo.errors.OperationFailure:
+                return 0 # no such collection
+        Nitems = CountCache.get(countKey)
+        if Nitems is cache_util.Missing:
+            Nitems = cursor.count()
+            CountCache.set(countKey, Nitems)
+        return Nitems
+
+    def _chunkWorker(self, cursor, size, separator, stream=None):
+        '''Encode up to size more documents from the cursor in a thread, '' when it is exhausted
+
+        The chunk starts with the separator and is compressed by stream if there is one.
+        '''
+        self.spans.mark('wait')
+        rows = []
+        for row in cursor:
+            rows.append(row)
+            if len(rows) >= size:
+                break
+        self.spans.mark('fetch')
+        if not rows:
+            return ''
+        s = separator + json_codec.dumps(rows)[1:-1]  # strip the brackets
+        self.spans.mark('encode')
+        if stream is not None:
+            s = stream.chunk(tornado.escape.utf8(s))
+            self.spans.mark('compress')
+        return s
+
+    @tornado.gen.coroutine
+    def _stream(self, result):
+        '''Write a large result a chunk at a time with chunked transfer encoding
+
+        Only one chunk of documents is in memory at a time.
+        '''
+        cursor, start, stop, Nitems = result
+        self.set_header('Content-Range', 'items %d-%d/%d' % (start, stop, Nitems))
+        self.set_header('Content-Type', 'text/javascript')
+        stream = None
+        if compress_util.MinSize:
+            self.set_header('Vary', 'Accept-Encoding')
+            encoding = compress_util.negotiate(self.request.headers.get('Accept-Encoding', ''),
+                                               streaming=True)
+            if encoding:
+                stream = compress_util.Stream(encoding)
+                self.set_header('Content-Encoding', encoding)
+        try:
+            separator = '['
+            while True:
+                s = yield self.run_future(self._chunkWorker, cursor, StreamChunkSize, separator,
+                                          stream)
+                if not s:
+                    break
+                self.write(s)
+                separator = ','
+                yield self.flush()
+                self.spans.mark('write')
+            s = separator == '[' and '[]' or ']'
+            self.write(stream is not None and stream.finish(s) or s)
+        finally:
+            cursor.close()
+
+    @tornado.gen.coroutine
+    def _callback(self, s, start, stop, Nitems, variants=None):
+        '''Report the async worker's encoded results'''
         # send the result
         self.set_header('Content-Range', 'items %d-%d/%d' % (start, stop, Nitems))
-        s = json.dumps(rows, default=bson.json_util.default)
-        s = s.replace('"_ref":', '"$ref":')  # restore $ref
-        self.set_header('Content-Length', len(s))
         self.set_header('Content-Type', 'text/javascript')
-        self.write(s)
+        yield self.writeBody(s, variants)
         self.finish()
 
+    @tornado.gen.coroutine
     def post(self, mode, db_name, collection_name):
         '''Create a new item and return the single item not an array'''
         if not self.checkAccessKey(db_name, collection_name, access.Create):
@@ -257,53 +709,242 @@ class CollectionHandler(access.BaseHandler):
         collection = self.mongo_conn[db_name][collection_name]
 
         try:
-            s = self.request.body
-            s = s.replace('"$ref":', '"_ref":')  # hide $ref
-            item = json.loads(s, object_hook=bson.json_util.object_hook)
+            item = json_codec.loads(self.request.body)
         except ValueError, e:
             raise HTTPError(400, unicode(e))
 
-        # validate the schema
-        self.validateSchema(db_name, collection_name, item)
-
-        if CheckSanity:
-            try:
-                sanitize(item)
-            except ValueError:
-                raise HTTPError(400, 'HTML field parse failed')
-
         # add meta items outside schema
         id = mongo_util.newId()
-        item['_id'] = id
-        item[access.OwnerKey] = self.getUserId()
+        owner = self.getUserId()
 
-        collection.insert(item, safe=True)
+        yield self.run_future(ChangingWorker(self._postWorker, db_name, collection_name, [id]),
+                              collection, db_name, collection_name, item, id, owner,
+                              len(self.request.body))
         # this path should get encoded only one place, fix this
         self.set_header('Location', '/data/%s-%s/%s/%s' % (mode, db_name, collection_name, id))
-        s = json.dumps(item, default=bson.json_util.default)
-        s = s.replace('"_ref":', '"$ref":')  # restore $ref
-        self.set_header('Content-Length', len(s))
+        s = json_codec.dumps(item)
         self.set_header('Content-Type', 'text/javascript')
-        self.write(s)
+        yield self.writeBody(s)
+
+    def _postWorker(self, collection, db_name, collection_name, item, id, owner, size=0):
+        '''Check and insert a new item in a thread'''
+        # validate the schema and sanitize
+        self.checkItems(db_name, collection_name, [item], size, CheckSanity)
+
+        item['_id'] = id
+        item[access.OwnerKey] = owner
+        item[access.VersionKey] = mongo_util.newId()
+
+        collection.insert(item, safe=True)
+
+
+# handle batches of creates, updates and deletes
+class BulkHandler(access.BaseHandler):
+    @tornado.gen.coroutine
+    def post(self, mode, db_name, collection_name):
+        '''Apply a list of operations and return a list of results in the same order
+
+        Each operation is {"method": "post", "content": item},
+        {"method": "put", "id": id, "content": item},
+        {"method": "patch", "id": id, "content": changed fields} or
+        {"method": "delete", "id": id}. Posts return the new item, the others
+        {"_id": id}. Nothing is written unless every operation is permitted and valid.
+        '''
+        try:
+            ops = json_codec.loads(self.request.body)
+        except ValueError, e:
+            raise HTTPError(400, unicode(e))
+        if type(ops) != list:
+            raise HTTPError(400, 'expected a list of operations')
+        if len(ops) > BulkLimit:
+            raise HTTPError(400, 'too many operations (limit %d)' % BulkLimit)
+
+        needed = {'post': access.Create, 'put': access.Update, 'patch': access.Update,
+                  'delete': access.Delete}
+        for op in ops:
+            if type(op) != dict or op.get('method') not in needed:
+                raise HTTPError(400, 'bad operation')
+            if op['method'] != 'post' and not isinstance(op.get('id'), basestring):
+                raise HTTPError(400, 'operation needs an id')
+            if op['method'] != 'delete' and type(op.get('content')) != dict:
+                raise HTTPError(400, 'operation needs content')
+            if op['method'] == 'patch':
+                CheckPatch(op['content'])
+        for method in set(op['method'] for op in ops):
+            if not self.checkAccessKey(db_name, collection_name, needed[method]):
+                raise HTTPError(403, '%s not permitted (%s)' % (method,
+                                                               self.checkAccessKeyMessage))
+
+        collection = self.mongo_conn[db_name][collection_name]
+        worker = ChangingWorker(self._bulkWorker, db_name, collection_name,
+                                lambda result: [ item['_id'] for item in result ])
+        result = yield self.run_future(worker, collection, db_name, collection_name,
+                                       ops, self.getUserId(),
+                                       len(self.request.body) // max(1, len(ops)))
+        s = json_codec.dumps(result)
+        self.set_header('Content-Type', 'text/javascript')
+        yield self.writeBody(s)
+
+    def _bulkWorker(self, collection, db_name, collection_name, ops, userId, size=0):
+        '''Check all the operations and then apply them together in a thread
+
+        size is the average size of an operation for picking the process pool.
+        '''
+        wholeItems = []
+        items = []
+        for op in ops:
+            if op['method'] == 'delete':
+                continue
+            if op['method'] == 'patch':
+                if not self.validateChanges(db_name, collection_name, op['content']):
+                    wholeItems.append(op)
+                if CheckSanity:
+                    try:
+                        sanitize(op['content'])
+                    except ValueError:
+                        raise HTTPError(400, 'HTML field parse failed')
+                continue
+            item = op['content']
+            # remove meta items that are not in schema
+            item.pop('_id', '')
+            item.pop(access.OwnerKey, '')
+            item.pop(access.VersionKey, '')
+            items.append(item)
+        self.checkItems(db_name, collection_name, items, size, CheckSanity)
+
+        # look up the owners of everything being changed at once
+        ids = [op['id'] for op in ops if op['method'] != 'post']
+        owners = {}
+        old_items = {}
+        if ids:
+            # patches the schema can't check field by field need the whole old items
+            fields = not wholeItems and [access.OwnerKey] or None
+            for old_item in collection.find({'_id': {'$in': ids}}, fields=fields):
+                owners[old_item['_id']] = old_item.get(access.OwnerKey, None)
+                old_items[old_item['_id']] = old_item
+        override = access.Override & self.allowedMode
+        for id in ids:
+            if id not in owners:
+                raise HTTPError(403, 'item %s does not exist' % id)
+            if owners[id] and owners[id] != userId and not override:
+                raise HTTPError(403, 'item %s not permitted (not owner)' % id)
+        for op in wholeItems:
+            self.validateSchema(db_name, collection_name,
+                                PatchedItem(old_items[op['id']], op['content']))
+
+        result = []
+        bulk = hasattr(collection, 'initialize_ordered_bulk_op') and \
+            collection.initialize_ordered_bulk_op()
+        # the owner in each filter catches changes since the owners were read so
+        # every update and remove has to match its item
+        matched = 0
+        removed = 0
+        missed = []
+        for op in ops:
+            if op['method'] == 'post':
+                item = op['content']
+                item['_id'] = mongo_util.newId()
+                item[access.OwnerKey] = userId
+                item[access.VersionKey] = mongo_util.newId()
+                if bulk:
+                    bulk.insert(item)
+                else:
+                    collection.insert(item, safe=True)
+                result.append(item)
+            elif op['method'] == 'put':
+                item = op['content']
+                item['_id'] = op['id']
+                item[access.OwnerKey] = owners[op['id']]
+                item[access.VersionKey] = mongo_util.newId()
+                spec = {'_id': op['id'], access.OwnerKey: owners[op['id']]}
+                matched += 1
+                if bulk:
+                    bulk.find(spec).replace_one(item)
+                elif not collection.update(spec, item, upsert=False, safe=True)['n']:
+                    missed.append(op['id'])
+                result.append({'_id': op['id']})
+            elif op['method'] == 'patch':
+                spec = {'_id': op['id'], access.OwnerKey: owners[op['id']]}
+                update = PatchUpdate(op['content'], mongo_util.newId())
+                if update:
+                    matched += 1
+                if update and bulk:
+                    bulk.find(spec).update_one(update)
+                elif update and not collection.update(spec, update, upsert=False,
+                                                      safe=True)['n']:
+                    missed.append(op['id'])
+                result.append({'_id': op['id']})
+            else:
+                spec = {'_id': op['id'], access.OwnerKey: owners[op['id']]}
+                removed += 1
+                if bulk:
+                    bulk.find(spec).remove_one()
+                elif not collection.remove(spec, safe=True)['n']:
+                    missed.append(op['id'])
+                result.append({'_id': op['id']})
+        # mongo refuses to execute an empty bulk operation
+        if bulk and [op for op in ops if op['method'] != 'patch' or op['content']]:
+            counts = bulk.execute()
+            if counts['nMatched'] != matched or counts['nRemoved'] != removed:
+                raise HTTPError(409, 'items changed owner or were deleted during the batch, '
+                                'the rest of it was written')
+        if missed:
+            raise HTTPError(409, 'items %s changed owner or were deleted during the batch, '
+                            'the rest of it was written' % ', '.join(missed))
+        return result
 
 
 # handle requests with an id
 class ItemHandler(access.BaseHandler):
+    @tornado.gen.coroutine
     def get(self, mode, db_name, collection_name, id):
         '''Handle requests for single items'''
-        if not self.checkAccessKey(db_name, collection_name, access.Read):
+        readMode = self.checkAccessKey(db_name, collection_name, access.Read)
+        if not readMode:
             raise HTTPError(403, 'read not permitted (%s)' % self.checkAccessKeyMessage)
 
         collection = self.mongo_conn[db_name][collection_name]
 
-        # restrict fields here
-        item = collection.find_one(id)
-        s = json.dumps(item, default=bson.json_util.default)
-        s = s.replace('"_ref":', '"$ref":')  # restore $ref
-        self.set_header('Content-Length', len(s))
+        fields = self.request.arguments.get('mf', [None])[0]
+        restrict = readMode == access.RestrictedRead
+        if ETags:
+            # a tag made since the last change to the collection is still good, otherwise
+            # the item's version has to be checked
+            changes = Changes.version((db_name, collection_name))
+            variant = ETagHash(fields, restrict, restrict and
+                               Changes.version((access.AdminDbName, 'Schemas')))
+            tags = [ tag.split(':') for tag in RequestETags(self.request) ]
+            for tag in tags:
+                if len(tag) == 3 and tag[0] == changes and tag[2] == variant:
+                    self.set_header('Etag', 'W/"%s"' % ':'.join(tag))
+                    self.set_status(304)
+                    return
+
+        item, version = yield self.run_future(self._getWorker, collection, db_name,
+                                              collection_name, id, fields, restrict)
+        s = json_codec.dumps(item)
+        if ETags:
+            # items written before versions existed are tagged by their content
+            version = version or 'h' + ETagHash(s)
+            self.set_header('Etag', 'W/"%s:%s:%s"' % (changes, version, variant))
+            if [version, variant] in [ tag[1:] for tag in tags ]:
+                self.set_status(304)
+                return
         self.set_header('Content-Type', 'text/javascript')
-        self.write(s)
-
+        yield self.writeBody(s)
+
+    def _getWorker(self, collection, db_name, collection_name, id, fields, restrict):
+        '''Fetch one item with only the permitted fields and its version in a thread'''
+        fields = self.getProjection(db_name, collection_name, fields, restrict)
+        # the version makes the ETag even when the fields asked for leave it out
+        extra = fields is not None and not restrict and access.VersionKey not in fields
+        item = collection.find_one(id, fields=extra and fields + [access.VersionKey] or fields)
+        version = item and item.get(access.VersionKey)
+        if item and extra:
+            item.pop(access.VersionKey, None)
+        return item, version
+
+    @tornado.gen.coroutine
     def put(self, mode, db_name, collection_name, id):
         '''update an item after an edit, no response?'''
         if not self.checkAccessKey(db_name, collection_name, access.Update):
@@ -311,85 +952,355 @@ class ItemHandler(access.BaseHandler):
 
         collection = self.mongo_conn[db_name][collection_name]
         try:
-            s = self.request.body
-            s = s.replace('"$ref":', '"_ref":')  # restore $ref
-            new_item = json.loads(s, object_hook=bson.json_util.object_hook)
+            new_item = json_codec.loads(self.request.body)
         except ValueError, e:
             raise HTTPError(400, unicode(e))
-        # remove meta items that are not in schema
-        new_item.pop('_id', '')
-        new_item.pop(access.OwnerKey, '')
+        # the fields are written with $set where dotted and $ names mean something else
+        CheckPatch(new_item)
+
+        yield self.run_future(ChangingWorker(self._putWorker, db_name, collection_name, [id]),
+                              collection, db_name, collection_name, id, new_item,
+                              self.getUserId(), len(self.request.body))
+
+    def _putWorker(self, collection, db_name, collection_name, id, new_item, userId, size=0):
+        '''Check ownership and replace an item in a thread'''
+        # validate schema and sanitize
+        self.checkItems(db_name, collection_name, [new_item], size, CheckSanity)
+
+        # set the new fields, keeping the owner, with the ownership check in the selector
+        version = mongo_util.newId()
+        new_item[access.VersionKey] = version
+        spec = {'_id': id}
+        if not access.Override & self.allowedMode:
+            spec[access.OwnerKey] = {'$in': [userId, None]}
+        old_item = collection.find_and_modify(spec, {'$set': new_item}, new=False)
+        if old_item is None:
+            # only failures read the item again to report why
+            if collection.find_one({'_id': id}, fields=[access.OwnerKey]):
+                raise HTTPError(403, 'update not permitted (not owner)')
+            raise HTTPError(403, 'update not permitted (does not exist)')
 
-        # validate schema
-        self.validateSchema(db_name, collection_name, new_item)
+        # a replacement drops the fields it doesn't have, unless the item was written since,
+        # and gets another version so a read between the two isn't taken for the result
+        removed = dict((key, 1) for key in old_item
+                       if key not in new_item and key not in ('_id', access.OwnerKey))
+        if removed:
+            collection.update({'_id': id, access.VersionKey: version},
+                              {'$unset': removed,
+                               '$set': {access.VersionKey: mongo_util.newId()}},
+                              upsert=False, safe=True)
+
+    @tornado.gen.coroutine
+    def patch(self, mode, db_name, collection_name, id):
+        '''Change just the fields sent, a null value removes the field'''
+        if not self.checkAccessKey(db_name, collection_name, access.Update):
+            raise HTTPError(403, 'update not permitted (%s)' % self.checkAccessKeyMessage)
+
+        collection = self.mongo_conn[db_name][collection_name]
+        try:
+            changes = json_codec.loads(self.request.body)
+        except ValueError, e:
+            raise HTTPError(400, unicode(e))
+        CheckPatch(changes)
+
+        yield self.run_future(ChangingWorker(self._patchWorker, db_name, collection_name, [id]),
+                              collection, db_name, collection_name, id, changes,
+                              self.getUserId())
+
+    def _patchWorker(self, collection, db_name, collection_name, id, changes, userId):
+        '''Check and apply changed fields with $set and $unset in a thread'''
+        if not self.validateChanges(db_name, collection_name, changes):
+            # the schema can only check whole items so check the item as it will be
+            old_item = collection.find_one({'_id': id})
+            if old_item:
+                self.validateSchema(db_name, collection_name, PatchedItem(old_item, changes))
 
         if CheckSanity:
             try:
-                sanitize(new_item)
+                sanitize(changes)
             except ValueError:
                 raise HTTPError(400, 'html string parse failed')
 
-        # insert meta info
-        new_item['_id'] = id
-
-        # check old item
-        old_item = collection.find_one({'_id': id}, fields=[access.OwnerKey])
-        if not old_item:
-            raise HTTPError(403, 'update not permitted (does not exist)')
-
-        owner = old_item.get(access.OwnerKey, None)
-
-        if not owner or access.Override & self.allowedMode or owner == self.getUserId():
-            new_item[access.OwnerKey] = owner
-
-        else:
+        update = PatchUpdate(changes, mongo_util.newId())
+        spec = {'_id': id}
+        if not access.Override & self.allowedMode:
+            # the owner is not changed so one filter covers owned and unowned items
+            spec[access.OwnerKey] = {'$in': [userId, None]}
+        if update:
+            result = collection.update(spec, update, upsert=False, safe=True)
+            if result['n']:
+                return
+        elif collection.find_one(spec, fields=['_id']):
+            return
+
+        if collection.find_one({'_id': id}, fields=[access.OwnerKey]):
             raise HTTPError(403, 'update not permitted (not owner)')
+        raise HTTPError(403, 'update not permitted (does not exist)')
 
-        collection.update({'_id': id}, new_item, upsert=False, safe=True)
-
+    @tornado.gen.coroutine
     def delete(self, mode, db_name, collection_name, id):
         '''Delete an item, what should I return?'''
         if not self.checkAccessKey(db_name, collection_name, access.Delete):
             raise HTTPError(403, 'delete item not permitted (%s)' % self.checkAccessKeyMessage)
 
         collection = self.mongo_conn[db_name][collection_name]
-        if not access.Override & self.allowedMode:
-            old_item = collection.find_one({'_id': id}, fields=[access.OwnerKey])
-            if not old_item:
-                raise HTTPError(403, 'delete item does not exist')
-            owner = old_item.get(access.OwnerKey, None)
-            if owner and owner != self.getUserId():
+        yield self.run_future(ChangingWorker(self._deleteWorker, db_name, collection_name, [id]),
+                              collection, id, self.getUserId())
+
+    def _deleteWorker(self, collection, id, userId):
+        '''Check ownership and remove an item in a thread'''
+        if access.Override & self.allowedMode:
+            collection.remove({'_id': id}, safe=True)
+            return
+
+        # remove only an item the user owns or that has no owner
+        result = collection.remove({'_id': id, access.OwnerKey: {'$in': [userId, None]}},
+                                   safe=True)
+        if not result['n']:
+            # only failures read the item to report why
+            if collection.find_one({'_id': id}, fields=[access.OwnerKey]):
                 raise HTTPError(403, 'delete not permitted (not owner)')
+            raise HTTPError(403, 'delete item does not exist')
 
-        collection.remove({'_id': id}, safe=True)
 
+# wait for changes instead of polling queries
+class ChangesHandler(access.BaseHandler):
+    # wakes the request when the client goes away while it waits
+    wakeup = None
 
-class TestHandler(access.BaseHandler):
-    def get(self, flag):
-        if flag == 'reset':
-            db = self.mongo_conn['test']
-            db.drop_collection('test')
-            collection = db['test']
+    @tornado.gen.coroutine
+    def get(self, mode, db_name, collection_name):
+        '''Wait for changes to the collection and return the items they touched
+
+        since is the version from the last response, without it the current
+        version is returned at once. wait is the most seconds to wait. mq and
+        mf select the items as they do for queries. The result is
+        {"since": version, "items": [changed items the query selects],
+        "deleted": [changed ids it doesn't select]} or, when the changes
+        aren't known, {"since": version, "reset": true} and the query should
+        be made again. Restricted readers are only told to query again since a
+        restricted query reads an item only when it is the one item selected.
+        '''
+        readMode = self.checkAccessKey(db_name, collection_name, access.Read)
+        restrict = readMode == access.RestrictedRead
+        if not readMode:
+            raise HTTPError(403, 'read not permitted (%s)' % self.checkAccessKeyMessage)
+        key = (db_name, collection_name)
+        since = self.get_argument('since', None)
+        if not since:
+            self.write({'since': Changes.version(key), 'items': [], 'deleted': []})
+            return
+        try:
+            wait = min(float(self.get_argument('wait', feed_util.PollSeconds)),
+                       feed_util.PollSeconds)
+        except ValueError:
+            raise HTTPError(400, 'bad wait')
 
-            for value, word in enumerate(['foo', 'bar', 'fee', 'baa', 'baa', 'bar']):
-                collection.insert({
-                    'word': word,
-                    'value': value,
-                    '_id': mongo_util.newId(),
-                    access.OwnerKey: self.getUserId()}, safe=True)
+        findSpec = {}
+        if 'mq' in self.request.arguments:
+            findSpec = ParseQuery(self.request.arguments['mq'][0])
+            if restrict:
+                findSpec = RestrictQuery(findSpec)
 
-            collection.insert({
-                'word': 'another',
-                'value': 42,
-                '_id': mongo_util.newId(),
-                access.OwnerKey: 'some.one@else'}, safe=True)
+        # changes made here wake the request, other processes' changes are checked for
+        deadline = time.time() + wait
+        while True:
+            version, ids = Feed.since(key, since)
+            remaining = deadline - time.time()
+            if ids != [] or remaining <= 0 or Feed.closed:
+                break
+            changed = tornado.concurrent.Future()
+            self.wakeup = lambda: changed.done() or changed.set_result(None)
+            Feed.wait(key, self.wakeup)
+            try:
+                yield tornado.gen.with_timeout(
+                    timedelta(seconds=min(remaining, feed_util.CheckSeconds)), changed)
+            except tornado.gen.TimeoutError:
+                pass
+            finally:
+                Feed.unwait(key, self.wakeup)
+                self.wakeup = None
+            if self.request.connection.stream.closed():
+                return
+
+        if ids is None or restrict and ids:
+            # the changed ids themselves aren't for restricted readers
+            self.write({'since': version, 'reset': True})
+            return
+        items = []
+        if ids:
+            collection = self.mongo_conn[db_name][collection_name]
+            fields = self.request.arguments.get('mf', [None])[0]
+            items = yield self.run_future(self._changesWorker, collection, db_name,
+                                          collection_name, findSpec, ids, fields, restrict)
+        selected = set(item['_id'] for item in items)
+        s = json_codec.dumps({'since': version, 'items': items,
+                              'deleted': [ id for id in ids if id not in selected ]})
+        self.set_header('Content-Type', 'text/javascript')
+        yield self.writeBody(s)
+
+    def _changesWorker(self, collection, db_name, collection_name, findSpec, ids, fields,
+                       restrict):
+        '''Fetch the changed items the query still selects in a thread'''
+        fields = self.getProjection(db_name, collection_name, fields, restrict)
+        spec = {'_id': {'$in': ids}}
+        if findSpec:
+            spec = {'$and': [findSpec, spec]}
+        return list(collection.find(spec, fields=fields))
+
+    def on_connection_close(self):
+        super(ChangesHandler, self).on_connection_close()
+        if self.wakeup is not None:
+            self.wakeup()
+
+
+# run the queries for a page in one request
+class BatchHandler(CollectionHandler):
+    SUPPORTED_METHODS = ('GET',)
+
+    def _request_summary(self):
+        '''Leave the query string out of the access log, it holds access keys'''
+        return '%s %s (%s)' % (self.request.method, self.request.path, self.request.remote_ip)
+
+    @tornado.gen.coroutine
+    def get(self):
+        '''Run a list of queries together and return their results in the same order
+
+        q is the json list of queries, each {"key": access key, "database": db,
+        "collection": collection} with optional "mq" query object, "ms" sort
+        like "+a,-b", "mf" fields like "a,b", "start" and "count". The result is
+        {"results": [...]} with {"items": [...], "range": "items 0-9/100"} for
+        each query, the range as in Content-Range, or {"status": 403,
+        "error": message} for one that failed. Results aren't streamed so each
+        query returns at most BatchCount items, the range shows how many there are.
+        '''
+        try:
+            queries = json_codec.loads(self.get_argument('q'))
+        except ValueError, e:
+            raise HTTPError(400, unicode(e))
+        if type(queries) != list:
+            raise HTTPError(400, 'expected a list of queries')
+        if len(queries) > BatchLimit:
+            raise HTTPError(400, 'too many queries (limit %d)' % BatchLimit)
+
+        results = yield [ self._batchQuery(query) for query in queries ]
+        self.spans.mark('queries')
+        s = self.profiled(json_codec.dumps, {'results': results})
+        self.spans.mark('encode')
+        self.set_header('Content-Type', 'text/javascript')
+        yield self.writeBody(s)
 
+    @tornado.gen.coroutine
+    def _batchQuery(self, query):
+        '''Check and run one query of a batch, reporting its failure instead of raising it'''
+        try:
+            if type(query) != dict:
+                raise HTTPError(400, 'bad query')
+            db_name = query.get('database')
+            collection_name = query.get('collection')
+            if not isinstance(db_name, basestring) or not isinstance(collection_name, basestring):
+                raise HTTPError(400, 'query needs a database and collection')
+            key = query.get('key')
+            if key is not None and not isinstance(key, basestring):
+                raise HTTPError(400, 'bad key')
+            readMode = self.checkAccessKey(db_name, collection_name, access.Read,
+                                           key and tornado.escape.utf8(key) or None)
+            restrict = readMode == access.RestrictedRead
+            if not readMode:
+                raise HTTPError(403, 'read not permitted (%s)' % self.checkAccessKeyMessage)
+
+            mq = query.get('mq') or {}
+            if type(mq) != dict:
+                raise HTTPError(400, 'bad query')
+            # the decoded query can hold dates, ids and patterns
+            countKey = (db_name, collection_name,
+                        json.dumps(mq, sort_keys=True, default=bson.json_util.default), restrict,
+                        Changes.version((db_name, collection_name)))
+            findSpec = TranslateQuery(mq)
+            if restrict:
+                findSpec = RestrictQuery(findSpec)
+            sortSpec = []
+            if not restrict and query.get('ms'):
+                try:
+                    for s in query['ms'].split(','):
+                        sortSpec.append((s[1:], {'+': pymongo.ASCENDING,
+                                                 '-': pymongo.DESCENDING}[s[0]]))
+                except (AttributeError, IndexError, KeyError):
+                    raise HTTPError(400, 'bad sort')
+            start = 0
+            stop = None
+            if not restrict:
+                try:
+                    start = max(int(query.get('start') or 0), 0)
+                    count = min(max(int(query.get('count') or BatchCount), 1), BatchCount)
+                except (TypeError, ValueError):
+                    raise HTTPError(400, 'bad range')
+                stop = start + count - 1
+            fields = query.get('mf')
+            if type(fields) == list:
+                fields = ','.join(fields)
+
+            collection = self.mongo_conn[db_name][collection_name]
+            result = yield self.run_future(self._batchWorker, collection, findSpec, sortSpec,
+                                           start, stop, restrict, countKey, fields)
+        except HTTPError, e:
+            result = {'status': e.status_code, 'error': e.log_message or
+                      httplib.responses.get(e.status_code, 'error')}
+        except pymongo.errors.OperationFailure, e:
+            result = {'status': 400, 'error': unicode(e)}
+        except Exception, e:
+            # one broken query shouldn't fail the others
+            logging.error('batch query failed: %s' % traceback.format_exc())
+            result = {'status': 500, 'error': httplib.responses[500]}
+        raise tornado.gen.Return(result)
+
+    def _batchWorker(self, collection, findSpec, sortSpec, start, stop, restrict, countKey,
+                     fields):
+        '''Run one query of a batch in a thread with its own stage timer'''
+        rows, start, stop, Nitems = self._worker(collection, findSpec, sortSpec, start, stop,
+                                                 restrict, countKey, fields=fields,
+                                                 spans=profile_util.Spans())
+        if not isinstance(rows, list):
+            # a large result comes back as a cursor to stream
+            cursor = rows
+            try:
+                rows = list(cursor)
+            finally:
+                cursor.close()
+        return {'items': rows, 'range': 'items %d-%d/%d' % (start, stop, Nitems)}
+
+
+class TestHandler(access.BaseHandler):
+    @tornado.gen.coroutine
+    def get(self, flag):
+        if flag == 'reset':
+            yield self.run_future(ChangingWorker(self._resetWorker, 'test', 'test'),
+                                  self.getUserId())
             self.write('ok')
 
         elif re.match(r'\d+', flag):
             code = int(flag)
             raise HTTPError(code)
 
+    def _resetWorker(self, userId):
+        '''Rebuild the test collection in a thread'''
+        db = self.mongo_conn['test']
+        db.drop_collection('test')
+        collection = db['test']
+
+        for value, word in enumerate(['foo', 'bar', 'fee', 'baa', 'baa', 'bar']):
+            collection.insert({
+                'word': word,
+                'value': value,
+                '_id': mongo_util.newId(),
+                access.OwnerKey: userId}, safe=True)
+
+        collection.insert({
+            'word': 'another',
+            'value': 42,
+            '_id': mongo_util.newId(),
+            access.OwnerKey: 'some.one@else'}, safe=True)
+
 
 class WarningHandler(access.BaseHandler):
     def post(self):
@@ -401,6 +1312,145 @@ class WarningHandler(access.BaseHandler):
         self.write(s)
 
 
+class MetricsHandler(access.BaseHandler):
+    '''Report the metrics in the Prometheus text format to local scrapers and developers'''
+    # caches reported by name
+    caches = {
+        'roles': access.RoleCache,
+        'permissions': access.PermissionCache,
+        'schemas': access.SchemaCache,
+        'keys': access.KeyCache,
+        'users': access.UserCache,
+        'counts': CountCache,
+        'queries': QueryCache,
+        'results': ResultCache,
+        'html': sanity.HTMLMemo,
+    }
+
+    @tornado.gen.coroutine
+    def get(self):
+        allowed = yield self.run_future(self.isLocalOrDeveloper)
+        if not allowed:
+            raise HTTPError(403, 'metrics not permitted')
+        s = metrics.render(self.snapshots())
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        yield self.writeBody(s)
+
+    def snapshots(self):
+        '''Read the thread pool and cache statistics'''
+        pool = self.application.thread_pool.stats()
+        caches = sorted((name, cache.stats()) for name, cache in self.caches.items())
+        return [
+            metrics.Snapshot('torongo_pool_tasks', 'gauge',
+                             'Worker tasks waiting in the queue or running',
+                             ('state',), [(('queued',), pool['queued']),
+                                          (('active',), pool['active'])]),
+            metrics.Snapshot('torongo_pool_threads', 'gauge', 'Worker threads',
+                             (), [((), pool['threads'])]),
+            metrics.Snapshot('torongo_pool_stuck_threads', 'gauge',
+                             'Worker threads abandoned by a task timeout',
+                             (), [((), pool['stuck'])]),
+            metrics.Snapshot('torongo_pool_tasks_total', 'counter',
+                             'Worker tasks by outcome', ('outcome',),
+                             [((key,), pool[key]) for key in
+                              ('submitted', 'completed', 'failed', 'timeouts', 'cancelled')]),
+            metrics.Snapshot('torongo_pool_wait_seconds_total', 'counter',
+                             'Time worker tasks spent queued', (), [((), pool['wait_seconds'])]),
+            metrics.Snapshot('torongo_pool_run_seconds_total', 'counter',
+                             'Time worker tasks spent running', (), [((), pool['run_seconds'])]),
+            metrics.Snapshot('torongo_requests_in_flight', 'gauge', 'Requests being handled',
+                             (), [((), getattr(self.application, 'in_flight', 0))]),
+            metrics.Snapshot('torongo_changes_waiting', 'gauge',
+                             'Requests waiting on _changes', (), [((), Feed.waiting())]),
+            metrics.Snapshot('torongo_cache_hits_total', 'counter', 'Cache hits by cache',
+                             ('cache',), [((name, ), stats['hits']) for name, stats in caches]),
+            metrics.Snapshot('torongo_cache_misses_total', 'counter', 'Cache misses by cache',
+                             ('cache',), [((name, ), stats['misses']) for name, stats in caches]),
+            metrics.Snapshot('torongo_cache_entries', 'gauge', 'Cache entries by cache',
+                             ('cache',), [((name, ), stats['size']) for name, stats in caches]),
+            metrics.Snapshot('torongo_cache_bytes', 'gauge', 'Cache bytes by cache',
+                             ('cache',), [((name, ), stats['bytes']) for name, stats in caches]),
+        ]
+
+
+class ProfileHandler(access.BaseHandler):
+    '''Control the slow log and sampling profiler at runtime for local users and developers
+
+    GET reports the profile, POST {"fraction": f, "slowMs": n} changes the settings
+    and DELETE discards the profile collected so far.
+    '''
+    @tornado.gen.coroutine
+    def prepare(self):
+        allowed = yield self.run_future(self.isLocalOrDeveloper)
+        if not allowed:
+            raise HTTPError(403, 'profiling not permitted')
+
+    @tornado.gen.coroutine
+    def get(self):
+        sort = self.get_argument('sort', 'cumulative')
+        limit = int(self.get_argument('limit', '40'))
+        try:
+            s = profile_util.report(sort, limit)
+        except KeyError:
+            raise HTTPError(400, 'unknown sort %s' % sort)
+        self.set_header('Content-Type', 'text/plain')
+        yield self.writeBody(s)
+
+    def post(self):
+        try:
+            settings = json.loads(self.request.body)
+            if 'fraction' in settings:
+                profile_util.set_profile_fraction(settings['fraction'])
+            if 'slowMs' in settings:
+                profile_util.SlowMs = max(int(settings['slowMs']), 0)
+        except (ValueError, TypeError, AttributeError), e:
+            raise HTTPError(400, unicode(e))
+        logging.warning('profiling %g of requests, slow log over %dms' % (
+            profile_util.ProfileFraction, profile_util.SlowMs))
+        self.write({ 'fraction': profile_util.ProfileFraction, 'slowMs': profile_util.SlowMs })
+
+    def delete(self):
+        profile_util.reset()
+        self.write('ok')
+
+
+class IndexHandler(access.BaseHandler):
+    '''Report the indexes the queries seen need to local users and developers
+
+    ?database=name limits the report to one database.
+    '''
+    @tornado.gen.coroutine
+    def get(self):
+        allowed = yield self.run_future(self.isLocalOrDeveloper)
+        if not allowed:
+            raise HTTPError(403, 'index report not permitted')
+        result = yield self.run_future(index_util.report, self._indexes, self.getSchemaInfo,
+                                       self.get_argument('database', None))
+        s = json_codec.dumps(result)
+        self.set_header('Content-Type', 'text/javascript')
+        yield self.writeBody(s)
+
+    def _indexes(self, db_name, collection_name):
+        '''Get the existing indexes of a collection in a thread'''
+        return self.mongo_conn[db_name][collection_name].index_information()
+
+
+ROUTES = [
+    (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)?$", DatabaseHandler),
+    (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/$", CollectionHandler),
+    (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/_bulk$", BulkHandler),
+    (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/_changes$", ChangesHandler),
+    (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/([a-f0-9]+)", ItemHandler),
+    (r"/data/_auth(.*)$", access.AuthHandler),
+    (r"/data/_test_(reset|\d+)$", TestHandler),
+    (r"/data/_warning$", WarningHandler),
+    (r"/data/_metrics$", MetricsHandler),
+    (r"/data/_profile$", ProfileHandler),
+    (r"/data/_indexes$", IndexHandler),
+    (r"/data/_batch$", BatchHandler),
+]
+
+
 def generate_secret(seed):
     '''Generate the secret string for hmac'''
     try:
@@ -413,11 +1463,22 @@ def generate_secret(seed):
 
 
 def run(port=8888, threads=4, debug=False, static=False, pid=None,
-        mongo_host='127.0.0.1', mongo_port=27017, seed=0):
+        mongo_host='127.0.0.1', mongo_port=27017, seed=0, admin_cache_ttl=None,
+        task_timeout=None, checkers=0, processes=1):
     if pid is not None:
         # launch as a daemon and write the pid file
         import daemon
         daemon.daemonize(pid)
+    # everything the server processes share is made before they fork
+    sockets = tornado.netutil.bind_sockets(port)
+    secret = generate_secret(seed)
+    if processes > 1:
+        if debug:
+            logging.warning('debug reloading does not work with processes, using 1')
+        else:
+            process_util.prefork(processes)
+    # fork the checker processes before there are any threads or connections
+    process_util.start(checkers)
     # retry making the mongo connection with exponential backoff
     for i in range(8):
         try:
@@ -430,6 +1491,8 @@ def run(port=8888, threads=4, debug=False, static=False, pid=None,
     else:
         raise pymongo.errors.AutoReconnect
 
+    access.configureAdminCaches(ttl=admin_cache_ttl)
+
     google_secrets = {
         "key": os.environ['GOOGLE_OAUTH_KEY'],
         "secret": os.environ['GOOGLE_OAUTH_SECRET'],
@@ -437,25 +1500,30 @@ def run(port=8888, threads=4, debug=False, static=False, pid=None,
     }
 
     kwargs = {
-        'cookie_secret': generate_secret(seed),
+        'cookie_secret': secret,
         'debug': debug,
         'thread_count': threads,
+        'task_timeout': task_timeout,
         'mongo_conn': conn,
         'google_oauth': google_secrets
     }
     if static:
         kwargs['static_path'] = os.path.join(os.path.dirname(__file__), "../")
-    application = mongo_util.MongoApplication([
-        (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)?$", DatabaseHandler),
-        (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/$", CollectionHandler),
-        (r"/data/([a-zA-Z]*)-([a-zA-Z][a-zA-Z0-9]*)/([a-zA-Z][a-zA-Z0-9]*)/([a-f0-9]+)", ItemHandler),
-        (r"/data/_auth(.*)$", access.AuthHandler),
-        (r"/data/_test_(reset|\d+)$", TestHandler),
-        (r"/data/_warning$", WarningHandler),
-    ], **kwargs)
+    application = mongo_util.MongoApplication(ROUTES, **kwargs)
     http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(port)
-    tornado.ioloop.IOLoop.instance().start()
+    http_server.add_sockets(sockets)
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    def stopped():
+        io_loop.stop()
+        application.thread_pool.shutdown()
+        process_util.shutdown()
+    def drain(signum, frame):
+        # answer the clients waiting for changes and finish the requests in flight before exiting
+        io_loop.add_callback_from_signal(Feed.close)
+        io_loop.add_callback_from_signal(application.drain, http_server, DrainSeconds, stopped)
+    signal.signal(signal.SIGTERM, drain)
+    io_loop.start()
 
 
 def generate_sample_data(n, host, port):
@@ -481,6 +1549,7 @@ def run_from_args():
     Runs an instance of the torongo server with options pulled from the command
     line.
     '''
+    global StreamChunkSize, CountMode
     parser = optparse.OptionParser()
     parser.add_option("-p", "--port", dest="port", default=8888,
         help="server port number (default=8888)", type="int")
@@ -507,6 +1576,49 @@ def run_from_args():
         help="seed for the random number generator")
     parser.add_option("--noSanity", dest="noSanity", action="store_true",
         default=False, help="disable sanity checking for BigWords")
+    parser.add_option("--noETags", dest="noETags", action="store_true", default=False,
+        help="disable ETags on gets, needed if anything else writes the db (default=false)")
+    parser.add_option("--adminCacheTTL", dest="adminCacheTTL", default=access.AdminCacheTTL,
+        type="float", help="seconds to cache roles and permissions from the Admin db (default=60)")
+    parser.add_option("--streamChunk", dest="streamChunk", default=StreamChunkSize, type="int",
+        help="stream query results larger than this many items in chunks, 0 to disable "
+             "(default=%d)" % StreamChunkSize)
+    parser.add_option("--jsonBackend", dest="jsonBackend", default=json_codec.Backend,
+        type="choice", choices=sorted(json_codec.Backends),
+        help="json implementation for responses, others are checked against the bson types "
+             "before use (default=%s)" % json_codec.Backend)
+    parser.add_option("--sanitizer", dest="sanitizer", default=sanity.HTMLBackend,
+        type="choice", choices=sorted(sanity.HTMLBackends),
+        help="html sanitizer for *HTML fields (default=%s)" % sanity.HTMLBackend)
+    parser.add_option("--countMode", dest="countMode", default=CountMode, type="choice",
+        choices=CountModes, help="how to count paged queries, one of %s (default=%s)" % (
+            '|'.join(CountModes), CountMode))
+    parser.add_option("--countTTL", dest="countTTL", default=CountCacheTTL, type="float",
+        help="seconds to reuse cached query counts (default=%d)" % CountCacheTTL)
+    parser.add_option("--resultCacheMB", dest="resultCacheMB", default=ResultCacheMB, type="int",
+        help="megabytes of query results to cache for collections with resultCache on, "
+             "0 to disable (default=%d)" % ResultCacheMB)
+    parser.add_option("--compressMin", dest="compressMin", default=compress_util.MinSize,
+        type="int", help="bytes above which /data responses are compressed for clients that "
+             "accept it, 0 to disable (default=%d)" % compress_util.MinSize)
+    parser.add_option("--pollSeconds", dest="pollSeconds", default=feed_util.PollSeconds,
+        type="float", help="most seconds a _changes request waits (default=%d)" %
+             feed_util.PollSeconds)
+    parser.add_option("--taskTimeout", dest="taskTimeout", default=None, type="float",
+        help="seconds before a worker task fails with 503 (default=no timeout)")
+    parser.add_option("--processes", dest="processes", default=1, type="int",
+        help="server processes sharing the port (default=1)")
+    parser.add_option("--checkers", dest="checkers", default=0, type="int",
+        help="processes per server process for checking large items (default=0, in threads)")
+    parser.add_option("--checkThreshold", dest="checkThreshold",
+        default=process_util.CheckThreshold, type="int",
+        help="bytes above which items go to the checker processes (default=%d)" %
+             process_util.CheckThreshold)
+    parser.add_option("--slowMs", dest="slowMs", default=profile_util.SlowMs, type="int",
+        help="log requests slower than this many milliseconds, 0 to disable (default=0)")
+    parser.add_option("--profileFraction", dest="profileFraction",
+        default=profile_util.ProfileFraction, type="float",
+        help="fraction of requests to profile, see /data/_profile (default=0)")
     (options, args) = parser.parse_args()
     if options.generate:
         generate_sample_data(options.generate, options.mongohost,
@@ -523,9 +1635,29 @@ def run_from_args():
         global CheckSanity
         CheckSanity = False
 
+    if options.noETags:
+        global ETags
+        ETags = False
+
+    StreamChunkSize = options.streamChunk
+    CountMode = options.countMode
+    CountCache.ttl = options.countTTL
+    ResultCache.maxbytes = options.resultCacheMB * 1024 * 1024
+    compress_util.MinSize = options.compressMin
+    feed_util.PollSeconds = options.pollSeconds
+    try:
+        json_codec.setBackend(options.jsonBackend)
+    except ValueError, e:
+        parser.error(str(e))
+    sanity.setHTMLBackend(options.sanitizer)
+    process_util.CheckThreshold = options.checkThreshold
+    profile_util.SlowMs = options.slowMs
+    profile_util.set_profile_fraction(options.profileFraction)
+
     # run the server
     run(options.port, options.workers, options.debug, options.static,
-        options.pid, options.mongohost, options.mongoport, options.seed)
+        options.pid, options.mongohost, options.mongoport, options.seed,
+        options.adminCacheTTL, options.taskTimeout, options.checkers, options.processes)
 
 if __name__ == "__main__":
     run_from_args()
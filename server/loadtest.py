@@ -0,0 +1,123 @@
+'''
+Load test for read latency while slow writes are in progress.
+
+Runs concurrent range reads against a collection on their own and then again
+while writers post large rich text items, and reports read latency
+percentiles for both phases. With all mongo access in the worker pool the
+read percentiles should stay flat when the writers start.
+
+The collection must grant the user read and create permission, for example
+run with --cookie set to a developer's user cookie.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import tornado.ioloop
+import tornado.httpclient
+import tornado.gen
+import json
+import optparse
+import time
+
+
+def percentile(values, p):
+    '''Return the p-th percentile of a list of numbers'''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+@tornado.gen.coroutine
+def openCollection(client, base, database, collection, mode, cookie):
+    '''Get the url and access key for a collection'''
+    headers = { 'Content-Type': 'application/json' }
+    if cookie:
+        headers['Cookie'] = 'user=' + cookie
+    response = yield client.fetch(base + '/data/_auth', method='POST', headers=headers,
+                                  body=json.dumps({ 'database': database,
+                                                    'collection': collection,
+                                                    'mode': mode }))
+    info = json.loads(response.body)
+    raise tornado.gen.Return((base + info['url'], info['key']))
+
+
+@tornado.gen.coroutine
+def reader(client, url, key, deadline, latencies):
+    '''Fetch the first page of the collection until the deadline'''
+    headers = { 'Authorization': key, 'Range': 'items=0-24' }
+    while time.time() < deadline:
+        t0 = time.time()
+        yield client.fetch(url, headers=headers)
+        latencies.append(time.time() - t0)
+
+
+@tornado.gen.coroutine
+def writer(client, url, key, deadline, size, counts):
+    '''Post large rich text items until the deadline'''
+    chunk = '<p>Some <b>rich</b> <i>text</i> for the sanitizer.</p>'
+    body = json.dumps({ 'loadtestHTML': chunk * (size // len(chunk) + 1) })
+    headers = { 'Authorization': key, 'Content-Type': 'application/json' }
+    while time.time() < deadline:
+        try:
+            yield client.fetch(url, method='POST', body=body, headers=headers)
+            counts['ok'] += 1
+        except tornado.httpclient.HTTPError:
+            counts['failed'] += 1
+
+
+@tornado.gen.coroutine
+def phase(client, url, key, options, nwriters):
+    '''Run the readers and nwriters writers for the configured duration'''
+    latencies = []
+    counts = { 'ok': 0, 'failed': 0 }
+    deadline = time.time() + options.seconds
+    tasks = [ reader(client, url, key, deadline, latencies) for i in range(options.readers) ]
+    tasks += [ writer(client, url, key, deadline, options.size, counts)
+               for i in range(nwriters) ]
+    yield tasks
+    raise tornado.gen.Return((latencies, counts))
+
+
+def report(title, latencies, counts):
+    print '%s: %d reads' % (title, len(latencies)),
+    for p in [ 50, 90, 99 ]:
+        print ' p%d=%.1fms' % (p, 1000 * percentile(latencies, p)),
+    print ' writes ok=%(ok)d failed=%(failed)d' % counts
+
+
+@tornado.gen.coroutine
+def main(options):
+    tornado.httpclient.AsyncHTTPClient.configure(None,
+        max_clients=options.readers + options.writers)
+    client = tornado.httpclient.AsyncHTTPClient()
+    url, key = yield openCollection(client, options.url, options.database,
+                                    options.collection, 'rc', options.cookie)
+
+    latencies, counts = yield phase(client, url, key, options, 0)
+    report('reads only', latencies, counts)
+    latencies, counts = yield phase(client, url, key, options, options.writers)
+    report('reads with slow writes', latencies, counts)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--url", dest="url", default='http://127.0.0.1:8888',
+        help="server base url (default=http://127.0.0.1:8888)")
+    parser.add_option("--database", dest="database", default='test',
+        help="database to read and write (default=test)")
+    parser.add_option("--collection", dest="collection", default='loadtest',
+        help="collection to read and write (default=loadtest)")
+    parser.add_option("--cookie", dest="cookie", default='',
+        help="value of the user cookie to authenticate with")
+    parser.add_option("--readers", dest="readers", default=20, type="int",
+        help="number of concurrent readers (default=20)")
+    parser.add_option("--writers", dest="writers", default=4, type="int",
+        help="number of concurrent writers in the second phase (default=4)")
+    parser.add_option("--size", dest="size", default=500000, type="int",
+        help="approximate size of each written item in bytes (default=500000)")
+    parser.add_option("--seconds", dest="seconds", default=10, type="float",
+        help="duration of each phase (default=10)")
+    (options, args) = parser.parse_args()
+    tornado.ioloop.IOLoop.instance().run_sync(lambda: main(options))
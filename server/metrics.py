@@ -0,0 +1,208 @@
+'''
+Counters and histograms rendered in the Prometheus text format.
+
+Updating a metric takes one lock and a dict update so instrumentation can
+stay on in production. Values that already exist elsewhere, like the thread
+pool and cache statistics, are read when the metrics are rendered instead
+of being updated as they change.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import bisect
+from threading import Lock
+
+# seconds
+LatencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# bytes
+SizeBuckets = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+_registry = []
+
+
+def _format_labels(names, values):
+    '''
+    Formats label names and values as {name="value",...}.
+
+    :param names: tuple of label names
+    :param values: tuple of label values
+    '''
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', r'\\').replace('"', r'\"')
+                                          .replace('\n', r'\n'))
+        for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+class Counter(object):
+    '''
+    A value per set of labels that only goes up.
+
+    :ivar name:
+    :ivar help:
+    :ivar labels: tuple of label names
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        '''
+        Adds to the value for a set of labels.
+
+        :param labels: tuple of label values in the order of the names
+        :param amount: amount to add
+        '''
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        '''Returns a list of (suffix, label names, label values, value)'''
+        with self._lock:
+            items = self._values.items()
+        return [ ('', self.labels, labels, value) for labels, value in sorted(items) ]
+
+
+class Gauge(Counter):
+    '''
+    A value per set of labels that can go up and down.
+    '''
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        '''
+        Sets the value for a set of labels.
+
+        :param labels: tuple of label values in the order of the names
+        :param value: new value
+        '''
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    '''
+    Counts of observed values in buckets, with their sum and count, per set
+    of labels.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LatencyBuckets):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        '''
+        Records one value.
+
+        :param labels: tuple of label values in the order of the names
+        :param value: observed value
+        '''
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [ [0] * (len(self.buckets) + 1), 0.0, 0 ]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [ (labels, (list(counts), total, count))
+                      for labels, (counts, total, count) in self._values.items() ]
+        result = []
+        names = self.labels + ('le',)
+        for labels, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                result.append(('_bucket', names, labels + (_format_value(bound),), cumulative))
+            result.append(('_sum', self.labels, labels, total))
+            result.append(('_count', self.labels, labels, count))
+        return result
+
+
+class Snapshot(object):
+    '''
+    Values read at render time rather than kept in a registered metric.
+    '''
+    def __init__(self, name, kind, help, labels=(), values=()):
+        '''
+        :param name:
+        :param kind: counter or gauge
+        :param help:
+        :param labels: tuple of label names
+        :param values: list of (label values, value)
+        '''
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.values = values
+
+    def samples(self):
+        return [ ('', self.labels, labels, value) for labels, value in self.values ]
+
+
+def render(extra=()):
+    '''
+    Returns all registered metrics and any extra snapshots in the Prometheus
+    text format.
+
+    :param extra: list of Snapshot
+    '''
+    lines = []
+    for metric in list(_registry) + list(extra):
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for suffix, names, labels, value in metric.samples():
+            lines.append('%s%s%s %s' % (metric.name, suffix, _format_labels(names, labels),
+                                        _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# metrics shared by the server modules
+Requests = Counter('torongo_requests_total', 'HTTP requests by handler, method and status',
+                   ('handler', 'method', 'status'))
+RequestSeconds = Histogram('torongo_request_seconds', 'HTTP request latency by handler',
+                           ('handler', 'method'))
+ResponseBytes = Histogram('torongo_response_bytes', 'HTTP response body size by handler',
+                          ('handler',), SizeBuckets)
+StageSeconds = Histogram('torongo_stage_seconds', 'Time in each stage of a request by handler',
+                         ('handler', 'stage'))
+MongoSeconds = Histogram('torongo_mongo_seconds',
+                         'Mongo operation latency by database, collection and operation',
+                         ('database', 'collection', 'operation'))
+
+
+def _benchmark(n=100000):
+    '''Measure the cost of recording a request'''
+    import time
+    t0 = time.time()
+    for i in xrange(n):
+        Requests.inc(('BenchmarkHandler', 'GET', '200'))
+        RequestSeconds.observe(('BenchmarkHandler', 'GET'), 0.003)
+        ResponseBytes.observe(('BenchmarkHandler',), 2500)
+    print 'record a request %5.2f us' % ((time.time() - t0) / n * 1e6)
+    t0 = time.time()
+    render()
+    print 'render %5.2f ms' % ((time.time() - t0) * 1e3)
+
+if __name__ == '__main__':
+    _benchmark()
@@ -6,23 +6,30 @@ Utilities for using pymongo and its thread pool in web request handlers.
 '''
 from thread_util import ThreadPoolApplication, ThreadedRequestHandler
 import pymongo
+import pymongo.collection
+import pymongo.database
 import bson.json_util
 import bson.objectid
 import json
+import time
+
+import metrics
 
 class MongoApplication(ThreadPoolApplication):
     '''
     Stores a reference to a pymongo.Connecion or creates a new one to 
-    the default port on localhost.
+    the default port on localhost. The connection is wrapped to time the
+    operations on it.
     
     :ivar mongo_conn:
     '''
     def __init__(self, *args, **kwargs):
         super(MongoApplication, self).__init__(*args, **kwargs)
         try:
-            self.mongo_conn = kwargs['mongo_conn']
+            mongo_conn = kwargs['mongo_conn']
         except KeyError:
-            self.mongo_conn = pymongo.Connection()
+            mongo_conn = pymongo.Connection()
+        self.mongo_conn = TimedConnection(mongo_conn)
 
 class MongoRequestHandler(ThreadedRequestHandler):
     '''
@@ -35,21 +42,19 @@ class MongoRequestHandler(ThreadedRequestHandler):
         super(MongoRequestHandler, self).__init__(*args, **kwargs)
         self.mongo_conn = self.application.mongo_conn
         
-    def run_async(self, callback, worker, *args, **kwargs):
+    def wrap_worker(self, worker):
         '''
-        Runs a worker function in a thread and receives the result in a 
-        callback. Cleans up the pymongo.Connection thread pool properly.
+        Wraps a worker so it cleans up the pymongo.Connection thread pool 
+        properly after running in a thread.
         
-        :param callback:
         :param worker:
-        :param args:
-        :param kwargs:
         '''
         def _worker(*args, **kwargs):
-            result = worker(*args, **kwargs)
-            self.mongo_conn.end_request()
-            return result
-        self.application.thread_pool(callback, _worker, *args, **kwargs)
+            try:
+                return worker(*args, **kwargs)
+            finally:
+                self.mongo_conn.end_request()
+        return _worker
 
     def to_json(self, obj):
         '''
@@ -69,6 +74,151 @@ class MongoRequestHandler(ThreadedRequestHandler):
         '''
         return json.loads(text, object_hook=bson.json_util.object_hook)
 
+class TimedConnection(object):
+    '''
+    Wraps a pymongo.Connection so operations on its collections record
+    their latency in metrics.MongoSeconds. Anything else passes through.
+    
+    :ivar connection: the wrapped connection
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getitem__(self, name):
+        return TimedDatabase(self.connection[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if isinstance(attr, pymongo.database.Database):
+            return TimedDatabase(attr)
+        return attr
+
+class TimedDatabase(object):
+    '''
+    Wraps a pymongo.Database to hand out timed collections.
+    
+    :ivar database: the wrapped database
+    '''
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return TimedCollection(self.database[name], self.database.name)
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if isinstance(attr, pymongo.collection.Collection):
+            return TimedCollection(attr, self.database.name)
+        return attr
+
+class TimedCollection(object):
+    '''
+    Wraps a pymongo.Collection to time its operations. Queries are timed
+    from the find through fetching the last document.
+    
+    :ivar collection: the wrapped collection
+    :ivar labels: database and collection names
+    '''
+    timed = set(['find_one', 'insert', 'save', 'update', 'remove', 'find_and_modify',
+                 'ensure_index', 'create_index', 'drop_index'])
+    bulk = set(['initialize_ordered_bulk_op', 'initialize_unordered_bulk_op'])
+
+    def __init__(self, collection, db_name):
+        self.collection = collection
+        self.labels = (db_name, collection.name)
+
+    def find(self, *args, **kwargs):
+        started = time.time()
+        cursor = self.collection.find(*args, **kwargs)
+        return TimedCursor(cursor, self.labels, time.time() - started)
+
+    def __getattr__(self, name):
+        # looked up here so hasattr tells whether the wrapped collection has it
+        attr = getattr(self.collection, name)
+        if name in self.bulk:
+            return lambda: TimedBulk(attr(), self.labels)
+        if name in self.timed:
+            return timed(attr, self.labels + (name,))
+        return attr
+
+class TimedCursor(object):
+    '''
+    Wraps a pymongo.Cursor to add up the time spent fetching from it and
+    record it as one find once it is exhausted or closed.
+    
+    :ivar cursor: the wrapped cursor
+    '''
+    def __init__(self, cursor, labels, elapsed=0.0):
+        self.cursor = cursor
+        self.labels = labels
+        self.elapsed = elapsed
+        self.fetched = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        started = time.time()
+        try:
+            row = self.cursor.next()
+        except StopIteration:
+            self.elapsed += time.time() - started
+            self._observe()
+            raise
+        self.elapsed += time.time() - started
+        self.fetched = True
+        return row
+
+    def count(self, *args, **kwargs):
+        return timed(self.cursor.count, self.labels + ('count',))(*args, **kwargs)
+
+    def close(self):
+        self.cursor.close()
+        if self.fetched:
+            self._observe()
+
+    def _observe(self):
+        if self.elapsed:
+            metrics.MongoSeconds.observe(self.labels + ('find',), self.elapsed)
+            self.elapsed = 0.0
+        self.fetched = False
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kwargs):
+            # sort, skip, limit and friends return the cursor for chaining
+            result = attr(*args, **kwargs)
+            return result is self.cursor and self or result
+        return chained
+
+class TimedBulk(object):
+    '''
+    Wraps a pymongo bulk operation to time its execute.
+    '''
+    def __init__(self, bulk, labels):
+        self.bulk = bulk
+        self.execute = timed(bulk.execute, labels + ('bulk',))
+
+    def __getattr__(self, name):
+        return getattr(self.bulk, name)
+
+def timed(fn, labels):
+    '''
+    Wraps a function to record how long each call takes in metrics.MongoSeconds.
+    
+    :param fn:
+    :param labels: database, collection and operation names
+    '''
+    def _timed(*args, **kwargs):
+        started = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.MongoSeconds.observe(labels, time.time() - started)
+    return _timed
+
 def newId():
     '''Use the mongo ID mechanism but convert them to strings'''
     # Not sure why I prefer the strings, they sure look better than the objects
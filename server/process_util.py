@@ -0,0 +1,214 @@
+'''
+Process pool for the CPU bound checks of items being written, and a
+supervisor for running the whole server in several forked processes.
+
+Sanitizing html and validating against a json schema are pure python, so
+worker threads can't run them in parallel. Items bigger than CheckThreshold
+bytes are checked in worker processes instead. Smaller items stay in the
+calling thread where the pickling would cost more than it saves.
+
+Start the pool before any threads so the forked processes don't inherit
+locks held by them.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+from concurrent.futures import ProcessPoolExecutor
+from tornado.web import HTTPError
+import os
+import sys
+import errno
+import signal
+import json
+import time
+import logging
+
+import access
+import cache_util
+import sanity
+
+# items with a request body over this many bytes are checked in the pool
+CheckThreshold = 64 * 1024
+# a server process that dies sooner than this after starting is restarted after a pause
+RestartDelay = 1.0
+
+_pool = None
+# compiled validators in a worker process by schema text
+_validators = cache_util.LRUCache(100)
+
+
+def start(nprocesses):
+    '''
+    Starts nprocesses checker processes, none disables the pool.
+
+    :param nprocesses: number of processes
+    '''
+    global _pool
+    if not nprocesses:
+        return
+    _pool = ProcessPoolExecutor(nprocesses)
+    # make the processes now while this is the only thread
+    list(_pool.map(_ping, range(nprocesses)))
+    logging.info('started %d checker processes' % nprocesses)
+
+
+def shutdown():
+    '''Stops the checker processes.'''
+    global _pool
+    if _pool:
+        _pool.shutdown()
+        _pool = None
+
+
+def use_pool(size):
+    '''
+    Returns true if an item of this size should be checked in the pool.
+
+    :param size: size of the item's json in bytes
+    '''
+    return _pool is not None and size > CheckThreshold
+
+
+def check(items, schema, sanitize):
+    '''
+    Checks items in the worker processes in parallel and waits for the
+    results. Call it from a worker thread, not the IOLoop.
+
+    Returns the sanitized items or raises the same errors as checking inline.
+
+    :param items: list of decoded items
+    :param schema: schema as stored in the Schemas collection or None
+    :param sanitize: true to sanitize the items too
+    '''
+    futures = [ _pool.submit(_check, item, schema, sanitize, sanity.HTMLBackend)
+                for item in items ]
+    results = []
+    for future in futures:
+        status, result = future.result()
+        if status == 'schema':
+            raise HTTPError(403, result)
+        elif status == 'html':
+            raise HTTPError(400, result)
+        results.append(result)
+    return results
+
+
+def prefork(nprocesses):
+    '''
+    Forks nprocesses server processes and supervises them, restarting any
+    that die. Returns the process number, 0 to nprocesses - 1, in each child.
+    The parent never returns. On SIGTERM or SIGINT it passes the signal on to
+    the children and exits once they all have.
+
+    Bind the listening sockets and do anything the children must share before
+    calling this, and start the io loop, threads and connections after.
+
+    :param nprocesses: number of server processes
+    '''
+    children = {}
+    stopping = []
+
+    def fork(number):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+        children[pid] = (number, time.time())
+        return False
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for number in range(nprocesses):
+        if fork(number):
+            return number
+    logging.info('started %d server processes' % nprocesses)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        number, started = children.pop(pid)
+        if stopping:
+            continue
+        logging.warning('server process %d (pid %d) exited with status %d, restarting' %
+                        (number, pid, status))
+        if time.time() - started < RestartDelay:
+            # don't spin if it dies right away
+            time.sleep(RestartDelay)
+        if fork(number):
+            return number
+    sys.exit(0)
+
+
+def _ping(n):
+    return n
+
+
+def _check(item, schema, sanitize, backend):
+    '''Validate and sanitize an item in a worker process'''
+    if schema:
+        key = schema if isinstance(schema, basestring) else json.dumps(schema, sort_keys=True)
+        validator = _validators.get(key)
+        if validator is cache_util.Missing:
+            validator = access.compileSchema(schema)
+            _validators.set(key, validator)
+        try:
+            validator(item)
+        except ValueError, e:
+            return 'schema', e.message
+    if sanitize:
+        if sanity.HTMLBackend != backend:
+            sanity.setHTMLBackend(backend)
+        try:
+            sanity.sanitize(item)
+        except ValueError:
+            return 'html', 'HTML field parse failed'
+    return 'ok', item
+
+
+def _benchmark(nprocesses=4, ndocs=16):
+    '''Compare checking large rich text items with threads and processes'''
+    from concurrent.futures import ThreadPoolExecutor
+    import copy
+    chunk = ('<p>Some <b>rich</b> <span style="color: red; position: absolute">text</span> '
+             'with <a href="http://example.com/%d" onclick="x()">links</a>.</p>')
+    docs = [ dict(('part%dHTML' % j, ''.join(chunk % k for k in range(200)) + str(i))
+                  for j in range(10))
+             for i in range(ndocs) ]
+    size = len(json.dumps(docs[0]))
+
+    def threaded(fn):
+        def run(work):
+            threads = ThreadPoolExecutor(nprocesses)
+            list(threads.map(fn, work))
+            threads.shutdown()
+        return run
+
+    start(nprocesses)
+    for name, run in [
+            ('inline', lambda work: map(sanity.sanitize, work)),
+            ('%d threads' % nprocesses, threaded(sanity.sanitize)),
+            ('%d processes' % nprocesses, lambda work: check(work, None, True))]:
+        sanity.HTMLMemo.invalidate()
+        work = copy.deepcopy(docs)
+        t0 = time.time()
+        run(work)
+        print '%-12s %6.1f items/s of %dKB' % (name, ndocs / (time.time() - t0), size // 1024)
+    shutdown()
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,187 @@
+'''
+Timing for the stages of a request, a log of slow requests and a sampling
+profiler that can be switched on while the server runs.
+
+The settings are per process so with several server processes a change
+made through /data/_profile only applies to the one that handled it.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import cProfile
+import pstats
+import random
+import logging
+import time
+from StringIO import StringIO
+from threading import Lock
+
+# requests slower than this many milliseconds are logged, 0 disables the log
+SlowMs = 0
+# fraction of requests to profile, 0 disables the profiler
+ProfileFraction = 0.0
+
+slow_log = logging.getLogger('torongo.slow')
+
+_lock = Lock()
+_stats = None
+_profiled = 0
+
+
+class Spans(object):
+    '''
+    Lap timer for the stages of one request. Each mark ends the stage named
+    by it and starts the next one. Marking the same stage again adds to it.
+
+    :ivar names: stage names in the order first marked
+    :ivar seconds: seconds by stage name
+    '''
+    def __init__(self, started=None):
+        '''
+        :param started: time the first stage started, now by default
+        '''
+        self.names = []
+        self.seconds = {}
+        self.last = started or time.time()
+
+    def mark(self, name):
+        '''
+        Ends the current stage.
+
+        :param name: stage name
+        '''
+        now = time.time()
+        if name not in self.seconds:
+            self.names.append(name)
+            self.seconds[name] = 0.0
+        self.seconds[name] += now - self.last
+        self.last = now
+
+    def items(self):
+        '''Returns a list of (name, seconds) in order'''
+        return [ (name, self.seconds[name]) for name in self.names ]
+
+    def __str__(self):
+        return ' '.join('%s=%.1fms' % (name, seconds * 1000) for name, seconds in self.items())
+
+
+def is_slow(seconds):
+    '''
+    Returns true if a request that took this long belongs in the slow log.
+
+    :param seconds: request time
+    '''
+    return SlowMs > 0 and seconds * 1000 >= SlowMs
+
+
+def explain_summary(explain):
+    '''
+    Reduces mongo's explain output to the plan and the work it did. Handles
+    the output of the old query optimizer and of the 3.0 query planner.
+
+    :param explain: the dict from cursor.explain()
+    :rtype: dict
+    '''
+    if 'queryPlanner' in explain:
+        stats = explain.get('executionStats', {})
+        stages = []
+        stage = explain['queryPlanner'].get('winningPlan', {})
+        while stage:
+            stages.append(stage.get('indexName') and '%s(%s)' % (stage['stage'],
+                                                                 stage['indexName'])
+                          or stage.get('stage'))
+            stage = stage.get('inputStage')
+        return { 'plan': ' <- '.join(stages),
+                 'returned': stats.get('nReturned'),
+                 'keysExamined': stats.get('totalKeysExamined'),
+                 'docsExamined': stats.get('totalDocsExamined'),
+                 'millis': stats.get('executionTimeMillis'),
+                 'inMemorySort': 'SORT' in stages }
+    return { 'plan': explain.get('cursor'),
+             'returned': explain.get('n'),
+             'keysExamined': explain.get('nscanned'),
+             'docsExamined': explain.get('nscannedObjects'),
+             'millis': explain.get('millis'),
+             'inMemorySort': explain.get('scanAndOrder') }
+
+
+def set_profile_fraction(fraction):
+    '''
+    Sets the fraction of requests to profile, 0 stops profiling.
+
+    :param fraction: 0 to 1
+    '''
+    global ProfileFraction
+    ProfileFraction = min(max(float(fraction), 0.0), 1.0)
+
+
+def sample():
+    '''
+    Returns a new profiler for a sampled request or None.
+
+    :rtype: cProfile.Profile
+    '''
+    if ProfileFraction and random.random() < ProfileFraction:
+        return cProfile.Profile()
+    return None
+
+
+def collect(profiler, request=True):
+    '''
+    Adds the results of a profiler to the totals.
+
+    :param profiler: from sample
+    :param request: false for part of a request that is counted by its own profiler
+    '''
+    global _stats, _profiled
+    profiler.create_stats()
+    with _lock:
+        # pstats refuses a profiler that saw no calls
+        if not profiler.stats:
+            pass
+        elif _stats is None:
+            _stats = pstats.Stats(profiler)
+        else:
+            _stats.add(profiler)
+        if request:
+            _profiled += 1
+
+
+def runcall(fn, *args, **kwargs):
+    '''
+    Calls fn under a profiler of its own and adds it to the totals. A
+    profiler only sees the thread it was started on and can't be shared by
+    workers running at the same time.
+
+    :param fn: function to call
+    '''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        collect(profiler, False)
+
+
+def reset():
+    '''Discards the profile totals.'''
+    global _stats, _profiled
+    with _lock:
+        _stats = None
+        _profiled = 0
+
+
+def report(sort='cumulative', limit=40):
+    '''
+    Returns the profile totals as text.
+
+    :param sort: pstats sort key
+    :param limit: number of functions to list
+    :rtype: str
+    '''
+    out = StringIO()
+    out.write('profiling %g of requests, %d profiled\n' % (ProfileFraction, _profiled))
+    with _lock:
+        if _stats is not None:
+            _stats.stream = out
+            _stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -2,12 +2,27 @@
 
 HTML parts adapted from http://stackoverflow.com/questions/16861/sanitising-user-input-using-python
 
-
+Strings with nothing to rewrite are returned without parsing, and recently
+sanitized html fragments are remembered by a hash of their text so saving an
+unchanged document again is cheap. The html parser is BeautifulSoup unless
+setHTMLBackend picks lxml.
 '''
 
 import re
+import hashlib
 from urlparse import urljoin
 from BeautifulSoup import BeautifulSoup, Comment
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+import cache_util
+
+# sanitized html fragments by (backend, hash of the text), for dirty and clean text
+HTMLMemo = cache_util.LRUCache(1000)
+# longer fragments are not remembered
+HTMLMemoMaxLength = 64 * 1024
 
 def sanitize(obj, html=False):
     '''Walk an object sanitizing each part.'''
@@ -28,6 +43,10 @@ def sanitize(obj, html=False):
 
     return obj
 
+# characters that make sanitizeText or the html parser change a string
+textSpecial = re.compile('[&<>"\']')
+htmlSpecial = re.compile('[&<>]')
+
 # this should not replace & in an entity
 targets = re.compile('(&(?!([a-zA-Z0-9]+|#[0-9]+|#x[0-9a-fA-F]+);)|[<>"\'])')
 # recommended by Mark Pilgrim
@@ -43,6 +62,8 @@ def sanitizeTextHelper(match):
         
 def sanitizeText(txt):
     '''Sanitize non-html strings'''
+    if not textSpecial.search(txt):
+        return txt
     return targets.sub(sanitizeTextHelper, txt)
     
 validTags = set((
@@ -106,7 +127,45 @@ validStyles = set((
 # I'm allowing only simple values or rgb()
 stylePattern = re.compile("([-a-z]+)\s*:\s*([a-z0-9' #%]+|rgb\s*\([0-9, ]+\))\s*;")
 
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return hashlib.sha1(value).digest()
+
 def sanitizeHTML(value):
+    '''Sanitize an html fragment, reusing recent results'''
+    if not htmlSpecial.search(value):
+        # plain text that the parser would hand back unchanged
+        return value
+    if len(value) > HTMLMemoMaxLength:
+        return _sanitizeHTML(value)
+    key = (HTMLBackend, _hash(value))
+    clean = HTMLMemo.get(key)
+    if clean is cache_util.Missing:
+        clean = _sanitizeHTML(value)
+        HTMLMemo.set(key, clean)
+        # the result is already clean so saving it again can skip the parse
+        HTMLMemo.set((HTMLBackend, _hash(clean)), clean)
+    return clean
+
+def cleanAttrs(attrs, escape):
+    '''Return the permitted attributes from a list of (name, value) pairs'''
+    result = []
+    for attr, val in attrs:
+        if attr in validAttrs:
+            result.append((attr, escape(val)))
+        elif attr in urlAttrs and validUrl.match(val):
+            result.append((attr, val))
+        elif attr == 'style':
+            styles = [ (cssAttr, cssVal) for cssAttr, cssVal in stylePattern.findall(val)
+                       if cssAttr in validStyles ]
+            if styles:
+                val = ';'.join('%s:%s' % style for style in styles)
+                result.append((attr, val))
+    return result
+
+def sanitizeSoup(value):
+    '''Sanitize html with BeautifulSoup'''
     soup = BeautifulSoup(value)
     for comment in soup.findAll(text=lambda text: isinstance(text, Comment)):
         # Get rid of comments
@@ -114,22 +173,43 @@ def sanitizeHTML(value):
     for tag in soup.findAll(True):
         if tag.name not in validTags:
             tag.hidden = True
-        attrs = tag.attrs
-        tag.attrs = []
-        for attr, val in attrs:
-            if attr in validAttrs:
-                tag.attrs.append((attr, sanitizeText(val)))
-            elif attr in urlAttrs and validUrl.match(val):
-                tag.attrs.append((attr, val))
-            elif attr == 'style':
-                styles = [ (cssAttr, cssVal) for cssAttr, cssVal in stylePattern.findall(val)
-                           if cssAttr in validStyles ]
-                if styles:
-                    val = ';'.join('%s:%s' % style for style in styles)
-                    tag.attrs.append((attr, val))
-                
+        # soup attributes are the raw text so escape them here
+        tag.attrs = cleanAttrs(tag.attrs, sanitizeText)
+
     return soup.renderContents().decode('utf8')
 
+def sanitizeLxml(value):
+    '''Sanitize html with lxml, keeping the contents of dropped tags like the soup'''
+    root = lxml.html.fragment_fromstring(value, create_parent='div')
+    for comment in root.xpath('//comment()'):
+        comment.drop_tree()
+    for tag in list(root.iterdescendants()):
+        if not isinstance(tag.tag, basestring):
+            # processing instructions and the like
+            tag.drop_tree()
+            continue
+        # lxml escapes attributes when it writes them
+        attrs = cleanAttrs(tag.attrib.items(), lambda val: val)
+        tag.attrib.clear()
+        for attr, val in attrs:
+            tag.set(attr, val)
+        if tag.tag not in validTags:
+            tag.drop_tag()
+    # strip the <div> and </div> of the parent
+    return lxml.html.tostring(root, encoding='unicode')[5:-6]
+
+HTMLBackends = { 'soup': sanitizeSoup }
+if lxml:
+    HTMLBackends['lxml'] = sanitizeLxml
+
+def setHTMLBackend(name):
+    '''Choose the html sanitizer by name, one of HTMLBackends'''
+    global HTMLBackend, _sanitizeHTML
+    _sanitizeHTML = HTMLBackends[name]
+    HTMLBackend = name
+
+setHTMLBackend('soup')
+
 if __name__ == '__main__':
     t1 = { 'a': 1,
            'b': [ 2, 3 ],
@@ -141,9 +221,46 @@ if __name__ == '__main__':
            'hHTML': '<a href="http://wwww.cs.unc.edu/~gb" rel="me">Gary</a>',
            'iHTML': '''<a href="javascript:alert('gotcha')">Bad</a>''',
          }
+    import copy
+    import time
+    original = copy.deepcopy(t1)
     for key in sorted(t1.keys()):
         print key, t1[key]
     st1 = sanitize(t1)
     for key in sorted(st1.keys()):
         print key, st1[key]
 
+    # a large rich text document built from the samples, like a long page of notes
+    doc = dict(('%s%dHTML' % (key[:-4], i), '%s<p>note %d</p>' % (value, i))
+               for key, value in original.items() if key.endswith('HTML')
+               for i in range(50))
+    doc.update(('text%d' % i, original['d']) for i in range(200))
+
+    def timeit(fn, n=5, doc=doc):
+        copies = [ copy.deepcopy(doc) for i in range(n) ]
+        t0 = time.time()
+        for obj in copies:
+            fn(obj)
+        return 1000 * (time.time() - t0) / n
+
+    def parseAll(obj):
+        # what every save cost before the fast paths
+        for key, value in obj.items():
+            if key.endswith('HTML'):
+                obj[key] = _sanitizeHTML(value)
+            else:
+                obj[key] = targets.sub(sanitizeTextHelper, value)
+
+    for backend in sorted(HTMLBackends):
+        setHTMLBackend(backend)
+        print backend
+        print '  parse every field   %7.1fms' % timeit(parseAll)
+        HTMLMemo.invalidate()
+        print '  first save          %7.1fms' % timeit(sanitize, 1)
+        print '  unchanged save      %7.1fms' % timeit(sanitize)
+        HTMLMemo.invalidate()
+        clean = sanitize(copy.deepcopy(doc))
+        HTMLMemo.invalidate()
+        print '  clean, memo empty   %7.1fms' % timeit(sanitize, 1, clean)
+        print '  clean, memo warm    %7.1fms' % timeit(sanitize, 5, clean)
+
@@ -0,0 +1,55 @@
+'''
+Tests for schema checks of whole items and of changed fields.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import json
+import unittest
+
+import access
+import fakemongo
+
+
+class TestFieldSchemas(unittest.TestCase):
+    def test_fields_checked_alone(self):
+        fields = access.compileFieldSchemas({
+            '$schema': 'http://json-schema.org/draft-04/schema#', 'type': 'object',
+            'properties': { 'a': { 'type': 'string' } }, 'required': [ 'a' ],
+            'additionalProperties': False })
+        self.assertEqual(fields['required'], set([ 'a' ]))
+        self.assertRaises(ValueError, fields['properties']['a'], 1)
+        self.assertIs(fields['additional'], False)
+
+    def test_rules_across_fields_need_whole_items(self):
+        for rule in [ { 'dependencies': { 'a': [ 'b' ] } },
+                      { 'anyOf': [ { 'required': [ 'a' ] }, { 'required': [ 'b' ] } ] },
+                      { 'not': { 'required': [ 'a' ] } },
+                      { 'maxProperties': 2 },
+                      { 'patternProperties': { '^x': { 'type': 'string' } } },
+                      { 'type': [ 'object', 'null' ] },
+                      { 'properties': { 'a': { '$ref': '#' } } } ]:
+            schema = dict({ 'properties': { 'a': {} } }, **rule)
+            self.assertIs(access.compileFieldSchemas(schema), None, rule)
+
+
+class TestPatchValidation(fakemongo.HandlerTestCase):
+    def test_patch_rejects_what_put_rejects(self):
+        self.conn['Admin']['Schemas'].insert({
+            '_id': 's', 'database': 'test', 'collection': 'items',
+            'schema': json.dumps({ 'type': 'object', 'properties': { 'a': {}, 'b': {} },
+                                   'dependencies': { 'a': [ 'b' ] } }) })
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'c': 1 })).body)
+        # a needs b with it whether the item is replaced or patched
+        response = self.request(url + item['_id'], key, 'PUT', json.dumps({ 'a': 'x' }))
+        self.assertEqual(response.code, 403)
+        response = self.request(url + item['_id'], key, 'PATCH', json.dumps({ 'a': 'x' }))
+        self.assertEqual(response.code, 403)
+        response = self.request(url + item['_id'], key, 'PATCH',
+                                json.dumps({ 'a': 'x', 'b': 'y' }))
+        self.assertEqual(response.code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
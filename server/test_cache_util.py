@@ -0,0 +1,103 @@
+'''
+Tests for the LRU cache and change counters.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import time
+import unittest
+
+import cache_util
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = cache_util.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), cache_util.Missing)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_caches_none(self):
+        cache = cache_util.LRUCache()
+        cache.set('a', None)
+        self.assertIs(cache.get('a'), None)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+
+    def test_expiry(self):
+        cache = cache_util.LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIs(cache.get('a'), cache_util.Missing)
+        self.assertEqual(len(cache), 0)
+
+    def test_maxbytes(self):
+        cache = cache_util.LRUCache(maxbytes=10)
+        cache.set('a', 'x', 6)
+        cache.set('b', 'y', 6)
+        self.assertIs(cache.get('a'), cache_util.Missing)
+        self.assertEqual(cache.bytes, 6)
+        # too big to keep at all
+        cache.set('c', 'z', 11)
+        self.assertIs(cache.get('c'), cache_util.Missing)
+        self.assertEqual(cache.get('b'), 'y')
+
+    def test_replacing_counts_bytes_once(self):
+        cache = cache_util.LRUCache(maxbytes=10)
+        cache.set('a', 'x', 4)
+        cache.set('a', 'y', 5)
+        self.assertEqual(cache.bytes, 5)
+        cache.pop('a')
+        self.assertEqual(cache.bytes, 0)
+
+    def test_invalidate(self):
+        cache = cache_util.LRUCache()
+        cache.set(('db', 'one', 1), 1, 3)
+        cache.set(('db', 'two', 1), 2, 4)
+        cache.invalidate(lambda key: key[:2] == ('db', 'one'))
+        self.assertIs(cache.get(('db', 'one', 1)), cache_util.Missing)
+        self.assertEqual(cache.get(('db', 'two', 1)), 2)
+        self.assertEqual(cache.bytes, 4)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_stats(self):
+        cache = cache_util.LRUCache(5)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['maxsize'], stats['hits'], stats['misses']),
+                         (1, 5, 1, 1))
+
+
+class TestChangeCounters(unittest.TestCase):
+    def test_version_changes_with_bump(self):
+        counters = cache_util.ChangeCounters()
+        before = counters.version(('db', 'items'))
+        self.assertEqual(counters.bump(('db', 'items')), 1)
+        after = counters.version(('db', 'items'))
+        self.assertNotEqual(before, after)
+        self.assertEqual(counters.count(before), 0)
+        self.assertEqual(counters.count(after), 1)
+
+    def test_unicode_and_str_keys_count_together(self):
+        counters = cache_util.ChangeCounters()
+        counters.bump((u'db', u'items'))
+        self.assertEqual(counters.count(counters.version(('db', 'items'))), 1)
+
+    def test_foreign_versions(self):
+        counters = cache_util.ChangeCounters()
+        other = cache_util.ChangeCounters()
+        other._epoch = 'x'
+        self.assertIs(counters.count(other.version('a')), None)
+        self.assertIs(counters.count('garbage'), None)
+        self.assertIs(counters.count(counters._epoch + '.zz'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+'''
+Tests for reducing queries to shapes and matching them with indexes.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import re
+import time
+import unittest
+
+import pymongo
+
+import fakemongo
+import index_util
+
+
+class TestShape(unittest.TestCase):
+    def test_equality_sort_and_ranges(self):
+        shape = index_util.shape({'b': 1, 'a': 'x', 'n': {'$gte': 3}},
+                                 [('d', pymongo.DESCENDING)])
+        self.assertEqual(shape, (('a', 'b'), (('d', -1),), ('n',)))
+
+    def test_in_is_equality_and_and_is_flattened(self):
+        shape = index_util.shape({'$and': [{'a': {'$in': [1, 2]}}, {'b': {'$lt': 4}}]}, [])
+        self.assertEqual(shape, (('a',), (), ('b',)))
+
+    def test_sort_on_an_equality_field_is_dropped(self):
+        shape = index_util.shape({'a': 1}, [('a', pymongo.ASCENDING), ('b', pymongo.ASCENDING)])
+        self.assertEqual(shape, (('a',), (('b', 1),), ()))
+
+    def test_patterns(self):
+        self.assertEqual(index_util.shape({'a': re.compile('^x')}, []), ((), (), ('a',)))
+        # a case insensitive or unanchored pattern can't use an index
+        self.assertIs(index_util.shape({'a': re.compile('^x', re.I)}, []), None)
+        self.assertIs(index_util.shape({'a': re.compile('x')}, []), None)
+
+    def test_nothing_to_index(self):
+        self.assertIs(index_util.shape({}, []), None)
+        self.assertIs(index_util.shape({'$or': [{'a': 1}, {'b': 2}]}, None), None)
+
+
+class TestCovers(unittest.TestCase):
+    def test_index_key_covers_its_shape(self):
+        shape = (('a', 'b'), (('d', -1),), ('n',))
+        key = index_util.index_key(shape)
+        self.assertEqual(key, [('a', 1), ('b', 1), ('d', -1), ('n', 1)])
+        self.assertTrue(index_util.covers(key, shape))
+
+    def test_equality_fields_in_any_order(self):
+        shape = (('a', 'b'), (), ())
+        self.assertTrue(index_util.covers([('b', 1), ('a', -1)], shape))
+        self.assertFalse(index_util.covers([('a', 1), ('c', 1)], shape))
+
+    def test_sort_in_either_direction(self):
+        shape = ((), (('a', 1), ('b', -1)), ())
+        self.assertTrue(index_util.covers([('a', -1), ('b', 1)], shape))
+        self.assertFalse(index_util.covers([('a', 1), ('b', 1)], shape))
+        self.assertFalse(index_util.covers([('b', -1), ('a', 1)], shape))
+
+    def test_ranges_after_the_sort(self):
+        shape = (('a',), (), ('n',))
+        self.assertTrue(index_util.covers([('a', 1), ('n', 1), ('z', 1)], shape))
+        self.assertFalse(index_util.covers([('n', 1), ('a', 1)], shape))
+
+    def test_special_indexes_never_cover(self):
+        for special in [ 'text', '2dsphere', '2d', 'hashed' ]:
+            self.assertFalse(index_util.covers([ ('a', special) ], (('a',), (), ())))
+            self.assertFalse(index_util._startswith([ ('a', special) ], [ ('a', 1) ]))
+
+    def test_float_directions(self):
+        # older servers report directions as doubles
+        self.assertTrue(index_util.covers([ ('a', 1.0), ('b', -1.0) ],
+                                          ((), (('a', 1), ('b', -1)), ())))
+        self.assertTrue(index_util._startswith([ ('a', 1.0), ('b', 1.0) ], [ ('a', 1) ]))
+
+
+
+class TestBuilder(unittest.TestCase):
+    def test_keeps_building_after_a_failure(self):
+        class Broken(object):
+            def index_information(self):
+                raise ValueError('invalid literal for int()')
+        collection = fakemongo.Connection()['test']['items']
+        collection.indexes['a_text'] = { 'key': [ ('a', 'text') ] }
+        index_util._builds.put((Broken(), ('test', 'broken'), [ ('a', 1) ], 'test'))
+        index_util._builds.put((collection, ('test', 'items'), [ ('a', 1) ], 'test'))
+        index_util._start()
+        for i in range(100):
+            if 'a_1' in collection.indexes:
+                break
+            time.sleep(0.01)
+        self.assertEqual(collection.indexes['a_1'], { 'key': [ ('a', 1) ] })
+
+
+if __name__ == '__main__':
+    unittest.main()
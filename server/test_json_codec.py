@@ -0,0 +1,68 @@
+'''
+Tests for the json codec's $ref handling and bson types.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import json
+import re
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+
+import json_codec
+
+
+class TestCodec(unittest.TestCase):
+    def tearDown(self):
+        json_codec.setBackend('json')
+
+    def test_refs_are_stored_as_ref(self):
+        item = json_codec.loads('{"parent": {"$ref": "abc"}, "text": "say \\"$ref\\":"}')
+        self.assertEqual(item, {'parent': {'_ref': 'abc'}, 'text': 'say "$ref":'})
+        self.assertEqual(json.loads(json_codec.dumps(item)),
+                         {'parent': {'$ref': 'abc'}, 'text': 'say "$ref":'})
+
+    def test_only_keys_are_renamed(self):
+        item = { 'text': 'a "_ref": b', '_ref': 'x',
+                 'list': [ 1, { 'note': '"_ref":', 'inner': { '_ref': 'y' } } ] }
+        self.assertEqual(json.loads(json_codec.dumps(item)),
+                         { 'text': 'a "_ref": b', '$ref': 'x',
+                           'list': [ 1, { 'note': '"_ref":', 'inner': { '$ref': 'y' } } ] })
+        # the caller's object is left as it was
+        self.assertEqual(item['list'][1]['inner'], { '_ref': 'y' })
+        self.assertEqual(json_codec.dumps({ 'text': '"_ref":' }), '{"text": "\\"_ref\\":"}')
+
+    def test_bson_types_round_trip(self):
+        # bson decodes dates as utc
+        item = {'date': datetime(2010, 6, 1, 12, 30, 15, tzinfo=utc),
+                'id': ObjectId('4c0a6e3b5e11c5a1b2000000'),
+                'ref': {'_ref': 'x'}, 'n': [1, 2.5, None, True], 'text': u'caf\xe9'}
+        back = json_codec.loads(json_codec.dumps(item))
+        self.assertEqual(back, item)
+
+    def test_patterns_decode(self):
+        query = json_codec.loads('{"a": {"$regex": "^x", "$options": "i"}}')
+        self.assertEqual(query['a'].pattern, '^x')
+        self.assertTrue(query['a'].flags & re.I)
+        self.assertEqual(json.loads(json_codec.dumps(query)),
+                         {'a': {'$regex': '^x', '$options': 'i'}})
+
+    def test_plain_bodies_skip_the_hook(self):
+        self.assertEqual(json_codec.loads('{"a": [1, {"b": "c"}]}'), {'a': [1, {'b': 'c'}]})
+
+    def test_backends(self):
+        for name in json_codec.Backends:
+            if name == 'json' or json_codec._roundTrips(name):
+                json_codec.setBackend(name)
+                self.assertEqual(json_codec.Backend, name)
+                self.test_bson_types_round_trip()
+            else:
+                self.assertRaises(ValueError, json_codec.setBackend, name)
+        self.assertRaises(KeyError, json_codec.setBackend, 'nonesuch')
+
+
+if __name__ == '__main__':
+    unittest.main()
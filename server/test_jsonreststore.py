@@ -0,0 +1,275 @@
+'''
+Tests for the query helpers in jsonreststore that don't need a server.
+
+:copyright: Gary Bishop 2010
+:license: BSD
+'''
+import json
+import unittest
+import urllib
+from datetime import datetime
+
+import pymongo
+from bson.objectid import ObjectId
+
+import access
+import fakemongo
+import jsonreststore
+from jsonreststore import BsonTypeOrder, BsonTypeRank, KeysetQuery
+
+
+def matches(doc, query):
+    '''Evaluate the kinds of query KeysetQuery makes the way mongo would'''
+    if '$or' in query:
+        return any(matches(doc, clause) for clause in query['$or'])
+    for field, test in query.iteritems():
+        value = doc.get(field)
+        if test is None:
+            ok = value is None
+        elif isinstance(test, dict) and '$type' in test:
+            ok = value is not None and test['$type'] in BsonTypeOrder[BsonTypeRank(value)]
+        elif isinstance(test, dict) and '$in' in test:
+            ok = value in test['$in']
+        elif isinstance(test, dict):
+            # $gt and $lt only compare values of the same type
+            op, bound = test.items()[0]
+            ok = (value is not None and BsonTypeRank(value) == BsonTypeRank(bound) and
+                  (op == '$gt' and value > bound or op == '$lt' and value < bound))
+        else:
+            ok = BsonTypeRank(value) == BsonTypeRank(test) and value == test
+        if not ok:
+            return False
+    return True
+
+
+class Reversed(object):
+    '''Sort key in descending order'''
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class TestKeysetQuery(unittest.TestCase):
+    values = [None, 'missing', 1, 2.5, 3, u'a', u'b', ObjectId('4c0a6e3b5e11c5a1b2000000'),
+              False, True, datetime(2010, 6, 1)]
+
+    def docs(self):
+        docs = []
+        for i, value in enumerate(self.values * 2):
+            doc = {'_id': i}
+            if value != 'missing':
+                doc['v'] = value
+            docs.append(doc)
+        return docs
+
+    def check(self, direction):
+        sortSpec = [('v', direction), ('_id', pymongo.ASCENDING)]
+        def key(doc):
+            value = doc.get('v')
+            rank = (BsonTypeRank(value), value)
+            return (direction == pymongo.ASCENDING and rank or Reversed(rank), doc['_id'])
+        docs = sorted(self.docs(), key=key)
+        for i, doc in enumerate(docs):
+            query = KeysetQuery(sortSpec, [doc.get('v'), doc['_id']])
+            after = [d['_id'] for d in docs if matches(d, query)]
+            self.assertEqual(after, [d['_id'] for d in docs[i + 1:]], (doc, query))
+
+    def test_ascending(self):
+        self.check(pymongo.ASCENDING)
+
+    def test_descending(self):
+        self.check(pymongo.DESCENDING)
+
+    def test_nothing_after_the_last_type(self):
+        query = KeysetQuery([('v', pymongo.DESCENDING)], [None])
+        self.assertEqual(query, {'_id': {'$in': []}})
+
+    def test_single_clause(self):
+        self.assertEqual(KeysetQuery([('_id', pymongo.ASCENDING)], [u'x']),
+                         {'$or': [{'_id': {'$gt': u'x'}}] +
+                          [{'_id': {'$type': code}} for codes in BsonTypeOrder[3:]
+                           for code in codes]})
+
+
+class TestTypeRank(unittest.TestCase):
+    def test_ranks(self):
+        self.assertEqual(BsonTypeRank(None), 0)
+        self.assertEqual(BsonTypeRank(3), BsonTypeRank(2.5))
+        self.assertEqual(BsonTypeRank(True), BsonTypeOrder.index([8]))
+        self.assertEqual(BsonTypeRank(u'x'), BsonTypeRank('x'))
+        self.assertTrue(BsonTypeRank(u'x') < BsonTypeRank({}) < BsonTypeRank([]))
+
+
+
+class TestPut(fakemongo.HandlerTestCase):
+    def test_replaces_the_fields(self):
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': 1, 'b': 2 })).body)
+        collection = self.conn['test']['items']
+        versions = []
+        findAndModify = collection.find_and_modify
+        def recordVersion(query, update, **kwargs):
+            versions.append(update['$set'][access.VersionKey])
+            return findAndModify(query, update, **kwargs)
+        collection.find_and_modify = recordVersion
+        response = self.request(url + item['_id'], key, 'PUT', json.dumps({ 'a': 3 }))
+        self.assertEqual(response.code, 200)
+        doc = collection.docs[0]
+        self.assertEqual((doc['a'], 'b' in doc, doc[access.OwnerKey]),
+                         (3, False, item[access.OwnerKey]))
+        # removing b made another version so a read of the item with b isn't current
+        self.assertNotEqual(doc[access.VersionKey], versions[0])
+
+    def test_refuses_dotted_and_operator_fields(self):
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': { 'b': 1 } })).body)
+        for body in [ { 'a.b': 2 }, { '$inc': { 'a': 1 } }, [ 1 ] ]:
+            response = self.request(url + item['_id'], key, 'PUT', json.dumps(body))
+            self.assertEqual(response.code, 400, body)
+        self.assertEqual(self.conn['test']['items'].docs[0]['a'], { 'b': 1 })
+
+
+
+class TestETags(fakemongo.HandlerTestCase):
+    def etag(self, response):
+        self.assertTrue(response.headers['Etag'].startswith('W/"'))
+        return response.headers['Etag'][3:-1]
+
+    def test_query_tag_is_changes_and_query(self):
+        url, key = self.key()
+        self.request(url, key, 'POST', json.dumps({ 'a': 1 }))
+        response = self.request(url, key)
+        self.assertEqual(response.code, 200)
+        tag = self.etag(response)
+        changes, query = tag.split(':')
+        self.assertEqual(changes, jsonreststore.Changes.version(('test', 'items')))
+        self.assertTrue(query.startswith('q'))
+        # the same query is unchanged, another one isn't
+        response = self.request(url, key, headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual((response.code, response.body), (304, ''))
+        response = self.request(url + '?mq=%7B%22a%22%3A1%7D', key,
+                                headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 200)
+        # any write to the collection changes the tag
+        self.request(url, key, 'POST', json.dumps({ 'a': 2 }))
+        response = self.request(url, key, headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(self.etag(response), tag)
+        self.assertEqual(len(json.loads(response.body)), 2)
+
+    def test_item_tag_is_changes_version_and_variant(self):
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': 1 })).body)
+        other = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': 2 })).body)
+        response = self.request(url + item['_id'], key)
+        self.assertEqual(response.code, 200)
+        tag = self.etag(response)
+        changes, version, variant = tag.split(':')
+        self.assertEqual(changes, jsonreststore.Changes.version(('test', 'items')))
+        self.assertEqual(version, self.conn['test']['items'].docs[0][access.VersionKey])
+        response = self.request(url + item['_id'], key,
+                                headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 304)
+        # another item's change moves the counter but this item's version still matches
+        self.request(url + other['_id'], key, 'PATCH', json.dumps({ 'a': 3 }))
+        response = self.request(url + item['_id'], key,
+                                headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 304)
+        self.assertNotEqual(self.etag(response).split(':')[0], changes)
+        self.assertEqual(self.etag(response).split(':')[1:], [ version, variant ])
+        # its own change gives it a new version
+        self.request(url + item['_id'], key, 'PATCH', json.dumps({ 'a': 4 }))
+        response = self.request(url + item['_id'], key,
+                                headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['a'], 4)
+        self.assertNotEqual(self.etag(response).split(':')[1], version)
+
+    def test_other_fields_are_another_variant(self):
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': 1, 'b': 2 })).body)
+        tag = self.etag(self.request(url + item['_id'], key))
+        response = self.request(url + item['_id'] + '?mf=a', key,
+                                headers={ 'If-None-Match': 'W/"%s"' % tag })
+        self.assertEqual(response.code, 200)
+        self.assertEqual(sorted(json.loads(response.body)), [ '_id', 'a' ])
+
+    def test_request_etags(self):
+        class Request(object):
+            headers = { 'If-None-Match': 'W/"a:b", "c:d:e" ,W/"f"' }
+        self.assertEqual(jsonreststore.RequestETags(Request()), [ 'a:b', 'c:d:e', 'f' ])
+
+
+
+class TestBatch(fakemongo.HandlerTestCase):
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.batchCount = jsonreststore.BatchCount
+        jsonreststore.BatchCount = 2
+
+    def tearDown(self):
+        jsonreststore.BatchCount = self.batchCount
+        super(TestBatch, self).tearDown()
+
+    def test_queries_return_at_most_batch_count(self):
+        url, key = self.key()
+        for i in range(5):
+            self.request(url, key, 'POST', json.dumps({ 'a': i }))
+        query = { 'key': key, 'database': 'test', 'collection': 'items', 'ms': '+a' }
+        queries = [ query, dict(query, count=10), dict(query, start=4), dict(query, count=1) ]
+        response = self.fetch('/data/_batch?q=' + urllib.quote(json.dumps(queries)))
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body)['results']
+        self.assertEqual([ ([ item['a'] for item in result['items'] ], result['range'])
+                           for result in results ],
+                         [ ([ 0, 1 ], 'items 0-1/5'), ([ 0, 1 ], 'items 0-1/5'),
+                           ([ 4 ], 'items 4-4/5'), ([ 0 ], 'items 0-0/5') ])
+
+
+
+class TestBulk(fakemongo.HandlerTestCase):
+    def raceOwners(self, bulk):
+        '''Change an owner and delete an item right after the bulk reads the owners'''
+        url, key = self.key()
+        ids = [ json.loads(self.request(url, key, 'POST', json.dumps({ 'a': i })).body)['_id']
+                for i in range(3) ]
+        collection = self.conn['test']['items']
+        collection.bulk = bulk
+        find = collection.find
+        def racingFind(spec=None, fields=None, **kwargs):
+            rows = list(find(spec, fields=fields))
+            collection.docs[0][access.OwnerKey] = 'some.one@else'
+            del collection.docs[1]
+            return iter(rows)
+        collection.find = racingFind
+        ops = [ { 'method': 'put', 'id': ids[0], 'content': { 'a': 10 } },
+                { 'method': 'delete', 'id': ids[1] },
+                { 'method': 'patch', 'id': ids[2], 'content': { 'a': 12 } } ]
+        response = self.request(url + '_bulk', key, 'POST', json.dumps(ops))
+        self.assertEqual(response.code, 409)
+        # the op that still matched was written
+        self.assertEqual([ doc['a'] for doc in collection.docs ], [ 0, 12 ])
+
+    def test_conflicts_in_bulk(self):
+        self.raceOwners(True)
+
+    def test_conflicts_one_at_a_time(self):
+        self.raceOwners(False)
+
+    def test_writes(self):
+        url, key = self.key()
+        item = json.loads(self.request(url, key, 'POST', json.dumps({ 'a': 1 })).body)
+        ops = [ { 'method': 'post', 'content': { 'a': 2 } },
+                { 'method': 'patch', 'id': item['_id'], 'content': { 'a': 3 } } ]
+        response = self.request(url + '_bulk', key, 'POST', json.dumps(ops))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(sorted(doc['a'] for doc in self.conn['test']['items'].docs), [ 2, 3 ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,8 @@ Utilities for running threaded workers in web request handlers.
 '''
 import tornado.web
 from tornado import ioloop
+from tornado.concurrent import Future
+from concurrent.futures import Executor
 import os
 import fcntl
 import sys
@@ -16,6 +18,38 @@ import logging
 from threading import Thread, Lock, Event, local
 from Queue import Queue, Empty
 
+def _format_status(running):
+    '''
+    Formats a snapshot of running thread info as a table.
+    
+    :param running: list of (ident, (begintime, fun, args, kwargs))
+    :rtype: str
+    '''
+    now = time.time()
+    s = '# ident'.ljust(20) + 'invocation' + '\n'
+    for ident, (begintime, fun, args, kwargs) in running:
+        s += str(ident).ljust(20)
+        args = map(repr, args) + \
+               ['%s=%r' % (k, v) for k, v in kwargs.items()]
+        s += '%s(%s)' % (getattr(fun, '__name__', repr(fun)), ', '.join(args))
+        s += ' [for %fs]' % (now - begintime)
+        s += '\n'
+    return s
+
+class TaskTimeout(tornado.web.HTTPError):
+    '''
+    Delivered to a waiting handler when a task runs past its timeout.
+    '''
+    def __init__(self):
+        super(TaskTimeout, self).__init__(503, 'worker timed out')
+
+class TaskCancelled(tornado.web.HTTPError):
+    '''
+    Delivered to a waiting handler when its task was cancelled.
+    '''
+    def __init__(self):
+        super(TaskCancelled, self).__init__(503, 'worker cancelled')
+
 class AsyncThreadPool(object):
     '''
     Provide a pool of N threads that executes tasks and issues callbacks with 
@@ -214,31 +248,337 @@ class AsyncThreadPool(object):
         
         :rtype: str
         '''
-        now = time.time()
-        with POOL._lock:
-            running = copy.copy(POOL._running.items())
-        s = '# ident'.ljust(20) + 'invocation' + '\n'
-        for ident, (begintime, fun, args, kwargs) in running:
-            s += str(ident).ljust(20)
-            args = map(repr, args) + \
-                   ['%s=%r' % (k, v) for k, v in kwargs.items()]
-            s += '%s(%s)' % (fun.__name__, ', '.join(args))
-            s += ' [for %fs]' % (now - begintime)
-            s += '\n'
-        return s
+        with self._lock:
+            running = copy.copy(self._running.items())
+        return _format_status(running)
+
+class FutureThreadPool(Executor):
+    '''
+    Provide a pool of N threads implementing the concurrent.futures Executor
+    interface. submit returns tornado futures for use with ``yield`` in
+    coroutines. Completed results are collected in a list and delivered by a
+    single IO loop callback per batch rather than one wakeup per task. Tasks
+    can have a timeout and can be cancelled, for example when the client
+    disconnects.
+    
+    The threads read a plain Queue rather than using ThreadPoolExecutor,
+    whose per-task concurrent.futures.Future costs more than the rest of the
+    dispatch put together under Python 2.
+    
+    Futures must be submitted and cancelled from the IO loop thread.
+    
+    :ivar _io_loop:
+    :ivar _queue:
+    :ivar _threads:
+    :ivar _done: completed (future, result, exc_info) awaiting delivery
+    :ivar _done_lock:
+    :ivar _timeouts: maps waiting futures to their timeout handles
+    :ivar _running:
+    :ivar _lock:
+    :ivar _join_event:
+    :ivar stuck_threads: number of threads running longer than the trigger
+    :ivar counters: task totals and accumulated wait and run seconds
+    '''
+    MONITOR_INTERVAL_SECONDS             = 15
+    MONITOR_TRIGGER_STUCK_THREAD_SECONDS = 30
+
+    def __init__(self, nthreads=1, timeout=None):
+        '''
+        :param nthreads: Number of threads to create in the pool
+        :type nthreads: int
+        :param timeout: Default seconds before a task times out or None
+        :type timeout: float
+        '''
+        self._io_loop = ioloop.IOLoop.instance()
+        self._queue = Queue()
+        self.timeout = timeout
+
+        # completed tasks waiting for the io loop
+        self._done = []
+        self._done_lock = Lock()
+        # only touched on the io loop thread
+        self._timeouts = {}
+
+        # info about thread workers
+        self._running = {}
+        self._lock = Lock()
+        self._join_event = Event()
+
+        self.stuck_threads = 0
+        self.counters = dict(submitted=0, completed=0, failed=0, timeouts=0,
+                             cancelled=0, wakeups=0, wait_seconds=0.0,
+                             run_seconds=0.0)
+
+        # create the thread pool
+        self._threads = []
+        for i in range(nthreads):
+            t = Thread(target=self._loop)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+        # create a monitor thread
+        t = Thread(target=self._monitor)
+        t.setDaemon(True)
+        t.start()
+
+    def submit(self, worker, *args, **kwargs):
+        '''
+        Queue a worker to run with the default timeout.
+        
+        :param worker:
+        :param args:
+        :param kwargs:
+        :rtype: tornado.concurrent.Future
+        '''
+        return self.submit_timeout(self.timeout, worker, *args, **kwargs)
+
+    def submit_timeout(self, timeout, worker, *args, **kwargs):
+        '''
+        Queue a worker to run, failing its future with TaskTimeout if it has
+        not finished after timeout seconds. The thread itself can't be
+        interrupted so a timed out worker that already started still runs to
+        completion.
         
+        :param timeout: seconds or None for no timeout
+        :param worker:
+        :param args:
+        :param kwargs:
+        :rtype: tornado.concurrent.Future
+        '''
+        future = Future()
+        self._queue.put((future, time.time(), worker, args, kwargs))
+        if timeout is not None:
+            self._timeouts[future] = self._io_loop.add_timeout(
+                time.time() + timeout, lambda: self._fail(future, TaskTimeout))
+        self.counters['submitted'] += 1
+        return future
+
+    def _loop(self):
+        '''
+        Runs a worker thread loop until a None task is received.
+        '''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # thread shutting down
+                return
+            future = item[0]
+            if future.done():
+                # cancelled or timed out while queued
+                continue
+            self._run(*item)
+
+    def _run(self, future, queued, worker, args, kwargs):
+        '''
+        Runs a worker in a pool thread and queues the result for delivery.
+        '''
+        started = time.time()
+        with self._lock:
+            self._running[thread.get_ident()] = (started, worker, args, kwargs)
+        try:
+            result = (worker(*args, **kwargs), None)
+        except Exception:
+            result = (None, sys.exc_info())
+        finished = time.time()
+        with self._lock:
+            del self._running[thread.get_ident()]
+            self.counters['wait_seconds'] += started - queued
+            self.counters['run_seconds'] += finished - started
+
+        with self._done_lock:
+            wake = not self._done
+            self._done.append((future, ) + result)
+        if wake:
+            # one wakeup delivers everything that completes before it runs
+            self._io_loop.add_callback(self._flush)
+
+    def _flush(self):
+        '''
+        Deliver all completed results on the io loop.
+        '''
+        with self._done_lock:
+            done, self._done = self._done, []
+        self.counters['wakeups'] += 1
+        for future, result, exc_info in done:
+            handle = self._timeouts.pop(future, None)
+            if handle is not None:
+                self._io_loop.remove_timeout(handle)
+            if future.done():
+                # already timed out or cancelled
+                continue
+            if exc_info is None:
+                self.counters['completed'] += 1
+                future.set_result(result)
+            else:
+                self.counters['failed'] += 1
+                future.set_exc_info(exc_info)
+
+    def _fail(self, future, error):
+        '''
+        Fail a waiting future with TaskTimeout or TaskCancelled. A queued
+        task is then skipped by the threads.
+        '''
+        handle = self._timeouts.pop(future, None)
+        if handle is not None:
+            self._io_loop.remove_timeout(handle)
+        if not future.done():
+            self.counters[error is TaskTimeout and 'timeouts' or 'cancelled'] += 1
+            future.set_exception(error())
+
+    def cancel(self, future):
+        '''
+        Cancel a task. It won't start if it is still queued and its future
+        fails with TaskCancelled either way.
+        
+        :param future: as returned by submit
+        '''
+        self._fail(future, TaskCancelled)
+
+    def _monitor(self):
+        '''
+        Runs a monitor thread until a join event is set.
+        '''
+        while not self._join_event.is_set():
+            self._count_stuck_threads()
+            self._join_event.wait(self.MONITOR_INTERVAL_SECONDS)
+
+    def _count_stuck_threads(self):
+        '''
+        Records how many threads have been running too long. Unlike
+        AsyncThreadPool this only reports, it never kills the server.
+        '''
+        with self._lock:
+            now = time.time()
+            elapseds = [now - t for t, _, _, _ in self._running.values()]
+        nelapsed = len([ d for d in elapseds
+                         if d > self.MONITOR_TRIGGER_STUCK_THREAD_SECONDS ])
+        if nelapsed:
+            logging.warning('monitor: %d of %d threads are stuck' %
+                            (nelapsed, len(self._threads)))
+        self.stuck_threads = nelapsed
+
+    def stats(self):
+        '''
+        Gets counters describing the pool.
+        
+        :rtype: dict
+        '''
+        with self._lock:
+            result = dict(self.counters)
+            result['active'] = len(self._running)
+        result['threads'] = len(self._threads)
+        result['queued'] = self._queue.qsize()
+        result['stuck'] = self.stuck_threads
+        return result
+
+    def join(self):
+        '''
+        Wait for all tasks to complete and deliver their results. The object
+        is effectively dead after this call.
+        '''
+        self._join_event.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        while self._threads:
+            self._threads.pop().join()
+        self._flush()
+
+    def shutdown(self, wait=True):
+        '''
+        Executor interface to join.
+        '''
+        self.join()
+
+    def __call__(self, callback, worker, *args, **kwargs):
+        '''
+        Queue a worker to run and pass its result to a callback on the io 
+        loop, compatible with AsyncThreadPool.
+        
+        :param callback: called with (result, exception, traceback)
+        :param worker:
+        :param args:
+        :param kwargs:
+        '''
+        future = self.submit(worker, *args, **kwargs)
+        if callback is None:
+            return
+        def _done(future):
+            exc_info = future.exc_info()
+            if exc_info:
+                callback(None, exc_info[1], exc_info[2])
+            else:
+                callback(future.result(), None, None)
+        # futures resolve on the io loop so call back directly from there
+        future.add_done_callback(_done)
+
+    def get_status(self):
+        '''
+        Gets the status of all running threads. Useful for debugging.
+        
+        :rtype: str
+        '''
+        with self._lock:
+            running = copy.copy(self._running.items())
+        return _format_status(running)
+
 class ThreadPoolApplication(tornado.web.Application):
     '''
     Builds a thread pool during object construction.
+    
+    :ivar in_flight: number of requests being handled
     '''
     def __init__(self, *args, **kwargs):
         super(ThreadPoolApplication, self).__init__(*args, **kwargs)
-        self.thread_pool = AsyncThreadPool(kwargs.get('thread_count'))
+        self.thread_pool = FutureThreadPool(kwargs.get('thread_count'),
+                                            kwargs.get('task_timeout'))
+        self.in_flight = 0
+
+    def drain(self, server, timeout, callback):
+        '''
+        Stops accepting connections and calls the callback once the requests
+        in flight finish or timeout seconds pass.
+        
+        :param server: the tornado.httpserver.HTTPServer to stop
+        :param timeout: most seconds to wait
+        :param callback: called with no arguments on the io loop
+        '''
+        server.stop()
+        io_loop = ioloop.IOLoop.instance()
+        deadline = time.time() + timeout
+        def check():
+            if self.in_flight and time.time() < deadline:
+                io_loop.add_timeout(time.time() + 0.1, check)
+                return
+            if self.in_flight:
+                logging.warning('stopping with %d requests in flight' % self.in_flight)
+            callback()
+        check()
 
 class ThreadedRequestHandler(tornado.web.RequestHandler):
     '''
     Provides convenience methods for using the thread pool.
     '''
+    def __init__(self, *args, **kwargs):
+        super(ThreadedRequestHandler, self).__init__(*args, **kwargs)
+        # count the requests in flight for draining before a shutdown
+        self._in_flight = hasattr(self.application, 'in_flight')
+        if self._in_flight:
+            self.application.in_flight += 1
+
+    def on_finish(self):
+        if self._in_flight:
+            self._in_flight = False
+            self.application.in_flight -= 1
+
+    def wrap_worker(self, worker):
+        '''
+        Hook for subclasses to wrap every worker run in the pool.
+        
+        :param worker:
+        '''
+        return worker
+
     def run_async(self, callback, worker, *args, **kwargs):
         '''
         Runs a worker function in a thread and receives the result in a 
@@ -249,4 +589,72 @@ class ThreadedRequestHandler(tornado.web.RequestHandler):
         :param args:
         :param kwargs:
         '''
-        self.application.thread_pool(callback, worker, *args, **kwargs)
+        self.application.thread_pool(callback, self.wrap_worker(worker),
+                                     *args, **kwargs)
+
+    def run_future(self, worker, *args, **kwargs):
+        '''
+        Runs a worker function in a thread and returns a future that is 
+        resolved on the IO loop with its result or exception. Meant to be 
+        yielded from a coroutine. The task is cancelled if the client
+        disconnects first.
+        
+        :param worker:
+        :param args:
+        :param kwargs:
+        :rtype: tornado.concurrent.Future
+        '''
+        future = self.application.thread_pool.submit(self.wrap_worker(worker),
+                                                     *args, **kwargs)
+        if not hasattr(self, '_pool_futures'):
+            self._pool_futures = set()
+        self._pool_futures.add(future)
+        future.add_done_callback(self._pool_futures.discard)
+        return future
+
+    def on_connection_close(self):
+        '''
+        Cancel outstanding pool tasks when the client goes away.
+        '''
+        for future in list(getattr(self, '_pool_futures', [])):
+            self.application.thread_pool.cancel(future)
+        super(ThreadedRequestHandler, self).on_connection_close()
+
+def _benchmark(pool, ntasks, use_futures):
+    '''
+    Times dispatching trivial tasks through a pool until every result has
+    been delivered on the io loop.
+    
+    :rtype: seconds per task
+    '''
+    io_loop = ioloop.IOLoop.instance()
+    remaining = [ntasks]
+    def _delivered(*args):
+        remaining[0] -= 1
+        if not remaining[0]:
+            io_loop.stop()
+    def _start():
+        for i in xrange(ntasks):
+            if use_futures:
+                pool.submit(int).add_done_callback(_delivered)
+            else:
+                pool(_delivered, int)
+    t0 = time.time()
+    io_loop.add_callback(_start)
+    io_loop.start()
+    elapsed = time.time() - t0
+    pool.join()
+    return elapsed / ntasks, getattr(pool, 'counters', {}).get('wakeups')
+
+if __name__ == '__main__':
+    # dispatch overhead per task, the pipe pool writes one wakeup byte per task
+    ntasks = 20000
+    for nthreads in [ 1, 4, 16 ]:
+        print 'threads=%d' % nthreads
+        for name, pool, use_futures in [
+                ('pipe pool callbacks', AsyncThreadPool(nthreads), False),
+                ('future pool callbacks', FutureThreadPool(nthreads), False),
+                ('future pool futures', FutureThreadPool(nthreads), True) ]:
+            seconds, wakeups = _benchmark(pool, ntasks, use_futures)
+            print '  %-22s %6.1f us/task %6s wakeups' % (name, 1e6 * seconds,
+                                                        wakeups or ntasks)